@@ -65,6 +65,88 @@ def logsumexp(x: Tensor, dim: int) -> Tensor:
     s = (x - m.masked_fill_(mask, 0).unsqueeze(dim=dim)).exp().sum(dim=dim)
     return s.masked_fill_(mask, 1).log() + m.masked_fill_(mask, -float('inf'))
 
+def compact_tokens(tokens: Tensor, mask: Tensor, pad: int) -> Tensor:
+    # left-align the tokens where mask is set (in order) and pad the rest
+    batch_size, length = tokens.shape
+    pos = (mask.long().cumsum(dim=-1) - 1).masked_fill_(~mask, length) # masked-out tokens go to an extra column
+    res = tokens.new_full((batch_size, length + 1), pad).scatter_(1, pos, tokens)
+    return res[:, :int(mask.sum(dim=-1).max())]
+
+def repeated_ngram_mask(res: Tensor, cands: Tensor, no_consecutive_repeated_ngram: int, no_repeated_ngram: int) -> Tensor:
+    # res: batch * length, the tokens generated so far; cands: batch * cand_num, the candidates of the next token
+    # returns the mask of the candidates repeating the last token, a consecutive k-gram (k <= no_consecutive_repeated_ngram)
+    # or an n-gram of res (n = no_repeated_ngram), comparing the windows of res exactly
+    length = res.size(1)
+    banned = torch.zeros_like(cands, dtype=torch.bool)
+    if length == 0:
+        return banned
+    banned |= cands == res[:, -1:]
+    for k in range(2, min(no_consecutive_repeated_ngram, (length + 1) // 2) + 1):
+        repeated = (res[:, length - k + 1:] == res[:, length - 2 * k + 1:length - k]).all(dim=-1)
+        banned |= repeated.unsqueeze(-1) & (cands == res[:, length - k:length - k + 1])
+    if no_repeated_ngram and length >= no_repeated_ngram:
+        windows = res.unfold(1, no_repeated_ngram, 1) # batch * window_num * n
+        same_prefix = (windows[:, :, :-1] == res[:, length - no_repeated_ngram + 1:].unsqueeze(1)).all(dim=-1)
+        banned |= (same_prefix.unsqueeze(-1) & (windows[:, :, -1:] == cands.unsqueeze(1))).any(dim=1)
+    return banned
+
+def dedup_path_tokens(path_tokens: Tensor, path_length: Tensor, pad: int, keep_last: bool = False) -> Tensor:
+    # remove padding and consecutive repeated tokens along the decoded paths
+    # (the first token is always kept, or the last one if the path was decoded backward)
+    pos = torch.arange(path_tokens.size(1), device=path_tokens.device)
+    keep = (path_tokens != pad) & (pos < path_length.unsqueeze(-1))
+    if keep_last:
+        keep[:, :-1] &= path_tokens[:, :-1] != path_tokens[:, 1:]
+        keep |= pos == (path_length - 1).unsqueeze(-1)
+    else:
+        keep[:, 1:] &= path_tokens[:, 1:] != path_tokens[:, :-1]
+        keep[:, 0] = True
+    return compact_tokens(path_tokens, keep, pad)
+
+def repeated_path_mask(entries: Tensor, valid: Tensor, hashes: Tensor, back: Tensor, cand_tokens: Tensor,
+                       entry_num: int, num_best: int) -> Tensor:
+    # entries: batch * pool, flat indices (node * entry_num + slot) of k-best entries, best first
+    # hashes, back: batch * (prelen * entry_num), the rolling hash and the flat index of the previous entry of each entry
+    # cand_tokens: batch * (prelen * top_cand_n), where the entry of flat index e emits cand_tokens[e // num_best]
+    # returns the mask of the valid entries repeating the token sequence of an earlier valid entry. Entries with equal
+    # hashes are compared exactly by walking back both paths until they meet in a node (which holds distinct
+    # sequences, so they are equal iff they are the same entry) or their tokens differ.
+    pos = torch.arange(entries.size(1), device=entries.device).expand_as(entries)
+    keys = torch.where(valid, hashes.gather(-1, entries).long(), -1 - pos)
+    key_sorted, key_order = keys.sort(dim=-1, stable=True)
+    group = torch.ones_like(key_order)
+    group[:, 1:] = key_sorted[:, 1:] != key_sorted[:, :-1]
+    group = group.cumsum(dim=-1)
+
+    # the pairs of equal hashes; groups are contiguous, so no pair at distance d means none further apart
+    pair_batch, pair_later, pair_earlier = [], [], []
+    for d in range(1, entries.size(1)):
+        batch_idx, idx = (group[:, d:] == group[:, :-d]).nonzero(as_tuple=True)
+        if batch_idx.numel() == 0:
+            break
+        pair_batch.append(batch_idx)
+        pair_later.append(key_order[batch_idx, idx + d])
+        pair_earlier.append(key_order[batch_idx, idx])
+    repeated = torch.zeros_like(valid)
+    if not pair_batch:
+        return repeated
+    pair_batch, pair_later = torch.cat(pair_batch), torch.cat(pair_later)
+    x, y = entries[pair_batch, pair_later], entries[pair_batch, torch.cat(pair_earlier)]
+
+    # walk back the undecided pairs in lock-step
+    pair = torch.arange(pair_batch.numel(), device=entries.device)
+    while pair.numel() > 0:
+        b = pair_batch[pair]
+        x_node, y_node = torch.div(x, entry_num, rounding_mode="floor"), torch.div(y, entry_num, rounding_mode="floor")
+        met = x_node == y_node
+        same = met & (x == y)
+        repeated[b[same], pair_later[pair[same]]] = True
+        step = ~met & (x_node != 0) & (y_node != 0) & \
+            (cand_tokens[b, torch.div(x, num_best, rounding_mode="floor")] == cand_tokens[b, torch.div(y, num_best, rounding_mode="floor")])
+        pair, b, x, y = pair[step], b[step], x[step], y[step]
+        x, y = back[b, x].long(), back[b, y].long()
+    return repeated
+
 # Due to the use of multi-processing, beamsearch functions are in global scope
 def init_beam_search(*args):
     import dag_search
@@ -282,7 +364,7 @@ class GlatDecomposedLink(FairseqNATModel):
                         "If --upsample-scale used in training is a fixed number, this parameter should be the same value."
                         "If --upsample-scale used in training is a range, this parameter can be the average of the range, or tuned on the validation set.")
             parser.add_argument('--decode-strategy', type=str, default="lookahead",
-                        help='Decoding strategy to use. Options include "greedy", "lookahead", "viterbi", "jointviterbi", "sample", and "beamsearch".')
+                        help='Decoding strategy to use. Options include "greedy", "lookahead", "viterbi", "jointviterbi", "sample", "kbest", and "beamsearch".')
 
             parser.add_argument('--decode-no-consecutive-repeated-ngram', type=int, default=0,
                         help="Prevent consecutive repeated k-grams (k <= n) in the generated text. Use 0 to disable this feature. This argument is used in greedy, lookahead, sample, and beam search decoding methods.")
@@ -290,7 +372,7 @@ class GlatDecomposedLink(FairseqNATModel):
                         help="Prevent repeated k-grams (not necessarily consecutive) with order n or higher in the generated text. Use 0 to disable this feature. "
                                 "This argument is used in lookahead, sample, and beam search decoding methods.")
             parser.add_argument('--decode-top-cand-n', type=float, default=5,
-                        help='Number of top candidates to consider during transition. This argument is used in lookahead decoding with n-gram prevention, and sample and beamsearch decoding methods.')
+                        help='Number of top candidates to consider during transition. This argument is used in lookahead decoding with n-gram prevention, and sample, kbest and beamsearch decoding methods.')
             parser.add_argument('--decode-top-p', type=float, default=0.9,
                         help="Maximum probability of top candidates to consider during transition. This argument is used in lookahead decoding with n-gram prevention, and sample and beamsearch decoding methods.")
             parser.add_argument('--decode-viterbibeta', type=float, default=1,
@@ -317,7 +399,7 @@ class GlatDecomposedLink(FairseqNATModel):
             parser.add_argument('--decode-threads-per-worker', type=int, default=4, help="Number of threads per worker to use during beamsearch decoding. "
                                     "This setting also applies to both vanilla decoding and overlapped decoding. A value between 2 and 8 is typically optimal.")
             parser.add_argument('--decode-dedup', type=bool, default=False, help="Enable token deduplication in BeamSearch.")
-            parser.add_argument('--decode-final-beamsize', type=int, default=1, help="Output multiple top beams")
+            parser.add_argument('--decode-final-beamsize', type=int, default=1, help="Output multiple top beams. In sample decoding, the number of samples drawn for each input (duplicates are dropped); in kbest decoding, the number of k-best sequences")
         except:
             pass
 
@@ -654,131 +736,123 @@ class GlatDecomposedLink(FairseqNATModel):
         idx1 = torch.arange(batch_size, device=links.device).unsqueeze(-1).unsqueeze(-1).expand(*nextstep_idx.shape)
         logits_idx = top_logits_idx[idx1, nextstep_idx, logits_idx_idx] # batch * prelen * top_cand_n
 
-        dagscores = dagscores.exp().cpu().numpy()
-        nextstep_idx = nextstep_idx.int().cpu().numpy()
-        logits_idx = logits_idx.int().cpu().numpy()
-        output_length_cpu = output_length.int().cpu().numpy()
-
-        output_tokens = []
-        for i, length in enumerate(output_length_cpu):
-            j = 0
-            res = [top_logits_idx[i][0][0]]
-            banned_ngram = set()
-            while j != length - 1:
-                temp_banned_token = set()
-                if res:
-                    temp_banned_token.add(res[-1])
-                for k in range(2, min(self.args.decode_no_consecutive_repeated_ngram, (len(res) + 1) // 2)+1, 1):
-                    if all([res[-l] == res[-k-l] for l in range(1, k, 1)]):
-                        temp_banned_token.add(res[-k])
-                prob = 0
-                for k, cand in enumerate(logits_idx[i, j]):
-                    if cand not in temp_banned_token and (tuple(res[-self.args.decode_no_repeated_ngram+1:]) + (cand, )) not in banned_ngram:
-                        break
-                    prob += dagscores[i, j, k]
-                    if prob > self.args.decode_top_p:
-                        k, cand = 0, logits_idx[i, j, 0]
-                        break
-                else:
-                    k, cand = 0, logits_idx[i, j, 0]
-                j = nextstep_idx[i, j, k]
-                res.append(cand)
-                if self.args.decode_no_repeated_ngram and len(res) >= self.args.decode_no_repeated_ngram:
-                    banned_ngram.add(tuple(res[-self.args.decode_no_repeated_ngram:]))
-            output_tokens.append(res)
-
-        output_seqlen = max([len(res) for res in output_tokens])
-        output_tokens = [res + [self.tgt_dict.pad_index] * (output_seqlen - len(res)) for res in output_tokens]
-        output_tokens = torch.tensor(output_tokens)
-        output_scores = torch.full(output_tokens.size(), 1.0)
+        # probability mass of the first k candidates
+        cum_probs = dagscores.exp().cumsum(dim=-1) # batch * prelen * top_cand_n
+
+        # all sentences walk the graph in lock-step, so every unfinished sentence has step + 1 tokens;
+        # a finished sentence stays at its last node and is padded
+        batch_idx = torch.arange(batch_size, device=links.device)
+        max_steps = int(output_length.max()) - 1
+        output_tokens = torch.full((batch_size, max_steps + 1), self.tgt_dict.pad_index, dtype=torch.long, device=links.device)
+        output_tokens[:, 0] = top_logits_idx[:, 0, 0]
+        j = torch.zeros(batch_size, dtype=torch.long, device=links.device)
+        seqlen = 1
+        for step in range(max_steps):
+            active = j != output_length - 1
+            if not active.any():
+                break
+            cands = logits_idx[batch_idx, j] # batch * top_cand_n
+            banned = repeated_ngram_mask(output_tokens[:, :step + 1], cands,
+                self.args.decode_no_consecutive_repeated_ngram, self.args.decode_no_repeated_ngram)
+
+            # take the first allowed candidate, unless the banned ones before it exceed top_p
+            allowed = ~banned
+            first = allowed.int().argmax(dim=-1)
+            banned_prob = cum_probs[batch_idx, j].gather(-1, (first - 1).clamp(min=0).unsqueeze(-1)).squeeze(-1)
+            k = first.masked_fill(~allowed.any(dim=-1) | ((first > 0) & (banned_prob > self.args.decode_top_p)), 0).unsqueeze(-1)
+
+            output_tokens[:, step + 1] = cands.gather(-1, k).squeeze(-1).masked_fill(~active, self.tgt_dict.pad_index)
+            j = torch.where(active, nextstep_idx[batch_idx, j].gather(-1, k).squeeze(-1), j)
+            seqlen = step + 2
+
+        output_tokens = output_tokens[:, :seqlen]
+        output_scores = torch.full(output_tokens.size(), 1.0, device=output_tokens.device)
         return output_tokens, output_scores
 
     def inference_lookahead_simple(self, links, output_logits_normalized, output_length):
         unreduced_logits, unreduced_tokens = output_logits_normalized.max(dim=-1)
-        unreduced_tokens = unreduced_tokens.tolist()
 
-        output_length = output_length.cpu().tolist()
         if self.args.decode_strategy == "lookahead":
-            links_idx = (links + unreduced_logits.unsqueeze(1) * self.args.decode_beta).max(dim=-1)[1].cpu().tolist() # batch * prelen
+            links_idx = (links + unreduced_logits.unsqueeze(1) * self.args.decode_beta).max(dim=-1)[1] # batch * prelen
         elif self.args.decode_strategy == "greedy":
-            links_idx = links.max(dim=-1)[1].cpu().tolist() # batch * prelen
-
-        unpad_output_tokens = []
-        for i, length in enumerate(output_length):
-            last = unreduced_tokens[i][0]
-            j = 0
-            res = [last]
-            while j != length - 1:
-                j = links_idx[i][j]
-                now_token = unreduced_tokens[i][j]
-                if now_token != self.tgt_dict.pad_index and now_token != last:
-                    res.append(now_token)
-                last = now_token
-            unpad_output_tokens.append(res)
-
-        output_seqlen = max([len(res) for res in unpad_output_tokens])
-        output_tokens = [res + [self.tgt_dict.pad_index] * (output_seqlen - len(res)) for res in unpad_output_tokens]
-        output_tokens = torch.tensor(output_tokens)
-        output_scores = torch.full(output_tokens.size(), 1.0)
+            links_idx = links.max(dim=-1)[1] # batch * prelen
+
+        # follow the links from node 0 by pointer doubling: after round r, on_path marks the first 2^r nodes of the path
+        # and jump points 2^r links ahead; node length - 1 ends the path and links to itself
+        batch_size, prelen, _ = links.shape
+        node_idx = torch.arange(prelen, device=links.device).unsqueeze(0)
+        jump = torch.where(node_idx < (output_length - 1).unsqueeze(-1), links_idx, node_idx)
+        on_path = (node_idx == 0).expand(batch_size, -1)
+        for _ in range((prelen - 1).bit_length()):
+            reached = on_path.new_zeros(batch_size, prelen + 1).scatter_(1, jump.masked_fill(~on_path, prelen), True)
+            on_path = on_path | reached[:, :prelen]
+            jump = jump.gather(1, jump)
+
+        # links go forward, so the path visits its nodes in increasing order
+        path_tokens = compact_tokens(unreduced_tokens, on_path, self.tgt_dict.pad_index)
+        output_tokens = dedup_path_tokens(path_tokens, on_path.sum(dim=-1), self.tgt_dict.pad_index)
+        output_scores = torch.full(output_tokens.size(), 1.0, device=output_tokens.device)
         return output_tokens, output_scores
 
     def inference_viterbi(self, links, output_logits_normalized, output_length):
         unreduced_logits, unreduced_tokens = output_logits_normalized.max(dim=-1)
-        unreduced_tokens = unreduced_tokens.tolist()
-
-        scores = []
-        indexs = []
-        # batch * graph_length
-        alpha_t = links[:,0]
-        if self.args.decode_strategy == "jointviterbi":
-            alpha_t += unreduced_logits[:,0].unsqueeze(1)
         batch_size, graph_length, _ = links.size()
-        alpha_t += unreduced_logits
-        scores.append(alpha_t)
+        jointviterbi = self.args.decode_strategy == "jointviterbi"
 
         # the exact max_length should be graph_length - 2, but we can reduce it to an appropriate extent to speedup decoding
         max_length = int(2 * graph_length / self.args.decode_upsample_scale)
+        length_penalty = (torch.arange(max_length, device=links.device) + 1) ** self.args.decode_viterbibeta
+
+        # batch * graph_length
+        link_last = torch.gather(links, -1, (output_length - 1).view(batch_size, 1, 1).repeat(1, graph_length, 1)).view(batch_size, graph_length)
+        alpha_t = links[:,0]
+        if jointviterbi:
+            alpha_t = alpha_t + unreduced_logits[:,0].unsqueeze(1)
+        alpha_t = alpha_t + unreduced_logits
+        scores = [alpha_t + link_last]
+        indexs = []
+
+        # for stopping early: one more step adds at most hop_gain to a path score, and the last link at most last_gain
+        hop_gain = (links + unreduced_logits.unsqueeze(1) if jointviterbi else links).flatten(1).max(dim=-1)[0].float()
+        last_gain = link_last.max(dim=-1)[0].float()
+        best_score = (scores[0] / length_penalty[:1]).max(dim=-1)[0]
+        hops = torch.arange(1, max_length, device=links.device)
+        # the check syncs with the host, so it only runs every few steps
+        stop_check_interval = 8
         for i in range(max_length - 1):
             alpha_t, index = torch.max(alpha_t.unsqueeze(-1) + links, dim = 1)
-            if self.args.decode_strategy == "jointviterbi":
-                alpha_t += unreduced_logits
-            scores.append(alpha_t)
+            if jointviterbi:
+                alpha_t = alpha_t + unreduced_logits
+            scores.append(alpha_t + link_last)
             indexs.append(index)
 
-        # max_length * batch * graph_length
-        indexs = torch.stack(indexs, dim = 0)
-        scores = torch.stack(scores, dim = 0)
-        link_last = torch.gather(links, -1, (output_length - 1).view(batch_size, 1, 1).repeat(1, graph_length, 1)).view(1, batch_size, graph_length)
-        scores += link_last
-
-        # max_length * batch
-        scores, max_idx = torch.max(scores, dim = -1)
-        lengths = torch.arange(max_length).unsqueeze(-1).repeat(1, batch_size) + 1
-        length_penalty = (lengths ** self.args.decode_viterbibeta).cuda(scores.get_device())
-        scores = scores / length_penalty
+            # stop once no longer path can beat the best length-normalized score of any sentence
+            best_score = torch.max(best_score, (scores[-1] / length_penalty[i + 1:i + 2]).max(dim=-1)[0])
+            if i + 2 < max_length and (i + 1) % stop_check_interval == 0:
+                bound = ((alpha_t.max(dim=-1)[0].float() + last_gain).unsqueeze(-1) + hops[:max_length - i - 2] * hop_gain.unsqueeze(-1)) / length_penalty[i + 2:]
+                bound = bound.max(dim=-1)[0]
+                bound = bound + (bound.abs() * 1e-3).nan_to_num(posinf=0) # tolerance for rounding
+                if (best_score >= bound).all():
+                    break
+
+        # steps * batch
+        scores, max_idx = torch.max(torch.stack(scores, dim = 0), dim = -1)
+        steps = scores.size(0)
+        scores = scores / length_penalty[:steps].unsqueeze(-1)
         max_score, pred_length = torch.max(scores, dim = 0)
         pred_length = pred_length + 1
 
-        initial_idx = torch.gather(max_idx, 0, (pred_length - 1).view(1, batch_size)).view(batch_size).tolist()
-        unpad_output_tokens = []
-        indexs = indexs.tolist()
-        pred_length = pred_length.tolist()
-        for i, length in enumerate(pred_length):
-            j = initial_idx[i]
-            last = unreduced_tokens[i][j]
-            res = [last]
-            for k in range(length - 1):
-                j = indexs[length - k - 2][i][j]
-                now_token = unreduced_tokens[i][j]
-                if now_token != self.tgt_dict.pad_index and now_token != last:
-                    res.insert(0, now_token)
-                last = now_token
-            unpad_output_tokens.append(res)
-
-        output_seqlen = max([len(res) for res in unpad_output_tokens])
-        output_tokens = [res + [self.tgt_dict.pad_index] * (output_seqlen - len(res)) for res in unpad_output_tokens]
-        output_tokens = torch.tensor(output_tokens)
-        output_scores = torch.full(output_tokens.size(), 1.0)
+        # backtrace all sentences at once; positions past the length of a sentence are ignored
+        initial_idx = torch.gather(max_idx, 0, (pred_length - 1).view(1, batch_size)).view(batch_size)
+        j = initial_idx
+        path_nodes = [j]
+        for k in range(steps - 2, -1, -1):
+            j = torch.where(k < pred_length - 1, indexs[k].gather(-1, j.unsqueeze(-1)).squeeze(-1), initial_idx)
+            path_nodes.append(j)
+        path_nodes = torch.stack(path_nodes[::-1], dim=-1) # batch * steps
+
+        output_tokens = dedup_path_tokens(unreduced_tokens.gather(-1, path_nodes), pred_length, self.tgt_dict.pad_index, keep_last=True)
+        output_scores = torch.full(output_tokens.size(), 1.0, device=output_tokens.device)
         return output_tokens, output_scores
 
     def inference_sample(self, links, output_logits_normalized, output_length):
@@ -793,52 +867,192 @@ class GlatDecomposedLink(FairseqNATModel):
         idx1 = torch.arange(batch_size, device=links.device).unsqueeze(-1).unsqueeze(-1).expand(*nextstep_idx.shape)
         logits_idx = top_logits_idx[idx1, nextstep_idx, logits_idx_idx] # batch * prelen * top_cand_n
 
-        dagscores = dagscores.exp().cpu().numpy()
-        nextstep_idx = nextstep_idx.int().cpu().numpy()
-        logits_idx = logits_idx.int().cpu().numpy()
-        output_length_cpu = output_length.int().cpu().numpy()
-
-        output_tokens = []
-        for i, length in enumerate(output_length_cpu):
-            j = 0
-            res = []
-            banned_ngram = set()
-
-            while j != length - 1:
-                temp_banned_token = set()
-                if res:
-                    temp_banned_token.add(res[-1])
-                for k in range(2, min(self.args.decode_no_consecutive_repeated_ngram, (len(res) + 1) // 2)+1, 1):
-                    if all([res[-l] == res[-k-l] for l in range(1, k, 1)]):
-                        temp_banned_token.add(res[-k])
-
-                problist = []
-                realprob = 0
-                for k, cand in enumerate(logits_idx[i, j]):
-                    realprob += dagscores[i, j, k]
-                    if cand in temp_banned_token or (tuple(res[-self.args.decode_no_repeated_ngram+1:]) + (cand, )) in banned_ngram:
-                        problist.append(1e-5)
-                    else:
-                        problist.append(dagscores[i, j, k])
-                    if realprob > self.args.decode_top_p:
-                        break
-                problist = np.array(problist)
-                problist /= problist.sum()
-                k = np.random.choice(len(problist), 1, p=problist).item()
-                cand = logits_idx[i, j, k]
-
-                j = nextstep_idx[i, j, k]
-                res.append(cand)
-
-                if self.args.decode_no_repeated_ngram and len(res) >= self.args.decode_no_repeated_ngram:
-                    banned_ngram.add(tuple(res[-self.args.decode_no_repeated_ngram:]))
-
-            output_tokens.append(res)
-
-        output_seqlen = max([len(res) for res in output_tokens])
-        output_tokens = [res + [self.tgt_dict.pad_index] * (output_seqlen - len(res)) for res in output_tokens]
-        output_tokens = torch.tensor(output_tokens)
-        output_scores = torch.full(output_tokens.size(), 1.0)
+        # sampling weights: the candidates up to the one crossing top_p
+        probs = dagscores.float().exp()
+        cum_probs = probs.cumsum(dim=-1)
+        in_top_p = torch.cat([torch.ones_like(cum_probs[..., :1], dtype=torch.bool), cum_probs[..., :-1] <= self.args.decode_top_p], dim=-1)
+
+        # decode_final_beamsize samples per sentence, all walking the graph in lock-step
+        num_samples = vars(self.args).get("decode_final_beamsize", 1)
+        sample_num = batch_size * num_samples
+        src_idx = torch.arange(batch_size, device=links.device).repeat_interleave(num_samples)
+        sample_length = output_length[src_idx]
+        max_steps = int(output_length.max()) - 1
+        output_tokens = torch.full((sample_num, max_steps), self.tgt_dict.pad_index, dtype=torch.long, device=links.device)
+        output_scores = torch.zeros(sample_num, max_steps, device=links.device)
+        j = torch.zeros(sample_num, dtype=torch.long, device=links.device)
+        seqlen = 0
+        for step in range(max_steps):
+            active = j != sample_length - 1
+            if not active.any():
+                break
+            cands = logits_idx[src_idx, j] # sample_num * top_cand_n
+            banned = repeated_ngram_mask(output_tokens[:, :step], cands,
+                self.args.decode_no_consecutive_repeated_ngram, self.args.decode_no_repeated_ngram)
+            weights = probs[src_idx, j].masked_fill(banned, 1e-5).log().masked_fill(~in_top_p[src_idx, j], float("-inf"))
+
+            # Gumbel-max: the argmax of the log weights plus Gumbel noise samples from the normalized weights
+            gumbel = -torch.empty_like(weights).exponential_().log()
+            k = (weights + gumbel).argmax(dim=-1, keepdim=True)
+
+            output_tokens[:, step] = cands.gather(-1, k).squeeze(-1).masked_fill(~active, self.tgt_dict.pad_index)
+            output_scores[:, step] = dagscores[src_idx, j].gather(-1, k).squeeze(-1).float().masked_fill(~active, 0)
+            j = torch.where(active, nextstep_idx[src_idx, j].gather(-1, k).squeeze(-1), j)
+            seqlen = step + 1
+
+        output_tokens = output_tokens[:, :seqlen]
+        output_scores = output_scores[:, :seqlen]
+        if num_samples == 1:
+            return output_tokens, output_scores
+
+        # n-best list of each sentence, ordered by the mean token score (the hypothesis score in finish_hypo)
+        nonpad = output_tokens.ne(self.tgt_dict.pad_index)
+        mean_scores = (output_scores * nonpad).sum(dim=-1) / nonpad.sum(dim=-1).clamp(min=1)
+        order = mean_scores.view(batch_size, num_samples).argsort(dim=-1, descending=True)
+        order = (order + torch.arange(batch_size, device=links.device).unsqueeze(-1) * num_samples).flatten() # sample_num
+        output_tokens, output_scores = output_tokens[order], output_scores[order]
+
+        # a sequence sampled several times is kept once, with its best score
+        _, seq_id = torch.unique(torch.cat([src_idx.unsqueeze(-1), output_tokens], dim=-1), dim=0, return_inverse=True)
+        # the stable sort puts the first occurrence of every sequence ahead of its repeats
+        seq_id_sorted, seq_order = seq_id.sort(stable=True)
+        first_sorted = torch.ones_like(seq_id_sorted, dtype=torch.bool)
+        first_sorted[1:] = seq_id_sorted[1:] != seq_id_sorted[:-1]
+        keep = torch.empty_like(first_sorted)
+        keep[seq_order] = first_sorted
+        keep = keep.view(batch_size, num_samples)
+        rank = keep.cumsum(dim=-1) - 1
+        nbest = int(rank[:, -1].max()) + 1
+
+        # rows past the distinct samples of a sentence are padding (skipped by finish_hypo)
+        dedup_tokens = output_tokens.new_full((batch_size, nbest, seqlen), self.tgt_dict.pad_index)
+        dedup_scores = output_scores.new_zeros(batch_size, nbest, seqlen)
+        batch_idx, sample_idx = keep.nonzero(as_tuple=True)
+        dedup_tokens[batch_idx, rank[batch_idx, sample_idx]] = output_tokens.view(batch_size, num_samples, seqlen)[batch_idx, sample_idx]
+        dedup_scores[batch_idx, rank[batch_idx, sample_idx]] = output_scores.view(batch_size, num_samples, seqlen)[batch_idx, sample_idx]
+        return dedup_tokens, dedup_scores
+
+    def inference_kbest(self, links, output_logits_normalized, output_length):
+        """
+        The decode_final_beamsize best distinct token sequences over the lattice of links and top candidate tokens,
+        with exact path scores: sum of links and decode_beta * token scores, as in lookahead and beamsearch.
+        As in lookahead, a node only links to its decode_top_cand_n most likely successors (and to the last node).
+        Node 0 and the last node emit their best token, and a token never repeats the previous one. Every
+        (node, candidate token) keeps its k best distinct sequences, which extend alike; sequences reaching a node
+        from several predecessors are told apart exactly (see repeated_path_mask), so the k-best list is exact on
+        this lattice.
+
+        Cost, with n = decode_top_cand_n and k = decode_final_beamsize: the pools of all nodes (the entries of their
+        predecessors) hold at most (n + 1) * prelen * n * k entries, and each node picks its n * k entries from the
+        4 * n * k best of its pool, O(n * n * k) (from the whole pool when those hold fewer than k distinct sequences
+        for some candidate token). Pairs of pool entries with equal hashes are walked back until their paths meet.
+        Memory: three batch * prelen * n * k tensors of 4-byte scores, hashes and back pointers, and the
+        batch * prelen * prelen mask of the predecessors.
+        """
+        batch_size, prelen, _ = links.shape
+        num_best = vars(self.args).get("decode_final_beamsize", 1)
+        pad = self.tgt_dict.pad_index
+        device = links.device
+        batch_idx = torch.arange(batch_size, device=device).unsqueeze(-1)
+
+        top_logits, top_logits_idx = output_logits_normalized.topk(self.args.decode_top_cand_n, dim=-1) # batch * prelen * top_cand_n
+        top_cand_n = top_logits_idx.size(-1)
+        token_scores = (top_logits * self.args.decode_beta).float()
+        token_scores.masked_fill_(top_logits_idx == pad, float("-inf"))
+        last_node = output_length - 1
+        token_scores[:, :, 1:].masked_fill_((torch.arange(prelen, device=device) == last_node.unsqueeze(-1)).unsqueeze(-1), float("-inf"))
+        cand_tokens = top_logits_idx.flatten(1)
+
+        # the predecessors of each node: u precedes v if v is among the top_cand_n successors of u or is the last node
+        succ_links, succ = links.topk(min(top_cand_n, prelen), dim=-1) # batch * prelen * top_cand_n
+        is_pred = torch.zeros_like(links, dtype=torch.bool).scatter_(-1, succ, succ_links > float("-inf"))
+        is_pred[batch_idx.squeeze(-1), :, last_node] = links[batch_idx.squeeze(-1), :, last_node] > float("-inf")
+        is_pred = is_pred.triu_(1).transpose(1, 2).contiguous() # batch * prelen (node) * prelen (predecessor)
+        num_pred = is_pred.sum(dim=-1)
+
+        # entries of a node (top_cand_n * num_best, the k best for each candidate token): score, a 31-bit hash of the
+        # token sequence and the flat index of the previous entry; entry e of a node emits its candidate e // num_best
+        entry_num = top_cand_n * num_best
+        hash_mod, hash_base = 2147483647, 1000003
+        scores = torch.full((batch_size, prelen, entry_num), float("-inf"), device=device)
+        hashes = torch.zeros(batch_size, prelen, entry_num, dtype=torch.int32, device=device)
+        back = torch.zeros(batch_size, prelen, entry_num, dtype=torch.int32, device=device)
+        scores[:, 0, 0] = 0
+        hashes[:, 0, 0] = top_logits_idx[:, 0, 0] + 1
+        entry_range = torch.arange(entry_num, device=device)
+
+        for v in range(1, int(output_length.max())):
+            pred_num = int(num_pred[:, v].max())
+            if pred_num == 0:
+                continue
+            pred_valid, pred = is_pred[:, v, :v].float().topk(pred_num, dim=-1) # batch * pred_num
+            pred_links = links[batch_idx, pred, v].float().masked_fill(pred_valid == 0, float("-inf"))
+            all_scores = (scores[batch_idx, pred] + pred_links.unsqueeze(-1)).flatten(1) # batch * (pred_num * entry_num)
+            all_entries = (pred.unsqueeze(-1) * entry_num + entry_range).flatten(1)
+            cand_token = top_logits_idx[:, v] # batch * top_cand_n
+            cand_token_scores = token_scores[:, v]
+
+            # search the best entries of the pool first; the whole pool is only needed
+            # when they hold fewer than k distinct sequences for some candidate token
+            for pool_size in (min(4 * entry_num, all_scores.size(-1)), all_scores.size(-1)):
+                pool_scores, pool_idx = all_scores.topk(pool_size, dim=-1)
+                pool_min = pool_scores[:, -1:]
+                pool_entries = all_entries.gather(-1, pool_idx)
+
+                # a sequence reaching v from several predecessors keeps its best path only
+                repeated = repeated_path_mask(pool_entries, pool_scores > float("-inf"), hashes.flatten(1), back.flatten(1),
+                    cand_tokens, entry_num, num_best)
+                pool_scores = pool_scores.masked_fill(repeated, float("-inf"))
+
+                # the k best for each candidate token of v
+                cand_scores = pool_scores.unsqueeze(1) + cand_token_scores.unsqueeze(-1) # batch * top_cand_n * pool_size
+                pool_tokens = cand_tokens.gather(-1, torch.div(pool_entries, num_best, rounding_mode="floor"))
+                cand_scores.masked_fill_(pool_tokens.unsqueeze(1) == cand_token.unsqueeze(-1), float("-inf"))
+                best_scores, prev = cand_scores.topk(min(num_best, pool_size), dim=-1)
+                if pool_size == all_scores.size(-1):
+                    break
+                settled = (best_scores[:, :, -1] - cand_token_scores >= pool_min) | (pool_min == float("-inf")) | (cand_token_scores == float("-inf"))
+                if settled.all():
+                    break
+            prev = pool_entries.gather(-1, prev.flatten(1)).view_as(prev)
+
+            # entries of candidate token c take the slots c * num_best onwards
+            best_num = prev.size(-1)
+            slots = (torch.arange(top_cand_n, device=device).unsqueeze(-1) * num_best + torch.arange(best_num, device=device)).flatten()
+            new_tokens = cand_token.unsqueeze(-1).expand_as(prev).flatten(1)
+            prev = prev.flatten(1)
+            scores[:, v, slots] = best_scores.flatten(1)
+            hashes[:, v, slots] = ((hashes.flatten(1).gather(-1, prev).long() * hash_base + new_tokens + 1) % hash_mod).int()
+            back[:, v, slots] = prev.int()
+
+        # the k best of the last node
+        final_scores, rank = scores[batch_idx.squeeze(-1), last_node].topk(num_best, dim=-1)
+        node = last_node.unsqueeze(-1).expand(-1, num_best)
+
+        # backtrace; step scores are the differences of the prefix scores
+        active = final_scores > float("-inf")
+        seqlen = torch.zeros(batch_size, num_best, dtype=torch.long, device=device)
+        reversed_tokens, reversed_scores = [], []
+        while active.any():
+            prefix_score = scores[batch_idx, node, rank]
+            flat = back[batch_idx, node, rank].long()
+            prev_node, prev_rank = torch.div(flat, entry_num, rounding_mode="floor"), flat % entry_num
+            step_score = (prefix_score - scores[batch_idx, prev_node, prev_rank]).masked_fill(node == 0, 0)
+            reversed_tokens.append(top_logits_idx[batch_idx, node, torch.div(rank, num_best, rounding_mode="floor")].masked_fill(~active, pad))
+            reversed_scores.append(step_score.masked_fill(~active, 0))
+            seqlen += active
+            active = active & (node != 0)
+            node, rank = prev_node, prev_rank
+
+        if not reversed_tokens:
+            reversed_tokens.append(torch.full((batch_size, num_best), pad, dtype=torch.long, device=device))
+            reversed_scores.append(torch.zeros(batch_size, num_best, device=device))
+        pos = torch.arange(len(reversed_tokens), device=device)
+        reverse_idx = (seqlen.unsqueeze(-1) - 1 - pos).clamp(min=0)
+        output_tokens = torch.stack(reversed_tokens, dim=-1).gather(-1, reverse_idx).masked_fill(pos >= seqlen.unsqueeze(-1), pad)
+        output_scores = torch.stack(reversed_scores, dim=-1).gather(-1, reverse_idx).masked_fill(pos >= seqlen.unsqueeze(-1), 0)
+        if num_best == 1:
+            return output_tokens.squeeze(1), output_scores.squeeze(1)
         return output_tokens, output_scores
 
     def inference_beamsearch(self, links, output_logits_normalized, output_length):
@@ -916,6 +1130,8 @@ class GlatDecomposedLink(FairseqNATModel):
             inference_result = self.inference_viterbi(links, output_logits_normalized, output_length)
         elif self.args.decode_strategy == "sample":
             inference_result = self.inference_sample(links, output_logits_normalized, output_length)
+        elif self.args.decode_strategy == "kbest":
+            inference_result = self.inference_kbest(links, output_logits_normalized, output_length)
         elif self.args.decode_strategy == "beamsearch":
             inference_result = self.inference_beamsearch(links, output_logits_normalized, output_length)
 
@@ -296,7 +296,7 @@ class TranslationDATConfig(FairseqDataclass):
     )
     decode_strategy: str = field(
         default="lookahead",
-        metadata={"help": 'Decoding strategy to use. Options include "greedy", "lookahead", "viterbi", "jointviterbi", "sample", and "beamsearch".'}
+        metadata={"help": 'Decoding strategy to use. Options include "greedy", "lookahead", "viterbi", "jointviterbi", "sample", "kbest", and "beamsearch".'}
     )
 
     decode_no_consecutive_repeated_ngram: int = field(
@@ -311,7 +311,7 @@ class TranslationDATConfig(FairseqDataclass):
     )
     decode_top_cand_n: int = field(
         default=5, metadata={
-            "help": "Number of top candidates to consider during transition. This argument is used in greedy and lookahead decoding with ngram prevention, and sample and beamsearch decoding methods."
+            "help": "Number of top candidates to consider during transition. This argument is used in greedy and lookahead decoding with ngram prevention, and sample, kbest and beamsearch decoding methods."
         }
     )
     decode_top_p: float = field(
@@ -368,7 +368,7 @@ class TranslationDATConfig(FairseqDataclass):
         default=False, metadata={"help": "Enable token deduplication in BeamSearch."}
     )
     decode_final_beamsize: int = field(
-        default=1, metadata={"help": "Output multiple top beams."}
+        default=1, metadata={"help": "Output multiple top beams. In sample decoding, the number of samples drawn for each input (duplicates are dropped); in kbest decoding, the number of k-best sequences."}
     )
     max_encoder_batch_tokens: Optional[int] = field(
         default=None,
@@ -138,7 +138,10 @@ def finish_hypo(decoder_out, sent_idxs, pad, bsz, step=0):
             }
 
     for i in range(finalized_idxs.size(0)):
-        for _finalized_tokens, _finalized_scores in zip(finalized_tokens[i], finalized_scores[i]):
+        for rank, (_finalized_tokens, _finalized_scores) in enumerate(zip(finalized_tokens[i], finalized_scores[i])):
+            # n-best lists shorter than the others are padded with empty rows
+            if rank > 0 and not _finalized_tokens.ne(pad).any():
+                continue
             finalized[finalized_idxs[i]].append(
                 finalized_hypos(
                     step,
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# fs_plugins is imported from the repository root, as with --user-dir fs_plugins
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,286 @@
+import itertools
+import random
+import types
+
+import pytest
+import torch
+
+try:
+    import fairseq
+except (ImportError, OSError):  # fairseq/version.txt is written by pip install -e .
+    pytest.skip("fairseq is not installed", allow_module_level=True)
+
+from fs_plugins.models.glat_decomposed_with_link import GlatDecomposedLink, repeated_path_mask
+
+PAD = 1
+
+
+def decoder(**args):
+    # the attributes of GlatDecomposedLink read by the inference methods
+    return types.SimpleNamespace(
+        args=types.SimpleNamespace(**args),
+        tgt_dict=types.SimpleNamespace(pad_index=PAD, bos_index=0, eos_index=2),
+    )
+
+
+def random_graph(batch_size, prelen, vocab, seed, jump=None):
+    # links, normalized token scores and output lengths of random graphs; with jump, the links favour jumps of
+    # about that many nodes, as in trained models
+    g = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(2, prelen + 1, (batch_size,), generator=g)
+    lengths[0] = prelen
+    links = torch.randn(batch_size, prelen, prelen, generator=g) * 2
+    node = torch.arange(prelen)
+    if jump is not None:
+        links = links - ((node.view(1, -1) - node.view(-1, 1)).float() - jump).abs() * 2
+    invalid = (node.view(1, -1, 1) >= node.view(1, 1, -1)) | (node.view(1, 1, -1) >= lengths.view(-1, 1, 1))
+    links = links.masked_fill(invalid, float("-inf")).log_softmax(dim=-1)
+    links = links.masked_fill(links.isnan(), float("-inf"))
+    logits = (torch.randn(batch_size, prelen, vocab, generator=g) * 3).log_softmax(dim=-1)
+    return links, logits, lengths
+
+
+def padded(rows):
+    width = max(len(row) for row in rows)
+    return torch.tensor([row + [PAD] * (width - len(row)) for row in rows])
+
+
+def lookahead_repeatprevent_loop(args, links, logits, lengths):
+    # the original decoding, one sentence at a time
+    batch_size, prelen, _ = links.shape
+    top_logits, top_logits_idx = logits.topk(args.decode_top_cand_n, dim=-1)
+    dagscores_arr = links.unsqueeze(-1) + top_logits.unsqueeze(1) * args.decode_beta
+    dagscores, top_cand_idx = dagscores_arr.reshape(batch_size, prelen, -1).topk(args.decode_top_cand_n, dim=-1)
+    nextstep_idx = torch.div(top_cand_idx, args.decode_top_cand_n, rounding_mode="floor")
+    batch_idx = torch.arange(batch_size).view(-1, 1, 1)
+    logits_idx = top_logits_idx[batch_idx, nextstep_idx, top_cand_idx % args.decode_top_cand_n]
+    dagscores, nextstep_idx, logits_idx = dagscores.exp().numpy(), nextstep_idx.tolist(), logits_idx.tolist()
+
+    output_tokens = []
+    for i, length in enumerate(lengths.tolist()):
+        j = 0
+        res = [top_logits_idx[i, 0, 0].item()]
+        banned_ngram = set()
+        while j != length - 1:
+            banned = {res[-1]}
+            for k in range(2, min(args.decode_no_consecutive_repeated_ngram, (len(res) + 1) // 2) + 1):
+                if all(res[-l] == res[-k - l] for l in range(1, k)):
+                    banned.add(res[-k])
+            prob = 0
+            for k, cand in enumerate(logits_idx[i][j]):
+                if cand not in banned and tuple(res[-args.decode_no_repeated_ngram + 1:]) + (cand,) not in banned_ngram:
+                    break
+                prob += dagscores[i, j, k]
+                if prob > args.decode_top_p:
+                    k, cand = 0, logits_idx[i][j][0]
+                    break
+            else:
+                k, cand = 0, logits_idx[i][j][0]
+            j = nextstep_idx[i][j][k]
+            res.append(cand)
+            if args.decode_no_repeated_ngram and len(res) >= args.decode_no_repeated_ngram:
+                banned_ngram.add(tuple(res[-args.decode_no_repeated_ngram:]))
+        output_tokens.append(res)
+    return padded(output_tokens)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_lookahead_repeatprevent_matches_loop(seed):
+    rng = random.Random(seed)
+    model = decoder(
+        decode_strategy="lookahead",
+        decode_top_cand_n=rng.choice([2, 3, 5]),
+        decode_beta=1.0,
+        decode_top_p=rng.choice([0.5, 0.9, 0.99]),
+        decode_no_consecutive_repeated_ngram=rng.choice([0, 2, 3, 4]),
+        decode_no_repeated_ngram=rng.choice([0, 2, 3, 4]),
+    )
+    links, logits, lengths = random_graph(rng.randint(1, 8), rng.randint(2, 30), rng.choice([5, 8, 20]), seed)
+    tokens, _ = GlatDecomposedLink.inference_lookahead_repeatprevent(model, links, logits, lengths)
+    assert torch.equal(tokens, lookahead_repeatprevent_loop(model.args, links, logits, lengths))
+
+
+def lookahead_simple_loop(args, links, logits, lengths):
+    # the original decoding, one sentence at a time
+    unreduced_logits, unreduced_tokens = logits.max(dim=-1)
+    if args.decode_strategy == "lookahead":
+        links_idx = (links + unreduced_logits.unsqueeze(1) * args.decode_beta).max(dim=-1)[1]
+    else:
+        links_idx = links.max(dim=-1)[1]
+    unreduced_tokens, links_idx = unreduced_tokens.tolist(), links_idx.tolist()
+
+    output_tokens = []
+    for i, length in enumerate(lengths.tolist()):
+        last = unreduced_tokens[i][0]
+        j = 0
+        res = [last]
+        while j != length - 1:
+            j = links_idx[i][j]
+            now_token = unreduced_tokens[i][j]
+            if now_token != PAD and now_token != last:
+                res.append(now_token)
+            last = now_token
+        output_tokens.append(res)
+    return padded(output_tokens)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_lookahead_simple_matches_loop(seed):
+    rng = random.Random(seed)
+    model = decoder(decode_strategy=["lookahead", "greedy"][seed % 2], decode_beta=rng.choice([1.0, 0.5]))
+    links, logits, lengths = random_graph(rng.randint(1, 8), rng.randint(2, 50), rng.choice([2, 3, 6, 20]), seed,
+        jump=rng.choice([None, 3]))
+    tokens, _ = GlatDecomposedLink.inference_lookahead_simple(model, links, logits, lengths)
+    assert torch.equal(tokens, lookahead_simple_loop(model.args, links, logits, lengths))
+
+
+def viterbi_full(args, links, logits, lengths):
+    # the original decoding: all max_length steps, then one backtrace per sentence
+    unreduced_logits, unreduced_tokens = logits.max(dim=-1)
+    jointviterbi = args.decode_strategy == "jointviterbi"
+    batch_size, graph_length, _ = links.size()
+    alpha_t = links[:, 0]
+    if jointviterbi:
+        alpha_t = alpha_t + unreduced_logits[:, 0].unsqueeze(1)
+    alpha_t = alpha_t + unreduced_logits
+    scores, indexs = [alpha_t], []
+    max_length = int(2 * graph_length / args.decode_upsample_scale)
+    for _ in range(max_length - 1):
+        alpha_t, index = torch.max(alpha_t.unsqueeze(-1) + links, dim=1)
+        if jointviterbi:
+            alpha_t = alpha_t + unreduced_logits
+        scores.append(alpha_t)
+        indexs.append(index)
+    link_last = links.gather(-1, (lengths - 1).view(batch_size, 1, 1).expand(-1, graph_length, 1)).view(1, batch_size, graph_length)
+    scores, max_idx = (torch.stack(scores) + link_last).max(dim=-1)
+    scores = scores / (torch.arange(1, max_length + 1).unsqueeze(-1) ** args.decode_viterbibeta)
+    pred_length = scores.max(dim=0)[1] + 1
+
+    output_tokens = []
+    for i, length in enumerate(pred_length.tolist()):
+        j = max_idx[length - 1, i].item()
+        last = unreduced_tokens[i, j].item()
+        res = [last]
+        for k in range(length - 1):
+            j = indexs[length - k - 2][i, j].item()
+            now_token = unreduced_tokens[i, j].item()
+            if now_token != PAD and now_token != last:
+                res.insert(0, now_token)
+            last = now_token
+        output_tokens.append(res)
+    return padded(output_tokens)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_viterbi_early_stop_matches_full_search(seed):
+    rng = random.Random(seed)
+    model = decoder(
+        decode_strategy=["viterbi", "jointviterbi"][seed % 2],
+        decode_upsample_scale=rng.choice([1, 2, 4, 8]),
+        decode_viterbibeta=rng.choice([0.0, 0.2, 0.5, 1.0, 1.5]),
+    )
+    links, logits, lengths = random_graph(rng.randint(1, 8), rng.randint(8, 60), rng.choice([2, 3, 6, 20]), seed,
+        jump=rng.choice([None, 2, 4]))
+    tokens, _ = GlatDecomposedLink.inference_viterbi(model, links, logits, lengths)
+    assert torch.equal(tokens, viterbi_full(model.args, links, logits, lengths))
+
+
+def sample_decoder(num_samples, top_cand_n, top_p=0.9):
+    return decoder(
+        decode_strategy="sample",
+        decode_top_cand_n=top_cand_n,
+        decode_beta=1.0,
+        decode_temperature=1.0,
+        decode_top_p=top_p,
+        decode_no_consecutive_repeated_ngram=0,
+        decode_no_repeated_ngram=0,
+        decode_final_beamsize=num_samples,
+    )
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_sample_nbest_is_distinct_and_sorted(seed):
+    rng = random.Random(seed)
+    num_samples = rng.choice([2, 5, 16])
+    model = sample_decoder(num_samples, rng.choice([2, 3]), rng.choice([0.5, 0.9, 1.0]))
+    links, logits, lengths = random_graph(rng.randint(1, 5), rng.randint(2, 12), rng.choice([3, 6]), seed, jump=2)
+    logits[..., PAD] = -50
+    torch.manual_seed(seed)
+    tokens, scores = GlatDecomposedLink.inference_sample(model, links, logits, lengths)
+    assert tokens.size(0) == lengths.size(0) and 1 <= tokens.size(1) <= num_samples
+    for sent_tokens, sent_scores in zip(tokens, scores):
+        nonpad = sent_tokens != PAD
+        # the distinct samples come first, the remaining rows are padding
+        num_rows = int(nonpad.any(dim=-1).sum())
+        assert nonpad[:num_rows].any(dim=-1).all()
+        samples = [tuple(row[mask].tolist()) for row, mask in zip(sent_tokens[:num_rows], nonpad[:num_rows])]
+        assert len(set(samples)) == num_rows
+        mean_scores = (sent_scores * nonpad).sum(dim=-1)[:num_rows] / nonpad.sum(dim=-1)[:num_rows]
+        assert (mean_scores[1:] <= mean_scores[:-1]).all()
+
+
+def test_sample_repeats_are_dropped():
+    # with a single candidate per node, every sample of a sentence takes the same path
+    links, logits, lengths = random_graph(3, 10, 6, 0, jump=2)
+    logits[..., PAD] = -50
+    tokens, _ = GlatDecomposedLink.inference_sample(sample_decoder(8, 1), links, logits, lengths)
+    assert tokens.size(1) == 1
+
+
+def kbest_brute_force(links, logits, length, top_cand_n, beta):
+    # best score of every token sequence on the lattice of inference_kbest, by enumerating its paths: a node links
+    # to its top_cand_n most likely successors and to the last node, node 0 and the last node emit their best token
+    top_logits, top_logits_idx = logits.topk(top_cand_n, dim=-1)
+    succ = links.topk(min(top_cand_n, links.size(-1)), dim=-1)[1].tolist()
+    best = {}
+    for num_inner in range(length - 1):
+        for inner in itertools.combinations(range(1, length - 1), num_inner):
+            path = (0,) + inner + (length - 1,)
+            if any(v != length - 1 and v not in succ[u] for u, v in zip(path, path[1:])):
+                continue
+            link_score = sum(links[u, v].item() for u, v in zip(path, path[1:]))
+            if link_score == float("-inf"):
+                continue
+            for cands in itertools.product([0], *[range(top_cand_n)] * num_inner, [0]):
+                tokens = tuple(top_logits_idx[u, c].item() for u, c in zip(path, cands))
+                if PAD in tokens[1:] or any(a == b for a, b in zip(tokens, tokens[1:])):
+                    continue
+                score = link_score + beta * sum(top_logits[u, c].item() for u, c in zip(path[1:], cands[1:]))
+                best[tokens] = max(best.get(tokens, float("-inf")), score)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_kbest_matches_brute_force(seed):
+    rng = random.Random(seed)
+    top_cand_n, num_best, beta = rng.choice([1, 2, 3]), rng.choice([1, 3, 8, 20]), rng.choice([1.0, 0.5])
+    links, logits, lengths = random_graph(rng.randint(1, 3), rng.randint(2, 7), rng.choice([3, 4, 6]), seed,
+        jump=rng.choice([None, 2]))
+    logits[..., PAD] = -50
+    model = decoder(decode_strategy="kbest", decode_top_cand_n=top_cand_n, decode_beta=beta, decode_final_beamsize=num_best)
+    tokens, scores = GlatDecomposedLink.inference_kbest(model, links, logits, lengths)
+    if num_best == 1:
+        tokens, scores = tokens.unsqueeze(1), scores.unsqueeze(1)
+    for b, length in enumerate(lengths.tolist()):
+        expected = kbest_brute_force(links[b], logits[b], length, top_cand_n, beta)
+        got = {}
+        for row_tokens, row_scores in zip(tokens[b], scores[b]):
+            nonpad = row_tokens != PAD
+            if nonpad.any():
+                got[tuple(row_tokens[nonpad].tolist())] = row_scores[nonpad].sum().item()
+        assert len(got) == int((tokens[b] != PAD).any(dim=-1).sum()) == min(num_best, len(expected))
+        for seq, score in got.items():
+            assert score == pytest.approx(expected[seq], abs=1e-4)
+        best_scores = sorted(expected.values(), reverse=True)[:len(got)]
+        assert sorted(got.values(), reverse=True) == pytest.approx(best_scores, abs=1e-4)
+
+
+def test_repeated_path_mask_ignores_hash_collisions():
+    # two candidates per node, one entry each; every entry has the same hash
+    cand_tokens = torch.tensor([[5, 5, 6, 7, 6, 7]])
+    back = torch.tensor([[0, 0, 0, 0, 0, 2]])
+    hashes = torch.zeros_like(back)
+    # [5, 6] (node 1), [5, 6] (node 2), [5, 7] (node 1) and [5, 6, 7] (node 2)
+    entries = torch.tensor([[2, 4, 3, 5]])
+    repeated = repeated_path_mask(entries, torch.ones_like(entries, dtype=torch.bool), hashes, back, cand_tokens, 2, 1)
+    assert repeated.tolist() == [[False, True, False, False]]
@@ -0,0 +1,86 @@
+# Error detector service
+import os
+import json
+import signal
+import argparse
+import socketserver
+
+from err_utils import BatchedModel, ModelServer
+
+
+"""
+    Shared front end of the PyTorch detector server for all stitcher workers:
+
+        python err_service.py --socket /tmp/err.sock --server localhost:5000
+        python stitch.py -e --err-detector binary --err-server unix:/tmp/err.sock ...
+
+    The workers keep one connection each; concurrent queries of all workers
+    are micro-batched and cached by (error template, line, code lines).
+
+    Protocol (Unix socket, one JSON document per line):
+        request:  {"key": "...", "q": {...}}   (see err_utils.query_key)
+        response: {"pred": ..., "logit": ...} or {"error": "..."}
+"""
+
+
+class DetectorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            try:
+                pred, logit = self.server.model.predict(request['key'], request['q'])
+                response = {'pred': pred, 'logit': logit}
+            except Exception as e:
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+
+class DetectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, model):
+        if os.path.exists(path):
+            os.remove(path)
+        self.model = model
+        super().__init__(path, DetectorHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default='./err.sock',
+                        help='Path of the Unix socket to serve on')
+    parser.add_argument('--server', required=True,
+                        help='Server + Port of the PyTorch detector')
+    parser.add_argument('--batch', action='store_true',
+                        help='The PyTorch server accepts a list of queries per request')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='Number of kept-alive connections to the PyTorch server')
+    parser.add_argument('--max-batch', type=int, default=32,
+                        help='Maximum number of queries sent at once')
+    parser.add_argument('--max-wait', type=float, default=0.002,
+                        help='Seconds to wait for more queries before sending a batch')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='Number of cached predictions')
+    args = parser.parse_args()
+
+    model = BatchedModel(
+        ModelServer(args.server, batch=args.batch, connections=args.connections),
+        max_batch=args.max_batch, max_wait=args.max_wait, cache_size=args.cache_size)
+    server = DetectorServer(args.socket, model)
+    print('Serving on {}'.format(args.socket))
+    # report the counters on kill as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('{} queries, {} cached, {} batches'.format(
+            model.num_queries, model.num_cached, model.num_batches))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,20 @@
 import json
 import math
 import re
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+import socket
+import threading
+import http.client
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
 
 
 LINE_OFFSET = 5
 TEXT_TOKENIZER = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+# first "file:line:col: error: message" line of the g++ output
+ERROR_LINE = re.compile(r'^[^:\n]*:(\d+):[:0-9 ]+error: (.*)$', re.M)
+QUOTED = re.compile('‘[^’]*’')
+QUOTED_VARS = re.compile('‘[A-Za-z0-9_ ]*’')
 
 
 def tokenize_err_msg(text):
@@ -25,23 +33,293 @@ def parse_error(raw_err_msg, tokenize=True):
         That is, the line number where the first non preamble line is line 0,
         and where DUMMY lines are still included.
     """
-    lines = raw_err_msg.split('\n')
+    # the scan stops at the first error line
+    m = ERROR_LINE.search(raw_err_msg)
+    if not m:
+        return None, None
+    lineno, message = m.groups()
+    if tokenize:
+        message = ' '.join(tokenize_err_msg(message))
+    return int(lineno) - LINE_OFFSET, message.strip()
+
+
+def parse_error_stream(lines, tokenize=True):
+    """
+    parse_error over an iterable of lines (e.g. a g++ stderr pipe or log
+    file); the lines after the first error line are not read.
+    """
     for line in lines:
-        m = re.match('[^:]*:(\d+):[:0-9 ]+error: (.*)', line)
-        if not m:
-            continue
-        lineno, message = m.groups()
-        if tokenize:
-            message = ' '.join(tokenize_err_msg(message))
-        return int(lineno) - LINE_OFFSET, message.strip()
+        if 'error: ' in line:
+            lineno, message = parse_error(line, tokenize)
+            if message is not None:
+                return lineno, message
     return None, None
 
 
-def post_request(server, post_fields):
-    request = Request(server, urlencode(post_fields).encode())
-    response = urlopen(request).read().decode()
-    response = json.loads(response)
-    return response
+def err_template(msg, mode='all'):
+    """
+    Anonymize the quoted names ('all') or only the quoted identifiers
+    ('vars') of an error message; 'none' keeps it as is.
+    """
+    if mode == 'none' or '‘' not in msg:
+        return msg
+    if mode == 'vars':
+        return QUOTED_VARS.sub('@@@', msg)
+    return QUOTED.sub('@@@', msg)
+
+
+def mine_templates(records, modes=('all', 'vars', 'none')):
+    """
+    Count the line offsets of the error templates in a corpus.
+
+    Args:
+        records: iterable of (raw_err_msg, stmt_idx of the actual error line)
+    Returns:
+        dict (mode, template) -> Counter of line offsets
+        (g++ line minus actual line, as used by TemplateErrDetector)
+    """
+    counts = defaultdict(Counter)
+    for raw_err_msg, err_stmt_idx in records:
+        lineno, msg = parse_error(raw_err_msg, tokenize=False)
+        if msg is None:
+            continue
+        for mode in modes:
+            counts[mode, err_template(msg, mode)][lineno - err_stmt_idx] += 1
+    return counts
+
+
+def template_rows(counts, min_count=1):
+    """
+    Rows of a template file (mode, total_count, template, line_offset,
+    count_percent) with the most common offset of every template.
+    """
+    rows = []
+    for (mode, template), offsets in counts.items():
+        total = sum(offsets.values())
+        if total < min_count:
+            continue
+        offset, count = offsets.most_common(1)[0]
+        rows.append((mode, total, template, offset, 100.0 * count / total))
+    rows.sort(key=lambda row: (row[0], -row[1], row[2]))
+    return rows
+
+
+################################################
+# Detector model connections
+
+
+class ModelServer(object):
+    """
+    Persistent HTTP connections to the PyTorch detector server.
+
+    Each thread keeps its own keep-alive connection. If batch is set, the
+    server is assumed to accept a list of queries in one request and to
+    return one pred / logit per query; otherwise the queries of a batch
+    are posted concurrently over up to `connections` connections.
+    """
+
+    def __init__(self, url, batch=False, connections=4, timeout=60):
+        parts = urlsplit(url if '//' in url else 'http://' + url)
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        self.batch = batch
+        self.timeout = timeout
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+
+    def _post(self, q):
+        body = urlencode({'q': json.dumps(q)})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection(
+                    self.host, timeout=self.timeout)
+            try:
+                conn.request('POST', self.path, body, headers)
+                return json.loads(conn.getresponse().read().decode())
+            except (http.client.HTTPException, OSError):
+                # the server closed the kept-alive connection, reconnect once
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def predict(self, queries):
+        """
+        Return the (pred, logit) of every query, or the exception it raised.
+        """
+        if self.batch and len(queries) > 1:
+            response = self._post(queries)
+            preds = response['pred']
+            logits = response.get('logit', [None] * len(queries))
+            if len(preds) != len(queries) or len(logits) != len(queries):
+                raise ValueError('The server returned {} preds and {} logits for {} queries'.format(
+                    len(preds), len(logits), len(queries)))
+            return list(zip(preds, logits))
+        futures = [self.executor.submit(self._post, q) for q in queries]
+        results = []
+        for future in futures:
+            try:
+                response = future.result()
+                results.append((response['pred'][0], response.get('logit', [None])[0]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class BatchedModel(object):
+    """
+    Micro-batch the concurrent predict calls of one process.
+
+    A dispatcher thread collects the queries that arrive within max_wait
+    seconds (at most max_batch), sends the ones that are not cached and not
+    already pending to the model in one go, and resolves the callers.
+    It only waits while fewer queries are queued than threads are in
+    predict, so a single caller never waits.
+    Results are kept in an LRU cache of cache_size entries.
+    """
+
+    def __init__(self, model, max_batch=32, max_wait=0.002, cache_size=100000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # key -> future of the queued or running query
+        self.pending = {}
+        self.queue = []
+        self.cond = threading.Condition()
+        self.num_queries = 0
+        self.num_cached = 0
+        self.num_batches = 0
+        # threads in predict
+        self.num_callers = 0
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, key, q):
+        """
+        Return a future of the (pred, logit) of q; equal keys share the result.
+        """
+        with self.cond:
+            self.num_queries += 1
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.num_cached += 1
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = Future()
+                self.queue.append((key, q))
+                self.cond.notify()
+            else:
+                self.num_cached += 1
+            return future
+
+    def predict(self, key, q):
+        with self.cond:
+            self.num_callers += 1
+        try:
+            return self.submit(key, q).result()
+        finally:
+            with self.cond:
+                self.num_callers -= 1
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                # give the concurrent callers a moment to join the batch
+                if len(self.queue) < min(self.max_batch, self.num_callers):
+                    self.cond.wait(self.max_wait)
+                batch = self.queue[:self.max_batch]
+                del self.queue[:self.max_batch]
+            try:
+                results = self.model.predict([q for _, q in batch])
+                if len(results) != len(batch):
+                    raise ValueError('{} results for {} queries'.format(len(results), len(batch)))
+            except Exception as e:
+                results = [e] * len(batch)
+            with self.cond:
+                self.num_batches += 1
+                for (key, _), res in zip(batch, results):
+                    future = self.pending.pop(key)
+                    if isinstance(res, Exception):
+                        future.set_exception(res)
+                        continue
+                    res = tuple(res)
+                    self.cache[key] = res
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                    future.set_result(res)
+
+
+class DetectorClient(object):
+    """
+    Persistent connection to a detector service (err_service.py) on a
+    Unix socket. The service batches and caches across all its clients.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def predict(self, key, q):
+        request = json.dumps({'key': key, 'q': q}).encode('utf8') + b'\n'
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+            try:
+                self.sock.sendall(request)
+                response = self.rfile.readline()
+            except OSError:
+                self.sock = None
+                raise
+            if not response:
+                self.sock = None
+                raise ConnectionError('detector service closed')
+        response = json.loads(response)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['pred'], response['logit']
+
+
+def get_model(server):
+    """
+    unix:[path] connects to a detector service, anything else is the
+    URL of the PyTorch server (batched and cached in this process).
+    """
+    if server.startswith('unix:'):
+        return DetectorClient(server[len('unix:'):])
+    return BatchedModel(ModelServer(server))
+
+
+# Lines on each side of the g++ error line in the detector cache key
+QUERY_WINDOW = 3
+
+
+def query_key(code_lines, lineno, msg, window=QUERY_WINDOW):
+    """
+    Cache key of a detector query: error template, line and the code lines
+    within window lines of it. The stitcher changes one line per compilation,
+    so keying on the whole program would never hit; the cached answer is
+    reused as long as the lines around the error are the same.
+    """
+    context = code_lines[max(lineno - window, 0):max(lineno + window + 1, 0)]
+    return json.dumps([lineno, len(code_lines), err_template(msg), context])
 
 
 ################################################
@@ -98,24 +376,35 @@ class TemplateErrDetector(ErrDetector):
                     self.templates[line[0]][line[2]] = int(line[3])
         for mode, templates in self.templates.items():
             print('Read {} {} templates'.format(len(templates), mode))
+        # message -> (line offset or None, tokenized message)
+        self.matches = {}
 
     def anonymize(self, msg, mode):
-        if mode == 'none':
-            return msg
-        if mode == 'vars':
-            return re.sub('‘[A-Za-z0-9_ ]*’', '@@@', msg)
-        return re.sub('‘[^’]*’', '@@@', msg)
+        return err_template(msg, mode)
+
+    def match(self, msg):
+        """
+        Return the line offset of the first mode whose template matches msg
+        (None if none does) and the tokenized message, memoized per message.
+        """
+        res = self.matches.get(msg)
+        if res is None:
+            offset = None
+            for mode in self.MODES:
+                offset = self.templates[mode].get(self.anonymize(msg, mode))
+                if offset is not None:
+                    break
+            res = self.matches[msg] = (offset, ' '.join(tokenize_err_msg(msg)).strip())
+        return res
 
     def detect(self, code_lines, raw_err_msg):
         lineno, msg = parse_error(raw_err_msg, tokenize=False)
         if msg is None:
             return None, None
-        tokenized_msg = ' '.join(tokenize_err_msg(msg)).strip()
-        for mode in self.MODES:
-            anon_msg = self.anonymize(msg, mode)
-            if anon_msg in self.templates[mode]:
-                return lineno - self.templates[mode][anon_msg], tokenized_msg
-        return None, tokenized_msg
+        offset, tokenized_msg = self.match(msg)
+        if offset is None:
+            return None, tokenized_msg
+        return lineno - offset, tokenized_msg
 
 
 class BinaryErrDetector(ErrDetector):
@@ -124,9 +413,9 @@ class BinaryErrDetector(ErrDetector):
     If not, abstain.
     """
 
-    def __init__(self, args):
-        self.server = args.err_server
-        self.info = {'probno': args.probno}
+    def __init__(self, args, probno=None):
+        self.model = get_model(args.err_server)
+        self.info = {'probno': args.probno if probno is None else probno}
 
     def detect(self, code_lines, raw_err_msg):
         lineno, msg = parse_error(raw_err_msg, tokenize=True)
@@ -141,8 +430,8 @@ class BinaryErrDetector(ErrDetector):
                 'msg': msg,
             }
         }
-        response = post_request(self.server, {'q': json.dumps(q)})
-        if response['pred'][0]:
+        pred, _ = self.model.predict(query_key(code_lines, lineno, msg), q)
+        if pred:
             return lineno, msg
         return None, msg
 
@@ -152,9 +441,9 @@ class AdvancedErrDetector(ErrDetector):
     Ask the PyTorch server what the actual error line is.
     """
 
-    def __init__(self, args):
-        self.server = args.err_server
-        self.info = {'probno': args.probno}
+    def __init__(self, args, probno=None):
+        self.model = get_model(args.err_server)
+        self.info = {'probno': args.probno if probno is None else probno}
         self.threshold = args.err_advanced_threshold
 
     def detect(self, code_lines, raw_err_msg):
@@ -170,9 +459,10 @@ class AdvancedErrDetector(ErrDetector):
                 'msg': msg,
             }
         }
-        response = post_request(self.server, {'q': json.dumps(q)})
-        argmax = response['pred'][0]
-        probs = self.softmax(response['logit'][0])
+        argmax, logit = self.model.predict(query_key(code_lines, lineno, msg), q)
+        if logit is None:
+            raise RuntimeError('The detector server returned no logit')
+        probs = self.softmax(logit)
         if probs[argmax] >= self.threshold:
             return argmax, msg
         return None, msg
@@ -185,13 +475,16 @@ class AdvancedErrDetector(ErrDetector):
 ################################################
 
 
-def get_err_detector(args):
+def get_err_detector(args, probno=None):
+    """
+    probno is the program sent to the model detectors (default: args.probno).
+    """
     if args.err_detector == 'naive':
         return NaiveErrDetector(args)
     if args.err_detector == 'template':
         return TemplateErrDetector(args)
     if args.err_detector == 'binary':
-        return BinaryErrDetector(args)
+        return BinaryErrDetector(args, probno)
     if args.err_detector == 'advanced':
-        return AdvancedErrDetector(args)
+        return AdvancedErrDetector(args, probno)
     raise ValueError('Unknown detector: {}'.format(args.err_detector))
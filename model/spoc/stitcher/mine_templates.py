@@ -0,0 +1,75 @@
+# Error template mining
+import os
+import ast
+import sys
+import glob
+import argparse
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+
+from err_utils import mine_templates, template_rows
+
+
+"""
+    Mine the error templates of TemplateErrDetector from the detailed
+    oracle logs of a stitching run (stitch.py -O):
+
+        python mine_templates.py ./out -j 16 -o templates.tsv
+
+    Every compile error of detailed-oracle.txt comes from a program that is
+    gold except for one candidate line, which is the actual error line.
+"""
+
+COMPILE_ERR = '1'
+
+
+def read_oracle_errors(path):
+    """
+    Yield (raw_err_msg, stmt_idx of the replaced line) of a detailed-oracle.txt.
+    """
+    with open(path) as fin:
+        for line in fin:
+            # stmt_idx prob_list_idx rank passed error repr(error_message)
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 6 and fields[4] == COMPILE_ERR:
+                yield ast.literal_eval(fields[5]), int(fields[0])
+
+
+def mine_file(path):
+    return mine_templates(read_oracle_errors(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+',
+                        help='detailed-oracle.txt files or output directories of stitch.py')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Template file to write (default: stdout)')
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='Minimum number of occurrences of a template')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, '*', 'detailed-oracle.txt'))))
+        else:
+            paths.append(path)
+    counts = defaultdict(Counter)
+    with Pool(args.workers) as pool:
+        for file_counts in pool.imap_unordered(mine_file, paths, chunksize=16):
+            for key, offsets in file_counts.items():
+                counts[key].update(offsets)
+    rows = template_rows(counts, args.min_count)
+    fout = open(args.output, 'w') if args.output else sys.stdout
+    for row in rows:
+        print('\t'.join(str(x) for x in row), file=fout)
+    if args.output:
+        fout.close()
+    print('Mined {} templates from {} files'.format(len(rows), len(paths)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
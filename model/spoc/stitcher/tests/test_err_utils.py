@@ -0,0 +1,87 @@
+import argparse
+
+from err_utils import (
+    LINE_OFFSET,
+    TemplateErrDetector,
+    err_template,
+    mine_templates,
+    parse_error,
+    parse_error_stream,
+    template_rows,
+)
+
+# g++ 11 output (LANG=C.UTF-8)
+CONVERSION = '''\
+1A-2.cpp: In function ‘int main()’:
+1A-2.cpp:8:12: error: conversion from ‘int’ to non-scalar type ‘std::string’ {aka ‘std::__cxx11::basic_string<char>’} requested
+    8 | string s = n;
+      |            ^
+1A-2.cpp:9:1: error: ‘foo’ was not declared in this scope
+    9 | foo(s);
+      | ^~~
+'''
+MISSING_SEMICOLON = '''\
+2B-1.cpp: In function ‘int main()’:
+2B-1.cpp:9:3: error: expected ‘,’ or ‘;’ before ‘return’
+    9 |   return x;
+      |   ^~~~~~
+'''
+NO_MEMBER = '''\
+3C-0.cpp: In function ‘int main()’:
+3C-0.cpp:12:5: error: ‘class std::vector<int>’ has no member named ‘push’
+   12 |   v.push(1);
+      |     ^~~~
+'''
+WARNING_ONLY = '''\
+4D-1.cpp: In function ‘int main()’:
+4D-1.cpp:7:7: warning: unused variable ‘x’ [-Wunused-variable]
+    7 |   int x;
+      |       ^
+'''
+
+
+def test_parse_error_first_error():
+    assert parse_error(CONVERSION, tokenize=False) == (
+        8 - LINE_OFFSET,
+        'conversion from ‘int’ to non-scalar type ‘std::string’ {aka ‘std::__cxx11::basic_string<char>’} requested',
+    )
+    assert parse_error(MISSING_SEMICOLON) == (9 - LINE_OFFSET, 'expected ‘ , ’ or ‘ ; ’ before ‘ return ’')
+    assert parse_error(WARNING_ONLY) == (None, None)
+    assert parse_error('') == (None, None)
+
+
+def test_parse_error_stream_matches_parse_error():
+    for output in (CONVERSION, MISSING_SEMICOLON, NO_MEMBER, WARNING_ONLY):
+        for tokenize in (True, False):
+            assert parse_error_stream(output.splitlines(True), tokenize) == parse_error(output, tokenize)
+
+
+def test_err_template_modes():
+    _, msg = parse_error(NO_MEMBER, tokenize=False)
+    assert err_template(msg) == '@@@ has no member named @@@'
+    assert err_template(msg, 'vars') == '‘class std::vector<int>’ has no member named @@@'
+    assert err_template(msg, 'none') == msg
+    assert err_template('expected primary-expression') == 'expected primary-expression'
+
+
+def test_template_detector_from_mined_templates(tmp_path):
+    # the actual error lines: the line before a missing semicolon, the line itself otherwise
+    records = [
+        (MISSING_SEMICOLON, 9 - LINE_OFFSET - 1),
+        (MISSING_SEMICOLON.replace('9:3', '20:3'), 20 - LINE_OFFSET - 1),
+        (NO_MEMBER, 12 - LINE_OFFSET),
+    ]
+    template_file = tmp_path / 'templates.tsv'
+    with open(str(template_file), 'w') as fout:
+        for row in template_rows(mine_templates(records)):
+            fout.write('\t'.join(str(x) for x in row) + '\n')
+    detector = TemplateErrDetector(
+        argparse.Namespace(err_template_file=str(template_file), err_template_threshold=90.0)
+    )
+    assert detector.detect(None, MISSING_SEMICOLON.replace('9:3', '31:3')) == (
+        31 - LINE_OFFSET - 1,
+        'expected ‘ , ’ or ‘ ; ’ before ‘ return ’',
+    )
+    assert detector.detect(None, NO_MEMBER.replace('vector<int>', 'set<int>'))[0] == 12 - LINE_OFFSET
+    assert detector.detect(None, CONVERSION)[0] is None
+    assert detector.detect(None, WARNING_ONLY) == (None, None)
@@ -6,6 +6,7 @@ Parse the log file from translate.py and output evaluation scores.
 from __future__ import print_function
 
 import re
+import math
 import argparse
 from collections import Counter
 
@@ -128,6 +129,47 @@ class Output(object):
         if output is not None:
             yield output
 
+    @classmethod
+    def parse_fairseq_file(cls, pred_file, tgt_file):
+        """
+        Yield Output objects from the output of fairseq-generate
+        (e.g., DA-Transformer with --decode-strategy kbest and --nbest).
+        Hypotheses are kept in the generated order; their scores are the
+        total log-probabilities (natural log) as in translate.py.
+        """
+        with open(tgt_file) as ftgt:
+            golds = [line.strip() for line in ftgt]
+        outputs = {}
+        with open(pred_file) as fin:
+            for line in fin:
+                line = line.rstrip('\n')
+                # S-0\tsource, H-0\tscore\thypo, D-0\tscore\tdetok, P-0\tpositional scores
+                m = re.match(r'^([SDP])-(\d+)\t(.*)$', line)
+                if not m:
+                    continue
+                kind, i, rest = m.groups()
+                i = int(i)
+                if i not in outputs:
+                    outputs[i] = Output()
+                    outputs[i].index = i + 1
+                    outputs[i].gold = cls.format_code(golds[i])
+                    outputs[i].gold_score = 0.0
+                output = outputs[i]
+                if kind == 'S':
+                    output.sentence = rest
+                elif kind == 'D':
+                    # the mean score in base 2 is replaced by the total below
+                    output.preds.append(cls.format_code(rest.split('\t', 1)[1]))
+                    output.pred_scores.append(float(rest.split('\t', 1)[0]))
+                else:
+                    # P- follows its D- line and gives the number of positions
+                    num_positions = len(rest.split())
+                    mean = output.pred_scores[-1]
+                    output.pred_scores[-1] = (
+                        mean * num_positions * math.log(2) if num_positions else float('-inf'))
+        for i in sorted(outputs):
+            yield outputs[i]
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -141,6 +183,8 @@ def main():
             help='When dumping predictions, dump all ranks in their own lines')
     parser.add_argument('-r', '--gold-rank', action='store_true',
             help='Print gold rank')
+    parser.add_argument('-f', '--fairseq', action='store_true',
+            help='the prediction file is the output of fairseq-generate')
     parser.add_argument("pred_file",
             help="the prediction file from translate.py")
     parser.add_argument("tgt_file",
@@ -154,7 +198,8 @@ def main():
 
     with open(args.out_file, 'w') as fout:
         Output.dump_header(fout)
-        for output in Output.parse_file(args.pred_file, args.tgt_file):
+        parse_file = Output.parse_fairseq_file if args.fairseq else Output.parse_file
+        for output in parse_file(args.pred_file, args.tgt_file):
             if args.out_file != '/dev/null':
                 output.dump(fout, args)
             if output.sentence != SKIPTHISLINE and output.sentence != DUMMY:
@@ -0,0 +1,171 @@
+import math
+from collections import Counter, OrderedDict
+
+from tree_sitter import Parser
+from codebleu import bleu, weighted_ngram_match
+from codebleu.codebleu import PACKAGE_DIR
+from codebleu.dataflow_match import dfg_function, get_data_flow, normalize_dataflow
+from codebleu.parser import remove_comments_and_docstrings
+from codebleu.utils import get_tree_sitter_language
+
+
+"""
+    CodeBLEU with cached references
+
+    codebleu.calc_codebleu re-reads the keywords and re-parses the reference
+    on every call. CodeBLEUScorer keeps, per reference key (e.g. unique_id),
+    the n-gram counts, keyword weights, syntax subtrees and normalized data
+    flow of the reference, so scoring several predictions of one problem
+    parses the reference once. The scores equal calc_codebleu with one
+    reference and one prediction and the default tokenizer.
+"""
+
+MAX_ORDER = 4
+
+
+def _ngram_counts(tokens, n):
+    return Counter(zip(*[tokens[i:] for i in range(n)])) if len(tokens) >= n else Counter()
+
+
+def _corpus_bleu(module, p_n, references, hyp_len, weights=(0.25, 0.25, 0.25, 0.25)):
+    """
+    The end of module.corpus_bleu for one hypothesis and its references
+    (in the argument format of the module, which decides the reference length).
+    """
+    if p_n[0][0] == 0:
+        return 0
+    bp = module.brevity_penalty(module.closest_ref_length(references, hyp_len), hyp_len)
+    p_n = module.SmoothingFunction().method1(p_n)
+    s = (w_i * math.log(p_i[0] / p_i[1]) for w_i, p_i in zip(weights, p_n))
+    return bp * math.exp(math.fsum(s))
+
+
+class _Reference(object):
+    """
+    Everything CodeBLEU derives from a reference alone.
+    """
+
+    def __init__(self, scorer, code):
+        self.tokens = code.split()
+        self.ngrams = [_ngram_counts(self.tokens, n) for n in range(1, MAX_ORDER + 1)]
+        self.weights = {
+            token: 1 if token in scorer.keywords else 0.2 for token in self.tokens
+        }
+        self.sexps = scorer.subtrees(code)
+        self.dataflow = scorer.dataflow(code)
+        self.num_dataflow = sum(self.dataflow.values())
+
+
+class CodeBLEUScorer(object):
+    """
+    Score predictions against cached references (at most max_refs kept).
+    """
+
+    def __init__(self, lang, weights=(0.25, 0.25, 0.25, 0.25), max_refs=1024):
+        self.lang = lang
+        self.weights = weights
+        self.max_refs = max_refs
+        self.refs = OrderedDict()
+        with open(PACKAGE_DIR / "keywords" / (lang + ".txt"), "r", encoding="utf-8") as f:
+            self.keywords = set(x.strip() for x in f.readlines())
+        self.parser = Parser()
+        self.parser.language = get_tree_sitter_language(lang)
+
+    def _strip_comments(self, code):
+        try:
+            return remove_comments_and_docstrings(code, self.lang)
+        except Exception:
+            return code
+
+    def subtrees(self, code):
+        """
+        S-expressions of the subtrees with children, as in syntax_match.
+        """
+        root = self.parser.parse(bytes(self._strip_comments(code), "utf8")).root_node
+        sexps, stack = [], [root]
+        while stack:
+            node = stack.pop()
+            sexps.append(str(node))
+            stack.extend(child for child in node.children if child.children)
+        return sexps
+
+    def dataflow(self, code):
+        """
+        Multiset of the normalized data flow edges, as in dataflow_match.
+        """
+        dfg = get_data_flow(self._strip_comments(code), [self.parser, dfg_function[self.lang]])
+        return Counter(
+            (var, relationship, tuple(par_vars))
+            for var, relationship, par_vars in normalize_dataflow(dfg)
+        )
+
+    def reference(self, key, code):
+        ref = self.refs.get(key)
+        if ref is None:
+            ref = self.refs[key] = _Reference(self, code.strip())
+            if len(self.refs) > self.max_refs:
+                self.refs.popitem(last=False)
+        else:
+            self.refs.move_to_end(key)
+        return ref
+
+    def score(self, key, reference, prediction):
+        """
+        Return the calc_codebleu dict of prediction against reference,
+        which is parsed once per key.
+        """
+        ref = self.reference(key, reference)
+        prediction = prediction.strip()
+        tokens = prediction.split()
+        hyp_ngrams = [_ngram_counts(tokens, n) for n in range(1, MAX_ORDER + 1)]
+
+        # n-gram match: clipped hypothesis n-grams
+        p_n = [
+            (
+                sum(min(count, ref_counts[ngram]) for ngram, count in counts.items()),
+                max(1, sum(counts.values())),
+            )
+            for counts, ref_counts in zip(hyp_ngrams, ref.ngrams)
+        ]
+        ngram_match_score = _corpus_bleu(bleu, p_n, [ref.tokens], len(tokens))
+
+        # weighted n-gram match: clipped reference n-grams, unigrams weighted
+        p_n = []
+        for n, (counts, ref_counts) in enumerate(zip(hyp_ngrams, ref.ngrams), start=1):
+            clipped = {ngram: min(count, counts[ngram]) for ngram, count in ref_counts.items()}
+            if n == 1 and len(ref.weights) == len(ref_counts):
+                p_n.append(
+                    (
+                        sum(c * ref.weights.get(ngram[0], 1) for ngram, c in clipped.items()),
+                        max(1, sum(c * ref.weights.get(ngram[0], 1) for ngram, c in ref_counts.items())),
+                    )
+                )
+            else:
+                p_n.append((sum(clipped.values()), max(1, sum(ref_counts.values()))))
+        weighted_ngram_match_score = _corpus_bleu(
+            weighted_ngram_match, p_n, [[ref.tokens, ref.weights]], len(tokens)
+        )
+
+        # syntax match: reference subtrees found in the prediction
+        cand_sexps = set(self.subtrees(prediction))
+        syntax_match_score = sum(1 for sexp in ref.sexps if sexp in cand_sexps) / len(ref.sexps)
+
+        # dataflow match: reference edges found in the prediction (as a multiset)
+        if ref.num_dataflow:
+            cand_dataflow = self.dataflow(prediction)
+            matched = sum(min(count, cand_dataflow[edge]) for edge, count in ref.dataflow.items())
+            dataflow_match_score = matched / ref.num_dataflow
+        else:
+            dataflow_match_score = 0
+
+        alpha, beta, gamma, theta = self.weights
+        return {
+            "codebleu": alpha * ngram_match_score
+            + beta * weighted_ngram_match_score
+            + gamma * syntax_match_score
+            + theta * (dataflow_match_score or 1),
+            "ngram_match_score": ngram_match_score,
+            "weighted_ngram_match_score": weighted_ngram_match_score,
+            "syntax_match_score": syntax_match_score,
+            "dataflow_match_score": dataflow_match_score,
+        }
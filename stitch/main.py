@@ -1,17 +1,32 @@
 import re
 import os
+import ast
 import pandas as pd
 import argparse
 import subprocess
 from tqdm import tqdm
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from datetime import datetime
 
 import uuid
 
+from utils import CompileCache, PrecompiledHeader, EvalPool, run_command
+from utils import TestcaseStore, run_suites
+from utils import fix_strings, fix_token, fix_token_b, fix_strings_batch
+from utils import save_pickle, load_pickle
+from utils import SuiteReport
+
 # Global arguments
 ARGS = None
+# Compile-result cache shared by all workers, None if disabled
+CACHE = None
+# Precompiled bits/stdc++.h, None if disabled
+PCH = None
+# Parsed test cases, memoized per problem id
+TESTCASES = None
+# Client of the compile-and-test service (service.py), None to run locally
+SERVICE = None
 
 class _header:
     text = 0
@@ -34,98 +49,10 @@ class err:
     mismatch_err = 3
 
 """
-    比较文件内容
+    比较输出内容: 超过该大小的程序输出直接判为不匹配
 """
 BIG_FILE_THRESHOLD = 1000000
 
-def compare_files(outfile, prgfile):
-    # Don't read big files
-    if (
-        os.path.getsize(prgfile) > BIG_FILE_THRESHOLD
-        and os.path.getsize(outfile) < BIG_FILE_THRESHOLD
-    ):
-        return False
-    with open(outfile, "br") as fin:
-        outdata = fin.read()
-    with open(prgfile, "br") as fin:
-        return fin.read() == outdata
-
-def fix_strings(inp):
-    res = ""
-    temp_string = ""
-    inside = False
-    for i in range(len(inp)):
-        if not inside:
-            res += inp[i]
-            if inp[i] == '"':
-                inside = True
-            continue
-        if inside:
-            if inp[i] == '"':
-                inside = False
-                if (
-                    len(temp_string) > 2
-                    and temp_string[0] == " "
-                    and temp_string[-1] == " "
-                ):
-                    res += temp_string[1:-1]
-                else:
-                    res += temp_string
-                res += '"'
-                temp_string = ""
-            else:
-                temp_string += inp[i]
-    inp = res
-    res = ""
-    temp_string = ""
-    inside = False
-    for i in range(len(inp)):
-        if not inside:
-            res += inp[i]
-            if inp[i] == "'":
-                inside = True
-            continue
-        if inside:
-            if inp[i] == "'":
-                inside = False
-                if (
-                    len(temp_string) > 2
-                    and temp_string[0] == " "
-                    and temp_string[-1] == " "
-                ):
-                    res += temp_string[1:-1]
-                else:
-                    res += temp_string
-                res += "'"
-                temp_string = ""
-            else:
-                temp_string += inp[i]
-    return res
-
-
-def fix_token(nl):
-    nl = nl.replace("( (", "((")
-    nl = nl.replace(") )", "))")
-    nl = nl.replace("[ [", "[[")
-    nl = nl.replace("] ]", "]]")
-    nl = nl.replace("{ {", "{{")
-    nl = nl.replace("} }", "}}")
-    nl = nl.replace("; ;", ";;")
-    nl = nl.replace("long long int", "long_long")
-    nl = nl.replace("long long", "long_long")
-    nl = re.sub(r'"\s"', "<space>", nl)
-    nl = re.sub(r"'\s'", "<space>", nl)
-    return nl
-
-
-def fix_token_b(nl):
-    if nl is None:
-        return None
-    nl = nl.replace("long_long", "long long")
-    # re.sub(pattern, replacement, text)
-    nl = re.sub("<space>", '" "', nl)
-    return nl
-
 
 # 分析输出结果
 def parse_fairseq_output(output_file, fix_token=False):
@@ -145,32 +72,15 @@ def parse_fairseq_output(output_file, fix_token=False):
     for group in groups:
         mylist = []
         for line in group:
-            pre = None
-            if line.startswith("S-"):
-                pre = " ".join(line.split()[1:])
-                if fix_token:
-                    mylist.append(fix_token_b(pre))
-                else:
-                    mylist.append(pre)
-            elif line.startswith("T-"):
-                pre = " ".join(line.split()[1:])
-                if fix_token:
-                    mylist.append(fix_token_b(pre))
-                else:
-                    mylist.append(pre)
+            if line.startswith("S-") or line.startswith("T-"):
+                mylist.append(" ".join(line.split()[1:]))
             elif line.startswith("H-"):
                 if len(line.split()) == 2:
-                    pre = None
-                    if fix_token:
-                        mylist.append(fix_token_b(pre))
-                    else:
-                        mylist.append(pre)
+                    mylist.append(None)
                 else:
-                    pre = " ".join(line.split()[2:])
-                    if fix_token:
-                        mylist.append(fix_token_b(pre))
-                    else:
-                        mylist.append(pre)
+                    mylist.append(" ".join(line.split()[2:]))
+        if fix_token:
+            mylist = fix_strings_batch(mylist, fn=fix_token_b)
 
         groups_list.append(mylist)
 
@@ -184,6 +94,10 @@ def parse_fairseq_output(output_file, fix_token=False):
     编译代码
 """
 
+# compiler message of a compilation killed after --gcc-timeout (never cached)
+COMPILE_TIMEOUT = "g++ timeout!"
+
+
 def compile_code(code, probid, subid, compile_only=False):
     """
     Write the code to [probid]-[subid].cpp and compile it.
@@ -194,22 +108,26 @@ def compile_code(code, probid, subid, compile_only=False):
     with open(unique_id + ".cpp", "w") as src_file:
         src_file.write(code)
 
+    # 预编译头文件 (bits/stdc++.h.gch) 的参数
+    pch_flags = PCH.compile_flags() if PCH is not None else ""
     if not compile_only:
         # -o {}: 指定输出文件的名称为 {unique_id}
-        command = "timeout {} g++ -std=c++03 {}.cpp -o {}".format(
-            5, unique_id, unique_id
+        command = "timeout {} g++ -std=c++03 {}{}.cpp -o {}".format(
+            ARGS.gcc_timeout + 1, pch_flags, unique_id, unique_id
         )
     else:
         # -c: 仅编译源文件，而不进行链接。这表示编译器将生成目标文件（.o 文件），但不会生成可执行文件。
-        command = "timeout {} g++ -std=c++03 {}.cpp -c".format(5, unique_id)
+        command = "timeout {} g++ -std=c++03 {}{}.cpp -c".format(
+            ARGS.gcc_timeout + 1, pch_flags, unique_id
+        )
 
     try:
-        process = subprocess.run(
-            command, shell=True, timeout=5, stderr=subprocess.PIPE
-        )
+        process = run_command(command, timeout=ARGS.gcc_timeout, stderr=subprocess.PIPE)
     except subprocess.TimeoutExpired:
-        return "g++ timeout!"
+        return COMPILE_TIMEOUT
 
+    if PCH is not None:
+        PCH.check(process.stderr.decode("utf8", "backslashreplace"))
     if process.returncode == 0:
         return None
     else:
@@ -239,6 +157,33 @@ def process_code(row_code, pre_code):
     return pre_code
 
 
+def report_errors(report):
+    """
+    Convert a SuiteReport to the error code and extra info.
+    """
+    if report.failed is None:
+        return err.no_err, None
+    if report.kind == "mismatch":
+        return err.mismatch_err, report.info
+    return err.runtime_err, report.info
+
+
+def suite_results(report, test_names):
+    """
+    (error code, extra info) of each suite of the report, up to the failing one.
+    """
+    results = []
+    for test_name in test_names:
+        if test_name in report.passed:
+            results.append((err.no_err, None))
+        elif test_name == report.failed:
+            results.append(report_errors(report))
+            break
+        else:
+            break
+    return results
+
+
 def run_tests(code, probid, subid, test_name):
     """
     Run the code on test cases.
@@ -246,66 +191,58 @@ def run_tests(code, probid, subid, test_name):
 
     Return the error code (no_err, runtime_err, or mismatch_err) and extra info.
 
-    Note: Does not clean up the files. Need to run cleanup afterwards.
+    Test cases come from TESTCASES (parsed once per problem), are fed
+    through pipes and the outputs are compared in memory.
     """
-    # uuid_str = str(uuid.uuid4())
-    unique_id = probid + "-" + subid
-    objfile = unique_id
-    inpfile = objfile + "_inp.txt"
-    outfile = objfile + "_out.txt"
-    prgfile = objfile + "_prg.txt"
-
-    input_file = open(inpfile, "w")
-    output_file = open(outfile, "w")
-
-    testcases = "{}/{}/{}_{}.txt".format(
-        r"./data/testcases", probid, probid, test_name
+    report = run_suites(
+        probid + "-" + subid,
+        [(test_name, TESTCASES.get(probid, test_name))],
+        ARGS.timeout,
+        big_output=BIG_FILE_THRESHOLD,
     )
-    with open(testcases) as f:
-        contents = f.readlines()
-
-    error_code = err.no_err
-    error_info = None
-    num_test = 0
-    counter = 0
-    for line in contents:
-        if line == "###ENDINPUT###\n":
-            counter = 1
-            continue
-        if line == "###ENDOUTPUT###\n":
-            input_file.close()
-            output_file.close()
-            command = "timeout {} ./{} < {} > {}".format(2, objfile, inpfile, prgfile)
-            process = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
-            if process.returncode != 0:
-                error_code = err.runtime_err
-                if process.returncode == 124:
-                    error_info = "Timeout {}"
-                else:
-                    error_info = process.stderr.decode("utf8", "backslashreplace")
-                break
-            if not compare_files(outfile, prgfile):
-                error_code = err.mismatch_err
-                error_info = "Mismatch {}".format(num_test)
-                break
-            num_test += 1
-            counter = 0
-            input_file = open(inpfile, "w")
-            output_file = open(outfile, "w")
-            continue
-        if counter == 0:
-            input_file.write(line)
-        if counter == 1:
-            output_file.write(line)
+    return report_errors(report)
+
 
-    input_file.close()
-    output_file.close()
-    return error_code, error_info
+TEST_SUITES = ["testcases_public", "testcases_hidden"]
 
 
 def compile_and_run_tests(running_code, probid, subid, detail=False):
+    """
+    Compile the code and run it on public and hidden test cases.
+    The suites run in one session which stops at the first failing case.
+    Verdicts are looked up in (and saved to) CACHE when it is enabled.
+    Without a cached verdict, the code goes to SERVICE when it is set.
+
+    Return 0 (compile error), 1 (compiled), 2 (passed public) or 3 (passed both).
+    """
     flag = 0
-    compile_errors = compile_code(running_code, probid, subid, compile_only=False)
+    entry = CACHE.get(running_code) if CACHE is not None else None
+    # whether ./[probid]-[subid] is the binary of running_code
+    binary_ready = False
+    # verdicts of the service, None if evaluated locally
+    report = None
+
+    if entry is None and SERVICE is not None:
+        verdict = SERVICE.evaluate(
+            running_code,
+            probid,
+            [] if ARGS.compile else TEST_SUITES,
+            timeout=ARGS.timeout,
+            std="c++03",
+            name=probid + "-" + subid,
+            gcc_timeout=ARGS.gcc_timeout,
+        )
+        compile_errors = verdict["compile_errors"]
+        report = SuiteReport.from_dict(verdict)
+        if CACHE is not None and compile_errors != COMPILE_TIMEOUT:
+            entry = CACHE.put_compile(running_code, compile_errors)
+    elif entry is None:
+        compile_errors = compile_code(running_code, probid, subid, compile_only=False)
+        binary_ready = compile_errors is None
+        if CACHE is not None and compile_errors != COMPILE_TIMEOUT:
+            entry = CACHE.put_compile(running_code, compile_errors, probid + "-" + subid)
+    else:
+        compile_errors = entry["compile_errors"]
     if detail:
         print(f"compile_errors:{compile_errors}")
 
@@ -316,23 +253,49 @@ def compile_and_run_tests(running_code, probid, subid, detail=False):
     if ARGS.compile:
         return flag
 
-    test_errors, test_error_info = run_tests(
-        running_code, probid, subid, "testcases_public"
-    )
-    if detail:
-        print(f"testcases_public:{test_errors},{test_error_info}")
-    if test_errors != err.no_err:
-        return flag
-    flag += 1
-
-    test_errors, test_error_info = run_tests(
-        running_code, probid, subid, "testcases_hidden"
-    )
-    if detail:
-        print(f"testcases_hidden:{test_errors},{test_error_info}")
-    if test_errors != err.no_err:
-        return flag
-    flag += 1
+    # (error code, extra info) of each suite, cached verdicts first
+    results = []
+    if report is not None:
+        remaining = TEST_SUITES
+    else:
+        for test_name in TEST_SUITES:
+            cached = CACHE.get_test(entry, probid, test_name, ARGS.timeout) if entry is not None else None
+            if cached is None:
+                break
+            results.append(cached)
+            if cached[0] != err.no_err:
+                break
+        remaining = TEST_SUITES[len(results):]
+    if remaining and report is None and all(res[0] == err.no_err for res in results):
+        if not binary_ready:
+            # The binary is not cached (or gone), compile again
+            binary_ready = CACHE.restore_binary(
+                running_code, probid + "-" + subid
+            ) or compile_code(running_code, probid, subid) is None
+        if not binary_ready:
+            # The cached verdict says it compiles, but it did not (e.g. g++ timeout)
+            return 0
+        report = run_suites(
+            probid + "-" + subid,
+            [(test_name, TESTCASES.get(probid, test_name)) for test_name in remaining],
+            ARGS.timeout,
+            big_output=BIG_FILE_THRESHOLD,
+        )
+    if remaining and report is not None:
+        for test_name, res in zip(remaining, suite_results(report, remaining)):
+            results.append(res)
+            if CACHE is not None:
+                entry = CACHE.put_test(running_code, probid, test_name, ARGS.timeout, *res)
+        if detail:
+            for test_name, num_test, wall, cpu in report.timings:
+                print(f"{test_name} #{num_test}: wall {wall:.3f}s cpu {cpu:.3f}s")
+
+    for test_name, (test_errors, test_error_info) in zip(TEST_SUITES, results):
+        if detail:
+            print(f"{test_name}:{test_errors},{test_error_info}")
+        if test_errors != err.no_err:
+            return flag
+        flag += 1
     return flag
 
 
@@ -452,179 +415,238 @@ def check_line_code_top1(is_test=False):
     return final_res
 
 
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
-from tqdm import tqdm
-
 """
-    检查单行代码的功能正确性
+    预处理数据: 将 {split}.csv 按 unique_id 分组, 预先解析 replace_dict
 """
 
-def check_line_code_topN_thread():
-    split = ARGS.split
+def build_split_store(csv_file):
+    """
+    Read the split csv once and group its rows by unique_id.
 
-    data = pd.read_csv(f"./data/{split}.csv")
-    code_header = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-    TopN = 10 + ARGS.top - 1
+    Return a dict mapping unique_id to the list of its rows sorted by line.
+    Each row is a list indexed by _header with replace_dict already parsed.
+    """
+    data = pd.read_csv(csv_file)
+    data["replace_dict"] = [
+        ast.literal_eval(x) for x in data["replace_dict"].values.tolist()
+    ]
+    data = data.sort_values(by=["unique_id", "line"], kind="stable")
+    return {
+        uid: group.values.tolist()
+        for uid, group in data.groupby("unique_id", sort=True)
+    }
+
+
+def load_split(split):
+    """
+    Load the grouped rows of ./data/{split}.csv.
+    The store is pickled to ARGS.split_cache and rebuilt when the csv is newer.
+    """
+    csv_file = f"./data/{split}.csv"
+    store_file = os.path.join(ARGS.split_cache, f"{split}.pkl")
+    store = load_pickle(store_file, source=csv_file)
+    if store is None:
+        store = build_split_store(csv_file)
+        save_pickle(store_file, store)
+    return store
 
-    unique_id = list(sorted(set(data["unique_id"].values.tolist())))
-    print(f"一共有{len(unique_id)}个问题")
-    if ARGS.test:
-        unique_id = unique_id[0:10]
 
-    final_res = []
+"""
+    评测进程池: 每个worker在独立的临时目录中编译和运行
+"""
 
-    def process_task(uid):
-        temp_data = data[data["unique_id"] == uid].sort_values(
-            by="line", ascending=True
+def init_worker(args):
+    """
+    Set the globals of a worker process (also used by the main process).
+    """
+    global ARGS, CACHE, PCH, TESTCASES, SERVICE
+    ARGS = args
+    TESTCASES = TestcaseStore(ARGS.prog_dir, ARGS.testcase_cache)
+    if not ARGS.no_cache:
+        CACHE = CompileCache(
+            ARGS.cache_dir, compile_command="g++ -std=c++03", keep_binaries=ARGS.cache_binaries
         )
+    if ARGS.pch:
+        PCH = PrecompiledHeader(ARGS.pch_dir, flags="-std=c++03", timeout=ARGS.gcc_timeout)
+    if ARGS.eval_socket:
+        from service import EvalClient
 
-        spoc_code = temp_data.code.values.tolist()
-        temp_data_list = temp_data.values.tolist()
-        # 对subid做处理，避免多线程资源抢占
-        probid, subid, workerid = uid.split("-")
-        subid = f"{subid}-{workerid}"
+        SERVICE = EvalClient(ARGS.eval_socket)
 
-        index_pre = [
-            i for i, x in enumerate(temp_data.text_v.values.tolist()) if x != "DUMMY"
-        ]
 
-        code_list = []
-        for i in index_pre:
-            code_temp = spoc_code.copy()
-            line = temp_data_list[i]
-            if line[3] == line[TopN]:
-                code_list.append("\n".join(code_temp))
-                continue
-            pre_code = line[TopN]
-            replace_dict = eval(line[_header.replace_dict])
-            pre_code = " ".join(
-                list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
-            )
-            pre_code = fix_strings(pre_code)
-            code_temp[i] = process_code(code_temp[i], pre_code)
-            code_list.append("\n".join(code_temp))
+def run_pool(task, unique_id, store):
+    """
+    Run task(uid, rows) for every problem in an EvalPool, in order.
+    """
+    groups = (store[uid] for uid in unique_id)
+    with EvalPool(ARGS.workers, init_worker, (ARGS,)) as pool:
+        return list(
+            tqdm(pool.map(task, unique_id, groups, timeout=ARGS.task_timeout), total=len(unique_id))
+        )
 
-        code_res = []
-        for _, code in enumerate(code_list):
-            test_code = code_header + code
-            code_res.append(compile_and_run_tests(test_code, probid, subid))
-        cleanup(f"{probid}-{subid}")
-        return code_res
 
-    with ThreadPoolExecutor() as executor:
-        final_res = list(
-            tqdm(executor.map(process_task, unique_id), total=len(unique_id))
+"""
+    检查单行代码的功能正确性
+"""
+
+def line_code_task(uid, rows):
+    code_header = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
+    TopN = 10 + ARGS.top - 1
+
+    spoc_code = [row[_header.code] for row in rows]
+    temp_data_list = rows
+    # 对subid做处理，避免多线程资源抢占
+    probid, subid, workerid = uid.split("-")
+    subid = f"{subid}-{workerid}"
+
+    index_pre = [
+        i for i, row in enumerate(rows) if row[_header.text_v] != "DUMMY"
+    ]
+
+    code_list = []
+    for i in index_pre:
+        code_temp = spoc_code.copy()
+        line = temp_data_list[i]
+        if line[3] == line[TopN]:
+            code_list.append("\n".join(code_temp))
+            continue
+        pre_code = line[TopN]
+        replace_dict = line[_header.replace_dict]
+        pre_code = " ".join(
+            list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
         )
+        pre_code = fix_strings(pre_code)
+        code_temp[i] = process_code(code_temp[i], pre_code)
+        code_list.append("\n".join(code_temp))
 
-    return final_res
+    code_res = []
+    for _, code in enumerate(code_list):
+        test_code = code_header + code
+        code_res.append(compile_and_run_tests(test_code, probid, subid))
+    cleanup(f"{probid}-{subid}")
+    return code_res
 
 
-def check_all_code_topN_thread(is_test=False):
-    split = ARGS.split
+def check_line_code_topN_thread():
+    store = load_split(ARGS.split)
+
+    unique_id = list(store)
+    print(f"一共有{len(unique_id)}个问题")
+    if ARGS.test:
+        unique_id = unique_id[0:10]
 
-    data = pd.read_csv(f"./data/{split}.csv")
+    return run_pool(line_code_task, unique_id, store)
+
+
+def all_code_task(uid, rows):
     code_header = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
     TopN = 10
+    spoc_code = [row[_header.code] for row in rows]
+    temp_data_list = rows
 
-    unique_id = list(sorted(set(data["unique_id"].values.tolist())))
-
-    if ARGS.test:
-        unique_id = unique_id[25:30]
+    probid, subid, workerid = uid.split("-")
+    subid = f"{subid}-{workerid}"
 
-    def process_task(uid):
-        temp_data = data[data["unique_id"] == uid].sort_values(
-            by="line", ascending=True
-        )
-        spoc_code = temp_data.code.values.tolist()
-        temp_data_list = temp_data.values.tolist()
+    index_pre = [
+        i for i, row in enumerate(rows) if row[_header.text_v] != "DUMMY"
+    ]
 
-        probid, subid, workerid = uid.split("-")
-        subid = f"{subid}-{workerid}"
+    for i in index_pre:
+        line = temp_data_list[i]
+        pre_code = str(line[TopN])
 
-        index_pre = [
-            i for i, x in enumerate(temp_data.text_v.values.tolist()) if x != "DUMMY"
-        ]
+        if line[3] in line[TopN : TopN + ARGS.top]:
+            continue
 
-        for i in index_pre:
-            line = temp_data_list[i]
-            pre_code = str(line[TopN])
+        replace_dict = line[_header.replace_dict]
+        pre_code = " ".join(
+            list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
+        )
+        pre_code = fix_strings(pre_code)
+        spoc_code[i] = process_code(spoc_code[i], pre_code)
 
-            if line[3] in line[TopN : TopN + ARGS.top]:
-                continue
+    test_code = code_header + "\n".join(spoc_code)
 
-            replace_dict = eval(line[_header.replace_dict])
-            pre_code = " ".join(
-                list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
-            )
-            pre_code = fix_strings(pre_code)
-            spoc_code[i] = process_code(spoc_code[i], pre_code)
+    code_res = compile_and_run_tests(test_code, probid, subid)
+    cleanup(f"{probid}-{subid}")
+    return code_res
 
-        test_code = code_header + "\n".join(spoc_code)
 
-        code_res = compile_and_run_tests(test_code, probid, subid)
-        cleanup(f"{probid}-{subid}")
-        return code_res
+def check_all_code_topN_thread(is_test=False):
+    store = load_split(ARGS.split)
 
-    with ThreadPoolExecutor() as executor:
-        res = list(tqdm(executor.map(process_task, unique_id), total=len(unique_id)))
+    unique_id = list(store)
 
-    return res
+    if ARGS.test:
+        unique_id = unique_id[25:30]
 
+    return run_pool(all_code_task, unique_id, store)
 
-from codebleu.codebleu import calc_codebleu
 
-def calc_codebleu_thread(is_test=False):
-    split = ARGS.split
+from codebleu_scorer import CodeBLEUScorer
 
-    data = pd.read_csv(f"./data/{split}.csv")
-    code_header = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-    TopN = 10
+# CodeBLEU scorer of the worker, references parsed once per unique_id
+SCORER = None
 
-    unique_id = list(sorted(set(data["unique_id"].values.tolist())))
+def codebleu_tops():
+    return range(1, ARGS.top + 1) if ARGS.codebleu_per_k else [ARGS.top]
 
-    if ARGS.test:
-        unique_id = unique_id[20:80]
 
-    def process_task(uid):
-        temp_data = data[data["unique_id"] == uid].sort_values(
-            by="line", ascending=True
+def codebleu_task(uid, rows):
+    """
+    CodeBLEU of the top ARGS.top variant of a problem (of every top 1 ..
+    ARGS.top variant with --codebleu-per-k): a line keeps the reference code
+    if it is among the top k predictions, otherwise it takes the top 1
+    prediction. All variants are scored against the same cached reference.
+    """
+    global SCORER
+    if SCORER is None:
+        SCORER = CodeBLEUScorer("c_sharp", weights=(0.25, 0.25, 0.25, 0.25))
+    TopN = 10
+    reference = [row[_header.code] for row in rows]
+    temp_data_list = rows
+
+    index_pre = [
+        i for i, row in enumerate(rows) if row[_header.text_v] != "DUMMY"
+    ]
+    # top 1 prediction of every predicted line
+    top1 = {}
+    for i in index_pre:
+        line = temp_data_list[i]
+        pre_code = line[TopN]
+        replace_dict = line[_header.replace_dict]
+        pre_code = " ".join(
+            list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
         )
-        prediction = temp_data.code.values.tolist()
-        reference = temp_data.code.values.tolist()
-        temp_data_list = temp_data.values.tolist()
-
-        probid, subid, workerid = uid.split("-")
-        subid = f"{subid}-{workerid}"
-        index_pre = [
-            i for i, x in enumerate(temp_data.text_v.values.tolist()) if x != "DUMMY"
-        ]
+        pre_code = fix_strings(pre_code)
+        top1[i] = process_code(reference[i], pre_code)
+
+    results = []
+    # variant -> scores, identical variants are scored once
+    scored = {}
+    for top in codebleu_tops():
+        prediction = list(reference)
         for i in index_pre:
             line = temp_data_list[i]
-            pre_code = line[TopN]
-            if line[3] in line[TopN : TopN + ARGS.top]:
-                continue
-            replace_dict = eval(line[_header.replace_dict])
-            pre_code = " ".join(
-                list(map(lambda x: replace_dict.get(x, x), pre_code.split()))
-            )
-            pre_code = fix_strings(pre_code)
-            prediction[i] = process_code(prediction[i], pre_code)
-
-        result = calc_codebleu(
-            [" ".join(reference)],
-            [" ".join(prediction)],
-            lang="c_sharp",
-            weights=(0.25, 0.25, 0.25, 0.25),
-            tokenizer=None,
-        )
+            if line[3] not in line[TopN : TopN + top]:
+                prediction[i] = top1[i]
+        prediction = " ".join(prediction)
+        if prediction not in scored:
+            scored[prediction] = SCORER.score(uid, " ".join(reference), prediction)
+        results.append(scored[prediction])
 
-        return result
+    return results
 
-    with ThreadPoolExecutor() as executor:
-        res = list(tqdm(executor.map(process_task, unique_id), total=len(unique_id)))
 
-    return res
+def calc_codebleu_thread(is_test=False):
+    store = load_split(ARGS.split)
+
+    unique_id = list(store)
+
+    if ARGS.test:
+        unique_id = unique_id[20:80]
+
+    return run_pool(codebleu_task, unique_id, store)
 
 
 def main():
@@ -636,11 +658,33 @@ def main():
     parser.add_argument("-a", "--all", action="store_true", help="Test all translation results")
     parser.add_argument("-T", "--top", type=int, default=1, help="Calculate top N")
     parser.add_argument("-B", "--codebleu", action="store_true", help="Calculate codebleu")
+    parser.add_argument("--codebleu-per-k", action="store_true", help="With -B, print the codebleu of every top k up to --top")
     parser.add_argument("--timeout",type=int,default=2,help="Timeout for execution (in seconds)")
     parser.add_argument("--gcc-timeout",type=int, default=30, help="Timeout for compilation (in seconds)")
-
-    global ARGS
-    ARGS = parser.parse_args()
+    parser.add_argument("--cache-dir", default="./out/cache", help="Directory of the persistent compile-result cache")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the compile-result cache")
+    parser.add_argument("--cache-binaries", action="store_true", help="Also keep the compiled binaries in the cache (unbounded disk usage)")
+    parser.add_argument("--pch", action="store_true", help="Compile with a precompiled bits/stdc++.h")
+    parser.add_argument("--pch-dir", default="./out/pch", help="Directory of the precompiled header")
+
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--task-timeout", type=int, default=3600, help="Stop the run when a problem takes longer (in seconds, 0 to disable)")
+    parser.add_argument("--prog-dir", default="./data/testcases", help="Path to the test cases")
+    parser.add_argument("--testcase-cache", default=None, help="Directory of the binary test case index shared by the workers")
+    parser.add_argument("--split-cache", default="./out/data", help="Directory of the pre-parsed split stores")
+    parser.add_argument("--eval-socket", default=None, help="Compile and test through the service listening on this Unix socket (see service.py)")
+    parser.add_argument("-P", "--preprocess", action="store_true", help="Only convert the split csv to the pre-parsed store")
+
+    args = parser.parse_args()
+    # workers run in their own scratch directories
+    args.prog_dir = os.path.abspath(args.prog_dir)
+    init_worker(args)
+
+    if ARGS.preprocess:
+        store = build_split_store(f"./data/{ARGS.split}.csv")
+        save_pickle(os.path.join(ARGS.split_cache, f"{ARGS.split}.pkl"), store)
+        print(f"{ARGS.split}: {len(store)}个问题")
+        return
 
     if ARGS.line:
         res = check_line_code_topN_thread()
@@ -684,12 +728,16 @@ def main():
 
     if ARGS.codebleu:
         res = calc_codebleu_thread()
-        codebleu_list = []
-        bleu_list = []
-        for i in res:
-            codebleu_list.append(i["codebleu"])
-            bleu_list.append(i["ngram_match_score"])
-        print(np.mean(codebleu_list))
+        for k, top in enumerate(codebleu_tops()):
+            codebleu_list = []
+            bleu_list = []
+            for i in res:
+                codebleu_list.append(i[k]["codebleu"])
+                bleu_list.append(i[k]["ngram_match_score"])
+            if ARGS.codebleu_per_k:
+                print(f"top{top} CodeBLEU: {np.mean(codebleu_list)}")
+            else:
+                print(np.mean(codebleu_list))
 
 
 if __name__ == "__main__":
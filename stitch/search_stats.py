@@ -0,0 +1,113 @@
+import os
+import json
+import glob
+import argparse
+from collections import Counter, defaultdict
+
+"""
+    Aggregate the search event logs ([method].jsonl, see stitch.SearchLog)
+    of a whole stitching run:
+
+        python stitch/search_stats.py ./out
+
+    Time per phase is summed over all programs. Compiling and testing of
+    speculative slots overlap, so the phases may add up to more than the
+    wall time of a program.
+"""
+
+# phases of an iteration and the event fields holding their seconds
+PHASES = [
+    ("precheck", "precheck_time"),
+    ("search", "search_time"),
+    ("compile", "compile_time"),
+    ("test", "test_time"),
+    ("detect", "detect_time"),
+    ("prefix", "prefix_time"),
+]
+
+ERRORS = ["no_err", "compile_err", "runtime_err", "mismatch_err"]
+
+
+class MethodStats(object):
+    def __init__(self):
+        self.programs = 0
+        self.wall = 0.0
+        self.iterations = 0
+        self.skipped = 0
+        self.phases = Counter()
+        self.results = Counter()
+        self.errors = Counter()
+        self.panics = 0
+        self.dropped = 0
+
+    def add(self, path):
+        self.programs += 1
+        last_time = 0.0
+        with open(path) as fin:
+            for line in fin:
+                event = json.loads(line)
+                last_time = event["time"]
+                # phase times are at the top level or in the detector decision
+                for sub in (event, event.get("detect"), event.get("prefix")):
+                    if sub:
+                        for phase, field in PHASES:
+                            self.phases[phase] += sub.get(field, 0.0)
+                if event["event"] == "iter":
+                    self.iterations += 1
+                    self.errors[ERRORS[event["error"]]] += 1
+                elif event["event"] == "skip":
+                    self.skipped += 1
+                elif event["event"] == "end":
+                    self.results[event["result"]] += 1
+                    self.dropped += event.get("dropped_subspaces", 0)
+                elif event["event"] == "panic":
+                    self.panics += 1
+        self.wall += last_time
+
+    def report(self, method):
+        solved = self.results["public"] + self.results["hidden"]
+        print(
+            "{}: {} programs, {} passed public, {} passed hidden, {} iterations, {} skipped".format(
+                method, self.programs, solved, self.results["hidden"], self.iterations, self.skipped
+            )
+        )
+        print("  {:<10}{:>12}{:>9}{:>14}".format("phase", "seconds", "share", "per iteration"))
+        rows = [(phase, self.phases[phase]) for phase, _ in PHASES if self.phases[phase]]
+        rows.append(("other", max(0.0, self.wall - sum(seconds for _, seconds in rows))))
+        rows.append(("wall", self.wall))
+        for phase, seconds in rows:
+            print(
+                "  {:<10}{:>12.3f}{:>8.1f}%{:>14.4f}".format(
+                    phase,
+                    seconds,
+                    100.0 * seconds / self.wall if self.wall else 0.0,
+                    seconds / self.iterations if self.iterations else 0.0,
+                )
+            )
+        print("  results: " + ", ".join("{} {}".format(k, v) for k, v in sorted(self.results.items())))
+        print("  verdicts: " + ", ".join("{} {}".format(k, self.errors[k]) for k in ERRORS))
+        if self.panics:
+            print("  panics: {}".format(self.panics))
+        if self.dropped:
+            print("  dropped subspaces (--max-heap): {}".format(self.dropped))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_dir", help="Output directory of stitch.py (one directory per program)")
+    parser.add_argument("-m", "--method", default=None, help="Only report this search (e.g. best_first)")
+    args = parser.parse_args()
+
+    stats = defaultdict(MethodStats)
+    for path in sorted(glob.glob(os.path.join(args.out_dir, "*", "*.jsonl"))):
+        method = os.path.splitext(os.path.basename(path))[0]
+        if args.method is None or method == args.method:
+            stats[method].add(path)
+    if not stats:
+        print("No event logs found in {}".format(args.out_dir))
+    for method in sorted(stats):
+        stats[method].report(method)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import os
+import json
+import signal
+import socket
+import asyncio
+import hashlib
+import argparse
+import itertools
+import threading
+from functools import partial
+from concurrent.futures import Future
+
+from utils import EvalPool, init_job_worker, run_job
+
+"""
+    Compile-and-test service
+
+    One long-lived process owns a pool of warmed-up workers (parsed test
+    cases, precompiled header) and serves the stitchers and evaluators:
+
+        python stitch/service.py --socket ./out/eval.sock -j 16 --pch-dir ./out/pch
+
+    Protocol (Unix socket, one JSON document per line):
+      request:  {"id": 1, "code": "...", "probid": "1A", "suites": [...],
+                 "timeout": 2, "std": "c++03", "name": "1A-2", "gcc_timeout": 30}
+                or a list of such requests (timeout, std, name and gcc_timeout
+                are optional; name is the file name shown in the compiler
+                messages, gcc_timeout defaults to --gcc-timeout of the service)
+      response: {"id": 1, "verdict": {...}}  (see utils.run_job), or
+                {"id": 1, "error": "..."}
+    Responses are streamed in completion order, not in request order.
+"""
+
+
+class EvalService(object):
+    """
+    asyncio front end of an EvalPool running utils.run_job.
+    Identical requests in flight share one job, whatever their names: the job
+    compiles as job-[key] and each caller gets its own name back in the
+    compiler messages.
+    """
+
+    def __init__(self, workers=None, prog_dir="./data/testcases", testcase_cache=None,
+                 pch_dir=None, gcc_timeout=30):
+        self.pool = EvalPool(
+            workers,
+            init_job_worker,
+            (
+                os.path.abspath(prog_dir),
+                testcase_cache and os.path.abspath(testcase_cache),
+                pch_dir and os.path.abspath(pch_dir),
+                gcc_timeout,
+            ),
+        )
+        # request key -> asyncio future of the running job
+        self.inflight = {}
+        self.num_requests = 0
+        self.num_deduplicated = 0
+
+    @staticmethod
+    def key(code, probid, suites, timeout, std, gcc_timeout):
+        return hashlib.sha1(
+            json.dumps([code, probid, list(suites), timeout, std, gcc_timeout]).encode("utf8")
+        ).hexdigest()
+
+    async def evaluate(self, code, probid, suites, timeout=2, std=None, name="job", gcc_timeout=None):
+        """
+        Return the verdict dict of one program (see utils.run_job).
+        """
+        self.num_requests += 1
+        key = self.key(code, probid, suites, timeout, std, gcc_timeout)
+        job_name = "job-" + key[:16]
+        future = self.inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.pool.executor,
+                partial(run_job, code, probid, list(suites), timeout, std, job_name, gcc_timeout=gcc_timeout),
+            )
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.num_deduplicated += 1
+        # one cancelled waiter must not cancel the shared job
+        verdict = await asyncio.shield(future)
+        if verdict["compile_errors"] is not None and job_name != name:
+            # the stitchers strip "[name].cpp" from the messages
+            verdict = dict(
+                verdict, compile_errors=verdict["compile_errors"].replace(job_name, name)
+            )
+        return verdict
+
+    async def _reply(self, request, writer, lock):
+        request_id = request.pop("id", None)
+        try:
+            message = {"id": request_id, "verdict": await self.evaluate(**request)}
+        except Exception as e:
+            message = {"id": request_id, "error": "{}: {}".format(type(e).__name__, e)}
+        async with lock:
+            writer.write(json.dumps(message).encode("utf8") + b"\n")
+            await writer.drain()
+
+    async def handle(self, reader, writer):
+        """
+        Serve one client connection; requests are evaluated concurrently.
+        """
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                requests = json.loads(line)
+                if isinstance(requests, dict):
+                    requests = [requests]
+                for request in requests:
+                    task = asyncio.ensure_future(self._reply(request, writer, lock))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        server = await asyncio.start_unix_server(self.handle, path=path, limit=1 << 26)
+        print("Serving on {} with {} workers".format(path, self.pool.num_workers))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.__exit__(None, None, None)
+
+
+class EvalClient(object):
+    """
+    Blocking, thread-safe client of an EvalService socket.
+
+        client = EvalClient("./out/eval.sock")
+        futures = client.submit_batch([dict(code=..., probid=..., suites=[...])])
+        verdict = futures[0].result()
+
+    The verdicts come back as they complete; a reader thread resolves the
+    concurrent.futures.Future of each request.
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.wfile = self.sock.makefile("wb")
+        self.rfile = self.sock.makefile("rb")
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.ids = itertools.count()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def submit_batch(self, requests):
+        """
+        Send a list of request dicts (code, probid, suites[, timeout, std, name, gcc_timeout])
+        at once. Return their futures in the same order.
+        """
+        futures, batch = [], []
+        with self.lock:
+            for request in requests:
+                request_id = next(self.ids)
+                future = Future()
+                self.futures[request_id] = future
+                futures.append(future)
+                batch.append(dict(request, id=request_id))
+            self.wfile.write(json.dumps(batch).encode("utf8") + b"\n")
+            self.wfile.flush()
+        return futures
+
+    def submit(self, code, probid, suites, timeout=2, std=None, name="job", gcc_timeout=None):
+        request = dict(
+            code=code,
+            probid=probid,
+            suites=list(suites),
+            timeout=timeout,
+            std=std,
+            name=name,
+            gcc_timeout=gcc_timeout,
+        )
+        return self.submit_batch([request])[0]
+
+    def evaluate(self, code, probid, suites, timeout=2, std=None, name="job", gcc_timeout=None):
+        return self.submit(code, probid, suites, timeout, std, name, gcc_timeout).result()
+
+    def _read(self):
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                with self.lock:
+                    future = self.futures.pop(message["id"], None)
+                if future is None:
+                    continue
+                if "error" in message:
+                    future.set_exception(RuntimeError(message["error"]))
+                else:
+                    future.set_result(message["verdict"])
+        finally:
+            with self.lock:
+                pending, self.futures = self.futures, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError("evaluation service closed"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default="./out/eval.sock", help="Path of the Unix socket to serve on")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--prog-dir", default="./data/testcases", help="Path to the test cases")
+    parser.add_argument("--testcase-cache", default=None, help="Directory of the binary test case index")
+    parser.add_argument("--pch-dir", default=None, help="Compile with precompiled headers kept in this directory")
+    parser.add_argument("--gcc-timeout", type=int, default=30, help="Timeout for compilation (in seconds)")
+    args = parser.parse_args()
+
+    service = EvalService(
+        args.workers, args.prog_dir, args.testcase_cache, args.pch_dir, args.gcc_timeout
+    )
+    # shut the workers down on kill as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(service.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        print(
+            "{} requests, {} deduplicated".format(
+                service.num_requests, service.num_deduplicated
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import csv, os, sys, math, time
+import csv, io, os, re, sys, json, math, time
 import argparse
 import heapq
 import subprocess
 from enum import Enum
 import itertools
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import PrecompiledHeader, TestcaseStore, EvalPool, run_suites, fix_strings
+from utils import SuiteReport
 
 
 # Global arguments
 ARGS = None
+# Precompiled bits/stdc++.h, None if disabled
+PCH = None
+# Parsed test cases, memoized per problem id
+TESTCASES = None
+# Client of the compile-and-test service (service.py), None to run locally
+SERVICE = None
 
 
 LINE_OFFSET = 5
 SCORE_THRES = 1e6
-ERR_BLACK_AMOUNT = -1e6
 
 # indices in the respective tsv_files
 class _inp:
@@ -56,60 +65,6 @@ class pass_test:
 # Helper methods
 
 
-# UTOOLS 修复字符串
-def fix_strings(inp):
-    res = ""
-    temp_string = ""
-    inside = False
-    for i in range(len(inp)):
-        if not inside:
-            res += inp[i]
-            if inp[i] == '"':
-                inside = True
-            continue
-        if inside:
-            if inp[i] == '"':
-                inside = False
-                if (
-                    len(temp_string) > 2
-                    and temp_string[0] == " "
-                    and temp_string[-1] == " "
-                ):
-                    res += temp_string[1:-1]
-                else:
-                    res += temp_string
-                res += '"'
-                temp_string = ""
-            else:
-                temp_string += inp[i]
-    inp = res
-    res = ""
-    temp_string = ""
-    inside = False
-    for i in range(len(inp)):
-        if not inside:
-            res += inp[i]
-            if inp[i] == "'":
-                inside = True
-            continue
-        if inside:
-            if inp[i] == "'":
-                inside = False
-                if (
-                    len(temp_string) > 2
-                    and temp_string[0] == " "
-                    and temp_string[-1] == " "
-                ):
-                    res += temp_string[1:-1]
-                else:
-                    res += temp_string
-                res += "'"
-                temp_string = ""
-            else:
-                temp_string += inp[i]
-    return res
-
-
 # UTOOLS 编译代码
 def compile_code(code, probid, subid, compile_only=False):
     """
@@ -121,12 +76,15 @@ def compile_code(code, probid, subid, compile_only=False):
     with open(unique_id + ".cpp", "w") as src_file:
         src_file.write(code)
 
+    pch_flags = PCH.compile_flags() if PCH is not None else ""
     if not compile_only:
-        command = "timeout {} g++ {}.cpp -o {}".format(
-            ARGS.gcc_timeout + 1, unique_id, unique_id
+        command = "timeout {} g++ {}{}.cpp -o {}".format(
+            ARGS.gcc_timeout + 1, pch_flags, unique_id, unique_id
         )
     else:
-        command = "timeout {} g++ {}.cpp -c".format(ARGS.gcc_timeout + 1, unique_id)
+        command = "timeout {} g++ {}{}.cpp -c".format(
+            ARGS.gcc_timeout + 1, pch_flags, unique_id
+        )
 
     try:
         process = subprocess.run(
@@ -135,13 +93,32 @@ def compile_code(code, probid, subid, compile_only=False):
     except subprocess.TimeoutExpired:
         return "g++ timeout!"
 
+    if PCH is not None:
+        PCH.check(process.stderr.decode("utf8", "backslashreplace"))
     if process.returncode == 0:
         return None
     else:
         return process.stderr.decode("utf8", "backslashreplace")
 
 
+# Program outputs larger than this (and than the gold output) are mismatches
+BIG_FILE_THRESHOLD = 1000000
+
+TEST_SUITES = ["testcases_public", "testcases_hidden"]
+
+
 # UTOOLS 运行测试案例
+def report_errors(report):
+    """
+    Convert a SuiteReport to the error code and extra info.
+    """
+    if report.failed is None:
+        return err.no_err, None
+    if report.kind == "mismatch":
+        return err.mismatch_err, report.info
+    return err.runtime_err, report.info
+
+
 def run_tests(code, probid, subid, test_name):
     """
     Run the code on test cases.
@@ -149,81 +126,19 @@ def run_tests(code, probid, subid, test_name):
 
     Return the error code (no_err, runtime_err, or mismatch_err) and extra info.
 
-    Note: Does not clean up the files. Need to run cleanup afterwards.
+    Test cases come from TESTCASES (parsed once per problem), are fed
+    through pipes and the outputs are compared in memory.
 
     ENDINPUT:输输入
     ENDOUTPUT:输出
     """
-    unique_id = probid + "-" + subid
-    objfile = unique_id
-    inpfile = objfile + "_inp.txt"
-    outfile = objfile + "_out.txt"
-    prgfile = objfile + "_prg.txt"
-
-    input_file = open(inpfile, "w")
-    output_file = open(outfile, "w")
-
-    testcases = "{}/{}/{}_{}.txt".format(ARGS.prog_dir, probid, probid, test_name)
-    with open(testcases) as f:
-        contents = f.readlines()
-
-    error_code = err.no_err
-    error_info = None
-    num_test = 0
-    counter = 0
-    for line in contents:
-        if line == "###ENDINPUT###\n":
-            counter = 1
-            continue
-        if line == "###ENDOUTPUT###\n":
-            input_file.close()
-            output_file.close()
-            command = "timeout {} ./{} < {} > {}".format(
-                ARGS.timeout, objfile, inpfile, prgfile
-            )
-            process = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
-            if process.returncode != 0:
-                error_code = err.runtime_err
-                if process.returncode == 124:
-                    error_info = "Timeout {}"
-                else:
-                    error_info = process.stderr.decode("utf8", "backslashreplace")
-                break
-            # 比较
-            if not compare_files(outfile, prgfile):
-                error_code = err.mismatch_err
-                error_info = "Mismatch {}".format(num_test)
-                break
-            num_test += 1
-            counter = 0
-            input_file = open(inpfile, "w")
-            output_file = open(outfile, "w")
-            continue
-        if counter == 0:
-            input_file.write(line)
-        if counter == 1:
-            output_file.write(line)
-
-    input_file.close()
-    output_file.close()
-    return error_code, error_info
-
-
-BIG_FILE_THRESHOLD = 1000000
-
-
-# UTOOLS  比较两个文件内容是否相同
-def compare_files(outfile, prgfile):
-    # Don't read big files
-    if (
-        os.path.getsize(prgfile) > BIG_FILE_THRESHOLD
-        and os.path.getsize(outfile) < BIG_FILE_THRESHOLD
-    ):
-        return False
-    with open(outfile, "br") as fin:
-        outdata = fin.read()
-    with open(prgfile, "br") as fin:
-        return fin.read() == outdata
+    report = run_suites(
+        probid + "-" + subid,
+        [(test_name, TESTCASES.get(probid, test_name))],
+        ARGS.timeout,
+        big_output=BIG_FILE_THRESHOLD,
+    )
+    return report_errors(report)
 
 
 # UTOOLS 清除文件
@@ -444,22 +359,340 @@ def detailed_oracle(inp_stmt, pred_stmt, probid, subid):
     log_file.close()
 
 
+################################################
+# Program assembly
+
+
+class ProgramAssembler(object):
+    """
+    Build the programs of one problem from index vectors.
+
+    The indentation and the braces inserted before each line only depend on
+    the indents and on whether the previous line ends with "{", so both
+    variants of every prefix are computed once. fix_strings is applied once
+    per (line, candidate). idx[k] is the candidate of the k-th non-DUMMY line.
+
+    If fixed_prev is set, "the previous line ends with {" is decided on the
+    fix_strings output instead of the raw prediction (as stitch_error_detect does).
+    """
+
+    HEADER = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
+
+    def __init__(self, inp_stmt, pred_stmt, fixed_prev=False):
+        self.inp_stmt = inp_stmt
+        self.pred_stmt = pred_stmt
+        self.fixed_prev = fixed_prev
+        # indents[stmt_idx]
+        self.indents = [int(inp[_inp.indent]) for inp in inp_stmt]
+        # prefixes[stmt_idx][prev_opens]
+        self.prefixes = []
+        # stmt_idx of the k-th non-DUMMY line
+        self.pred_positions = []
+        # (text, opens) of the DUMMY lines, None for predicted lines
+        self.dummies = []
+        curr_ind = 0
+        for stmt_idx, (inp, pred) in enumerate(zip(inp_stmt, pred_stmt)):
+            tmp_ind = self.indents[stmt_idx]
+            indent = "\t" * tmp_ind
+            opening = ""
+            if tmp_ind < curr_ind:
+                if inp[_inp.code] != "}":
+                    indent += "} "
+                if curr_ind - tmp_ind > 1:
+                    indent += (curr_ind - tmp_ind - 1) * "} "
+            elif tmp_ind > curr_ind:
+                opening = "{ "
+                if tmp_ind - curr_ind > 1:
+                    indent += (tmp_ind - curr_ind - 1) * "{ "
+            curr_ind = tmp_ind
+            # prefixes[stmt_idx][False]: previous line does not end with "{"
+            self.prefixes.append(
+                ("\t" * tmp_ind + opening + indent[tmp_ind:], indent)
+            )
+            if pred[_pred.text] == "DUMMY":
+                code = inp[_inp.code]
+                self.dummies.append((code + "\n", self.opens(code)))
+            else:
+                self.pred_positions.append(stmt_idx)
+                self.dummies.append(None)
+        # candidates[k][cand] = (line text, opens) computed lazily
+        self.candidates = [{} for _ in self.pred_positions]
+
+    @staticmethod
+    def opens(line):
+        """
+        Whether the next line must not get an extra "{ ".
+        """
+        return bool(line) and line[-1] == "{"
+
+    def candidate(self, k, cand):
+        """
+        Return (line text, raw prediction, fixed prediction, opens) of
+        candidate cand of the k-th non-DUMMY line.
+        """
+        res = self.candidates[k].get(cand)
+        if res is None:
+            stmt_idx = self.pred_positions[k]
+            raw = self.pred_stmt[stmt_idx][_pred.pred_best + cand]
+            fixed = fix_strings(raw)
+            text = fixed + " // " + self.inp_stmt[stmt_idx][_inp.text] + "\n"
+            res = (text, raw, fixed, self.opens(fixed if self.fixed_prev else raw))
+            self.candidates[k][cand] = res
+        return res
+
+    def _parts(self, idx, upto=None):
+        """
+        Yield the pieces of the program for stmt_idx in [0, upto].
+        """
+        prev_opens = False
+        k = 0
+        last = len(self.prefixes) - 1 if upto is None else upto
+        for stmt_idx in range(last + 1):
+            yield self.prefixes[stmt_idx][prev_opens]
+            dummy = self.dummies[stmt_idx]
+            if dummy is not None:
+                text, prev_opens = dummy
+            else:
+                text, _, _, prev_opens = self.candidate(k, idx[k])
+                k += 1
+            yield text
+
+    def build(self, idx):
+        """
+        Return the full program for the index vector idx.
+        """
+        return self.HEADER + "".join(self._parts(idx))
+
+    def code_lines(self, idx):
+        """
+        Return [(pseudocode, code, indent)] for the error detectors.
+        """
+        code_lines = []
+        k = 0
+        for stmt_idx, inp in enumerate(self.inp_stmt):
+            if self.dummies[stmt_idx] is not None:
+                code = inp[_inp.code]
+            else:
+                code = self.candidate(k, idx[k])[2]
+                k += 1
+            code_lines.append((inp[_inp.text], code, self.indents[stmt_idx]))
+        return code_lines
+
+    def prefix(self, idx, mid_idx):
+        """
+        Return the program up to the mid_idx-th non-DUMMY line, closed with
+        enough braces to be compiled on its own (used by prefix pruning).
+        """
+        last = self.pred_positions[mid_idx]
+        code = self.HEADER + "".join(self._parts(idx, last))
+        prev_line = self.candidate(mid_idx, idx[mid_idx])[1]
+        curr_ind = self.indents[last]
+        next_ind = self.indents[last + 1] if last + 1 < len(self.indents) else 0
+
+        if not prev_line or prev_line[-1] == "{":
+            code += "} "
+        if (
+            not prev_line
+            or (
+                (
+                    prev_line.startswith("while")
+                    or prev_line.startswith("for")
+                    or prev_line.startswith("if")
+                    or prev_line.startswith("else")
+                )
+                and prev_line[-1] == ")"
+            )
+            or prev_line.startswith("else")
+        ):
+            code += "{ }"
+        if curr_ind == 0 and next_ind == 1:
+            code += "{ }"
+        code += curr_ind * "} "
+        return code
+
+
+################################################
+# Syntax pre-check
+
+# string / char literals, multi-character operators, words, single characters
+_LINE_TOKEN = re.compile(
+    r'"(?:\\.|[^"\\])*"|'
+    r"'(?:\\.|[^'\\])*'|"
+    r"<<=|>>=|->|::|\+\+|--|<<|>>|&&|\|\||[-+*/%&|^!=<>]=|"
+    r"\w+|\S"
+)
+_CLOSING = {")": "(", "]": "["}
+# operators that cannot end a statement; only checked right before ";",
+# since an expression may go on in the next line ("cout << a <<")
+_DANGLING = {
+    "+", "-", "/", "%", "=", "^", "|", "!", "~", "?", ",", ".", "->", "::",
+    "<<", ">>", "&&", "||", "==", "!=", "<=", ">=",
+    "+=", "-=", "*=", "/=", "%=", "&=", "|=", "^=", "<<=", ">>=",
+}
+
+
+def check_line_syntax(line, indent):
+    """
+    Cheap syntax check of one candidate line (after fix_strings).
+    indent is the number of braces open before the line.
+    Return None if the line may be valid, otherwise the reason.
+    """
+    if line.lstrip().startswith("#"):
+        return None
+    stack = []
+    depth = 0
+    tokens = _LINE_TOKEN.findall(line)
+    for token in tokens:
+        if token in ('"', "'"):
+            return "unterminated literal"
+        elif token in ("(", "["):
+            stack.append(token)
+        elif token in _CLOSING:
+            if not stack or stack.pop() != _CLOSING[token]:
+                return "unmatched " + token
+        elif token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth < -indent:
+                return "unmatched }"
+    if stack:
+        return "unclosed " + stack[-1]
+    for i in range(1, len(tokens)):
+        if tokens[i] == ";" and tokens[i - 1] in _DANGLING and (i < 2 or tokens[i - 2] != "operator"):
+            return "dangling " + tokens[i - 1]
+    return None
+
+
+class LinePrecheck(object):
+    """
+    Verdicts of check_line_syntax for every candidate of one problem.
+
+    Identical candidates at the same indentation are checked once.
+    blacklist[k] is the set of rejected candidates of the k-th non-DUMMY
+    line; a line whose candidates are all rejected is not pruned.
+    The rejected candidates are listed in precheck.txt.
+    """
+
+    def __init__(self, assembler, num_preds):
+        self.verdicts = {}
+        self.blacklist = []
+        self.num_rejected = 0
+        with open("precheck.txt", "w") as fout:
+            for k, stmt_idx in enumerate(assembler.pred_positions):
+                indent = assembler.indents[stmt_idx]
+                rejected = {}
+                for cand in range(num_preds):
+                    fixed = assembler.candidate(k, cand)[2]
+                    key = (fixed, indent)
+                    if key not in self.verdicts:
+                        self.verdicts[key] = check_line_syntax(fixed, indent)
+                    if self.verdicts[key] is not None:
+                        rejected[cand] = self.verdicts[key]
+                if len(rejected) == num_preds:
+                    rejected = {}
+                for cand, reason in sorted(rejected.items()):
+                    fout.write(
+                        "{}\t{}\t{}\t{}\n".format(
+                            k, cand, reason, assembler.candidate(k, cand)[2]
+                        )
+                    )
+                self.blacklist.append(set(rejected))
+                self.num_rejected += len(rejected)
+
+
+################################################
+# Search telemetry
+
+
+class SearchLog(object):
+    """
+    Buffered JSON-lines event log of one search, [method].jsonl in the
+    program directory (see search_stats.py for the aggregation).
+
+    Every event is a dict with "event" and "time" (seconds since the
+    program started). Events are written buffer_size at a time and when
+    the log is closed, so logging costs no syscall per iteration.
+    """
+
+    def __init__(self, method, buffer_size=1000):
+        self.method = method
+        self.buffer_size = buffer_size
+        self.events = []
+        self.file = open(method + ".jsonl", "w")
+
+    def write(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = round(time.time() - START_TIME, 6)
+        self.events.append(json.dumps(fields))
+        if len(self.events) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            self.file.write("\n".join(self.events) + "\n")
+            self.events = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.write(
+                "panic",
+                error="{}: {}".format(exc_type.__name__, exc_value),
+                traceback="".join(traceback.format_exception(exc_type, exc_value, tb)),
+            )
+        self.close()
+
+
 ################################################
 # Stitchers
 
 
-def compile_and_run_tests(code, probid, subid, iter_count):
+def compile_and_run_tests(code, probid, subid, iter_count, timing=None):
     """
     Compile the code, run on public and hidden test cases, then clean up.
+    Both suites run in one session which stops at the first failing case.
     Return (pass_test code, err code, extra_info).
+    The seconds spent compiling and testing go to timing["compile"] and
+    timing["test"] when a dict is given.
     """
     unique_id = probid + "-" + subid
+    if timing is None:
+        timing = {}
+    timing["compile"], timing["test"] = 0.0, 0.0
     if ARGS.verbose:
         with open("verbose-{:05d}".format(iter_count), "w") as fout:
             fout.write(code)
             fout.write("###############################\n")
-    # generate c++
-    compile_errors = compile_code(code, probid, subid)
+    start = time.time()
+    if SERVICE is not None:
+        # the source stays at [probid]-[subid].cpp as with compile_code
+        with open(unique_id + ".cpp", "w") as src_file:
+            src_file.write(code)
+        # compile and run in the shared evaluation service
+        verdict = SERVICE.evaluate(
+            code,
+            probid,
+            TEST_SUITES,
+            timeout=ARGS.timeout,
+            name=unique_id,
+            gcc_timeout=ARGS.gcc_timeout,
+        )
+        compile_errors = verdict["compile_errors"]
+        report = SuiteReport.from_dict(verdict)
+        # the waiting time of the request counts as testing
+        timing["compile"] = verdict["compile_time"]
+        timing["test"] = time.time() - start - timing["compile"]
+    else:
+        # generate c++
+        compile_errors = compile_code(code, probid, subid)
+        timing["compile"] = time.time() - start
     if compile_errors is not None:
         if ARGS.verbose:
             print("{}: Compilation fails!".format(iter_count))
@@ -469,51 +702,45 @@ def compile_and_run_tests(code, probid, subid, iter_count):
                 fout.write(compile_errors)
         cleanup(unique_id)
         return pass_test.none, err.compile_err, compile_errors
-    # run public test cases
-    test_errors, test_error_info = run_tests(code, probid, subid, "testcases_public")
-    if test_errors != err.no_err:
-        if ARGS.verbose:
-            if test_errors == err.runtime_err:
-                print("{}: Public test runtime error".format(iter_count))
-            else:
-                print("{}: Public test mismatch".format(iter_count))
-            with open("verbose-{:05d}".format(iter_count), "a") as fout:
-                fout.write("\n\n@@@ {} {}\n".format(pass_test.none, test_errors))
-                fout.write("Error: {}\n".format(test_error_info))
-                with open(unique_id + "_inp.txt", "br") as fin:
-                    fout.write("Input: {}\n".format(repr(fin.read())))
-                with open(unique_id + "_out.txt", "br") as fin:
-                    fout.write("Gold: {}\n".format(repr(fin.read())))
-                with open(unique_id + "_prg.txt", "br") as fin:
-                    fout.write("Pred: {}\n".format(repr(fin.read())[:2000]))
-        cleanup(unique_id)
-        return pass_test.none, test_errors, test_error_info
-    # run hidden test cases
-    test_errors, test_error_info = run_tests(code, probid, subid, "testcases_hidden")
-    if test_errors != err.no_err:
-        if ARGS.verbose:
+    if SERVICE is None:
+        # run public then hidden test cases
+        start = time.time()
+        report = run_suites(
+            unique_id,
+            [(test_name, TESTCASES.get(probid, test_name)) for test_name in TEST_SUITES],
+            ARGS.timeout,
+            big_output=BIG_FILE_THRESHOLD,
+        )
+        timing["test"] = time.time() - start
+    test_errors, test_error_info = report_errors(report)
+    passed = pass_test.both
+    if report.failed == "testcases_public":
+        passed = pass_test.none
+    elif report.failed == "testcases_hidden":
+        passed = pass_test.public
+    if ARGS.verbose:
+        if test_errors != err.no_err:
+            suite = "Public" if passed == pass_test.none else "Hidden"
             if test_errors == err.runtime_err:
-                print("{}: Hidden test runtime error".format(iter_count))
+                print("{}: {} test runtime error".format(iter_count, suite))
             else:
-                print("{}: Hidden test mismatch".format(iter_count))
-            with open("verbose-{:05d}".format(iter_count), "a") as fout:
-                fout.write("\n\n@@@ {} {}\n".format(pass_test.public, test_errors))
-                fout.write("Error: {}\n".format(test_error_info))
-                with open(unique_id + "_inp.txt", "br") as fin:
-                    fout.write("Input: {}\n".format(repr(fin.read())))
-                with open(unique_id + "_out.txt", "br") as fin:
-                    fout.write("Gold: {}\n".format(repr(fin.read())))
-                with open(unique_id + "_prg.txt", "br") as fin:
-                    fout.write("Pred: {}\n".format(repr(fin.read())[:2000]))
-        cleanup(unique_id)
-        return pass_test.public, test_errors, test_error_info
-    # success!
-    if ARGS.verbose:
-        print("{}: Succeeded!".format(iter_count))
+                print("{}: {} test mismatch".format(iter_count, suite))
+        else:
+            print("{}: Succeeded!".format(iter_count))
         with open("verbose-{:05d}".format(iter_count), "a") as fout:
-            fout.write("\n\n@@@ {} {}\n".format(pass_test.both, err.no_err))
+            fout.write("\n\n@@@ {} {}\n".format(passed, test_errors))
+            if test_errors != err.no_err:
+                inp, out, prg = report.case
+                fout.write("Error: {}\n".format(test_error_info))
+                fout.write("Input: {}\n".format(repr(inp)))
+                fout.write("Gold: {}\n".format(repr(out)))
+                fout.write("Pred: {}\n".format(repr(prg)[:2000]))
+            for test_name, num_test, wall, cpu in report.timings:
+                fout.write(
+                    "{} #{}: wall {:.3f}s cpu {:.3f}s\n".format(test_name, num_test, wall, cpu)
+                )
     cleanup(unique_id)
-    return pass_test.both, err.no_err, None
+    return passed, test_errors, test_error_info
 
 
 def stitch_top1(inp_stmt, pred_stmt, probid, subid):
@@ -561,107 +788,121 @@ def stitch_top1(inp_stmt, pred_stmt, probid, subid):
 # Gibbs sampling
 
 
+# Stop sampling after this many rounds without a new program
+GIBBS_MAX_STALL = 1000
+
+
 def stitch_gibbs(inp_stmt, pred_stmt, probid, subid, thres=0.8, smooth=0.5):
+    """
+    Run ARGS.chains chains of random single-line updates over the lines
+    whose top 1 prob is below thres (the others keep the top 1).
+    Each round, every chain resamples one random line (uniformly with
+    prob smooth, else from the line's distribution) and the programs not
+    seen before are compiled and tested concurrently, in chain order.
+    """
     import numpy as np
 
-    sampled_idx = []
-    prob_list = []
-    # store the probabilities of the lines to be sampled in prob_list and
-    # generate initial random indices for the lines to be sampled in sampled_idx
-    for inp, pred in zip(inp_stmt, pred_stmt):
-        curr_prob_list = []
-        if (
-            pred[_pred.text] != "DUMMY"
-            and math.exp(float(pred[_pred.pred_score])) < thres
-        ):
-            for i in range(
-                _pred.pred_best + ARGS.num_preds, _pred.pred_best + 2 * ARGS.num_preds
+    # only the lines below thres are sampled, the others use the top 1
+    assembler = ProgramAssembler(inp_stmt, pred_stmt)
+    sampled_lines = [
+        k
+        for k, stmt_idx in enumerate(assembler.pred_positions)
+        if math.exp(float(pred_stmt[stmt_idx][_pred.pred_score])) < thres
+    ]
+    # cumulative distribution of the candidates of each sampled line
+    cum_probs = np.zeros((len(sampled_lines), ARGS.num_preds))
+    for row, k in enumerate(sampled_lines):
+        pred = pred_stmt[assembler.pred_positions[k]]
+        log_probs = np.array(
+            pred[_pred.pred_best + ARGS.num_preds : _pred.pred_best + 2 * ARGS.num_preds],
+            dtype=float,
+        )
+        probs = np.exp(log_probs)
+        cum_probs[row] = np.cumsum(probs / probs.sum())
+
+    def resample(lines):
+        # one new candidate for each (chain, line) in lines
+        uniform = np.random.randint(ARGS.num_preds, size=lines.shape)
+        coin_toss = np.random.uniform(0, 1, lines.shape)
+        draws = np.random.uniform(0, 1, lines.shape)
+        weighted = (draws[..., None] > cum_probs[lines]).sum(-1)
+        return np.where(coin_toss < smooth, uniform, np.minimum(weighted, ARGS.num_preds - 1))
+
+    num_chains = max(1, ARGS.chains)
+    num_lines = len(sampled_lines)
+    # sampled indices of every chain, one row per chain
+    states = resample(np.tile(np.arange(num_lines), (num_chains, 1)))
+    # number of distinct programs
+    space = ARGS.num_preds ** num_lines
+    seen = set()
+    curr_idx = [0] * len(assembler.pred_positions)
+    iter_count, compile_count, skip_count, stall = 0, 0, 0, 0
+    try:
+        with open("gibbs_stats.txt", "a") as stat_file, ThreadPoolExecutor(
+            max_workers=num_chains
+        ) as executor:
+            while (
+                iter_count < ARGS.compile_budget
+                and len(seen) < space
+                and stall < GIBBS_MAX_STALL
             ):
-                curr_prob_list.append(float(pred[i]))
-            curr_prob_list = [math.exp(x) for x in curr_prob_list]
-            total_sum = sum(curr_prob_list)
-            curr_prob_list = [x * 1.0 / total_sum for x in curr_prob_list]
-            prob_list.append(curr_prob_list)
-            coin_toss = np.random.uniform(0, 1, 1)[0]
-            if coin_toss < smooth:
-                sampled_idx.append(np.random.choice(ARGS.num_preds, 1)[0])
-            else:
-                sampled_idx.append(
-                    np.random.choice(ARGS.num_preds, 1, p=curr_prob_list)[0]
-                )
-    iter_count = 0
-    compile_count = 0
-    while iter_count < ARGS.compile_budget:
-        iter_count += 1
-        code = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-        curr_ind = 0
-        prev_line = " "
-        curr_idx = 0
-        for inp, pred in zip(inp_stmt, pred_stmt):
-            indent = "\t" * int(inp[_inp.indent])
-            tmp_ind = int(inp[_inp.indent])
-            if tmp_ind < curr_ind:
-                if inp[_inp.code] != "}":
-                    indent += "} "
-                if curr_ind - tmp_ind > 1:
-                    indent += (curr_ind - tmp_ind - 1) * "} "
-            elif tmp_ind > curr_ind:
-                if not prev_line or prev_line[-1] != "{":
-                    indent += "{ "
-                if tmp_ind - curr_ind > 1:
-                    indent += (tmp_ind - curr_ind - 1) * "{ "
-            curr_ind = tmp_ind
-            if pred[_pred.text] == "DUMMY":
-                code += indent + inp[_inp.code] + "\n"
-                prev_line = inp[_inp.code]
-            else:
-                if math.exp(float(pred[_pred.pred_score])) < thres:
-                    code += (
-                        indent
-                        + fix_strings(pred[_pred.pred_best + sampled_idx[curr_idx]])
-                        + " // "
-                        + inp[_inp.text]
-                        + "\n"
-                    )
-                    prev_line = pred[_pred.pred_best + sampled_idx[curr_idx]]
-                    curr_idx += 1
-                else:
-                    code += (
-                        indent
-                        + fix_strings(pred[_pred.pred_best])
-                        + " // "
-                        + inp[_inp.text]
-                        + "\n"
+                # submit the new programs of the chains
+                batch = []
+                for sampled_idx in states:
+                    key = sampled_idx.tobytes()
+                    if key in seen:
+                        skip_count += 1
+                        continue
+                    if iter_count + len(batch) >= ARGS.compile_budget:
+                        break
+                    seen.add(key)
+                    for k, cand in zip(sampled_lines, sampled_idx):
+                        curr_idx[k] = int(cand)
+                    code = assembler.build(curr_idx)
+                    slot_subid = subid if num_chains == 1 else "{}-{}".format(subid, len(batch))
+                    future = executor.submit(
+                        compile_and_run_tests,
+                        code,
+                        probid,
+                        slot_subid,
+                        iter_count + len(batch) + 1,
                     )
-                    prev_line = pred[_pred.pred_best]
-        # run the program
-        passed, error, _ = compile_and_run_tests(code, probid, subid, iter_count)
-        stat_file = open("gibbs_stats.txt", "a")
-        if error != err.compile_err:
-            compile_count += 1
-        stat_file.write("Stats after iteration # " + str(iter_count) + "\n")
-        stat_file.write("Time: {:.3f}\n".format(time.time() - START_TIME))
-        stat_file.write("Number of programs compiled:  " + str(compile_count) + "\n")
-        stat_file.write(str(passed) + " " + str(error) + "\n")
-        if passed == pass_test.none:
-            idx_to_change = np.random.choice(len(sampled_idx), 1)[0]
-            coin_toss = np.random.uniform(0, 1, 1)[0]
-            if coin_toss < smooth:
-                sampled_idx[idx_to_change] = np.random.choice(ARGS.num_preds, 1)[0]
-            else:
-                sampled_idx[idx_to_change] = np.random.choice(
-                    ARGS.num_preds, 1, p=prob_list[idx_to_change]
-                )[0]
-            stat_file.write("continuing sampling...\n\n")
-            stat_file.close()
-        elif passed == pass_test.public:
-            stat_file.write("passed public but failed hidden!\n\n")
-            stat_file.close()
-            return True, False
-        else:
-            stat_file.write("passed public and hidden!\n\n")
-            stat_file.close()
-            return True, True
+                    batch.append((code, future))
+                stall = 0 if batch else stall + 1
+                # commit the results in chain order
+                for code, future in batch:
+                    iter_count += 1
+                    passed, error, _ = future.result()
+                    if error != err.compile_err:
+                        compile_count += 1
+                    stat_file.write("Stats after iteration # " + str(iter_count) + "\n")
+                    stat_file.write("Time: {:.3f}\n".format(time.time() - START_TIME))
+                    stat_file.write("Number of programs compiled:  " + str(compile_count) + "\n")
+                    stat_file.write("Number of duplicate samples skipped:  " + str(skip_count) + "\n")
+                    stat_file.write(str(passed) + " " + str(error) + "\n")
+                    if passed == pass_test.none:
+                        stat_file.write("continuing sampling...\n\n")
+                        continue
+                    if num_chains > 1:
+                        # keep the passing program under the usual name
+                        with open(probid + "-" + subid + ".cpp", "w") as fout:
+                            fout.write(code)
+                    if passed == pass_test.public:
+                        stat_file.write("passed public but failed hidden!\n\n")
+                        return True, False
+                    else:
+                        stat_file.write("passed public and hidden!\n\n")
+                        return True, True
+                if num_lines:
+                    # every chain resamples one random line
+                    lines = np.random.randint(num_lines, size=num_chains)
+                    states[np.arange(num_chains), lines] = resample(lines)
+    finally:
+        if num_chains > 1:
+            for slot in range(num_chains):
+                slot_file = "{}-{}-{}.cpp".format(probid, subid, slot)
+                if os.path.exists(slot_file):
+                    os.remove(slot_file)
     return False, False
 
 
@@ -669,29 +910,232 @@ def stitch_gibbs(inp_stmt, pred_stmt, probid, subid, thres=0.8, smooth=0.5):
 # Best first search
 
 
-class PrioritySet(object):
-    def __init__(self):
+class _Subspace(object):
+    """
+    Index vectors that start with a fixed prefix (packed into an integer),
+    avoid the candidates in mask at the pivot line and are free after it.
+    version is the KBestEnumerator.version the node was scored with.
+    """
+
+    __slots__ = ("prefix", "pivot", "mask", "version")
+
+    def __init__(self, prefix, pivot, mask, version):
+        self.prefix = prefix
+        self.pivot = pivot
+        self.mask = mask
+        self.version = version
+
+
+class KBestEnumerator(object):
+    """
+    Lazy best-first enumeration of the index vectors of prob_list
+    (one candidate per line) by decreasing total log prob.
+
+    Lawler-style partitioning: popping the best vector x of a subspace
+    splits the rest of the subspace into one child per line i >= pivot
+    (x[:i] fixed, x[i] excluded, free after i), so every vector is produced
+    exactly once without a set of the used ones. Children are created when
+    the next vector is requested.
+
+    Scores only go down (ban / penalize). Nodes scored before the last update
+    are re-scored when popped and pushed back if they got worse, so updates
+    need no rebuild of the heap.
+
+    Index vectors are packed into integers (base num_preds); ties are broken
+    by the packed best vector, i.e. lexicographically.
+    At most max_size nodes are kept; beyond that the worst half is dropped,
+    and the vectors after that are no longer guaranteed in k-best order
+    (a warning is printed at every drop).
+    prefix_filter(idx) returns the length of a known bad prefix of idx (0 if
+    none); children that would fix a bad prefix are not created.
+    """
+
+    def __init__(self, prob_list, max_size=None, prefix_filter=None):
+        self.scores = [list(prob_list_) for prob_list_ in prob_list]
+        self.L = len(self.scores)
+        self.base = max([len(prob_list_) for prob_list_ in self.scores] + [1])
+        self.max_size = max_size
+        self.prefix_filter = prefix_filter
+        # order[j]: candidates of line j that are not banned, best first
+        self.order = [
+            sorted(range(len(scores)), key=lambda c, scores=scores: (-scores[c], c))
+            for scores in self.scores
+        ]
+        self.banned = [set() for _ in range(self.L)]
+        self.version = 0
         self.heap = []
-        self.used = set()
+        # popped (node, idx) whose children are not created yet
+        self.pending = None
+        # subspaces dropped by max_size, subtrees cut by prefix_filter
+        self.dropped, self.pruned = 0, 0
+        self._update_suffix()
+        root = _Subspace(0, 0, 0, self.version)
+        value = self._value(0.0, 0, 0)
+        if value is not None:
+            self._push(-value, self._pack_best(0, 0, 0), root)
+
+    def _update_suffix(self):
+        # feasible[j]: no line j.. is empty
+        # suffix_pack[j] = best candidates of lines j.. packed
+        self.feasible = [True] * (self.L + 1)
+        self.suffix_pack = [0] * (self.L + 1)
+        for j in range(self.L - 1, -1, -1):
+            if not self.order[j] or not self.feasible[j + 1]:
+                self.feasible[j] = False
+            else:
+                self.suffix_pack[j] = (
+                    self.order[j][0] * self.base ** (self.L - 1 - j)
+                    + self.suffix_pack[j + 1]
+                )
+
+    def _pack_best(self, prefix, pivot, mask):
+        """
+        Packed best vector of a non-empty subspace.
+        """
+        if pivot == self.L:
+            return prefix
+        packed = prefix * self.base + self._best(pivot, mask)
+        return packed * self.base ** (self.L - 1 - pivot) + self.suffix_pack[pivot + 1]
+
+    def _pack(self, idx):
+        packed = 0
+        for c in idx:
+            packed = packed * self.base + c
+        return packed
+
+    def _best(self, j, mask):
+        for c in self.order[j]:
+            if not (mask >> c) & 1:
+                return c
+        return None
+
+    def _value(self, prefix_sum, pivot, mask):
+        """
+        Score of the best vector of a subspace, None if it is empty.
+        """
+        if pivot == self.L:
+            return prefix_sum
+        c = self._best(pivot, mask)
+        if c is None or not self.feasible[pivot + 1]:
+            return None
+        # summed from left to right like the log prob of a full vector
+        value = prefix_sum + self.scores[pivot][c]
+        for j in range(pivot + 1, self.L):
+            value += self.scores[j][self.order[j][0]]
+        return value
+
+    def _unpack(self, prefix, length):
+        idx = [0] * length
+        for j in range(length - 1, -1, -1):
+            prefix, idx[j] = divmod(prefix, self.base)
+        return idx
+
+    def _evaluate(self, node):
+        """
+        Return (score, best vector) of a subspace, None if it is empty.
+        """
+        idx = self._unpack(node.prefix, node.pivot)
+        if any(c in self.banned[j] for j, c in enumerate(idx)):
+            return None
+        prefix_sum = 0.0
+        for j, c in enumerate(idx):
+            prefix_sum += self.scores[j][c]
+        value = self._value(prefix_sum, node.pivot, node.mask)
+        if value is None:
+            return None
+        if node.pivot < self.L:
+            idx.append(self._best(node.pivot, node.mask))
+            idx.extend(self.order[j][0] for j in range(node.pivot + 1, self.L))
+        return value, idx
+
+    def _push(self, key, packed, node):
+        heapq.heappush(self.heap, (key, packed, node))
+        if self.max_size is not None and len(self.heap) > self.max_size:
+            kept = heapq.nsmallest(self.max_size // 2, self.heap)
+            self.dropped += len(self.heap) - len(kept)
+            print(
+                "Warning: more than {} subspaces, dropped the worst {}; "
+                "the enumeration is no longer in exact k-best order".format(
+                    self.max_size, len(self.heap) - len(kept)
+                ),
+                file=sys.stderr,
+            )
+            # a sorted list is a heap
+            self.heap = kept
+
+    def _expand(self, node, idx):
+        upto = self.L
+        if self.prefix_filter is not None:
+            bad_length = self.prefix_filter(idx)
+            if bad_length:
+                upto = max(node.pivot, bad_length)
+                self.pruned += self.L - upto
+        prefix = node.prefix
+        prefix_sum = 0.0
+        for j in range(node.pivot):
+            prefix_sum += self.scores[j][idx[j]]
+        for i in range(node.pivot, upto):
+            mask = (node.mask if i == node.pivot else 0) | (1 << idx[i])
+            value = self._value(prefix_sum, i, mask)
+            if value is not None:
+                self._push(
+                    -value,
+                    self._pack_best(prefix, i, mask),
+                    _Subspace(prefix, i, mask, self.version),
+                )
+            prefix = prefix * self.base + idx[i]
+            prefix_sum += self.scores[i][idx[i]]
 
-    def add(self, log_prob, idx):
-        idx = tuple(idx)
-        if idx not in self.used:
-            heapq.heappush(self.heap, (log_prob, idx))
-            self.used.add(idx)
-            if len(self.heap) > ARGS.max_heap:
-                print("Heap limit exceeded. Committing suicide ...")
-                exit(0)
+    def _flush(self):
+        if self.pending is not None:
+            self._expand(*self.pending)
+            self.pending = None
 
     def pop(self):
-        log_prob, idx = heapq.heappop(self.heap)
-        # self.used.remove(idx)
-        return log_prob, list(idx)
+        """
+        Return (negative log prob, index vector) of the next best vector.
+        """
+        self._flush()
+        while True:
+            key, _, node = heapq.heappop(self.heap)
+            res = self._evaluate(node)
+            if res is None:
+                continue
+            if node.version != self.version:
+                node.version = self.version
+                if -res[0] != key:
+                    self._push(-res[0], self._pack(res[1]), node)
+                    continue
+            self.pending = (node, res[1])
+            return -res[0], list(res[1])
+
+    def ban(self, j, c):
+        """
+        Never return candidate c of line j again.
+        """
+        if c not in self.banned[j]:
+            self.banned[j].add(c)
+            self.order[j].remove(c)
+            self.version += 1
+            self._update_suffix()
+
+    def penalize(self, j, c, amount):
+        """
+        Lower the log prob of candidate c of line j by amount.
+        """
+        self.scores[j][c] -= amount
+        scores = self.scores[j]
+        self.order[j].sort(key=lambda c: (-scores[c], c))
+        self.version += 1
+        self._update_suffix()
 
     def __len__(self):
         return len(self.heap)
 
     def empty(self):
+        self._flush()
+        while self.heap and self._evaluate(self.heap[0][2]) is None:
+            heapq.heappop(self.heap)
         return len(self.heap) == 0
 
 
@@ -706,104 +1150,165 @@ def stitch_best_first(inp_stmt, pred_stmt, probid, subid):
                 curr_prob_list.append(float(pred[i]))
             prob_list.append(curr_prob_list)
 
+    assembler = ProgramAssembler(inp_stmt, pred_stmt)
     iter_count, compile_count = 0, 0
-    # create a heap and add the first element
-    # since we want a max_heap, we add a the negative of log prob (by default it's a min heap)
-    heap = PrioritySet()
-    log_prob = 0
-    idx = []
-    for prob_list_ in prob_list:
-        log_prob += prob_list_[0]
-        idx.append(0)
-    heap.add(-log_prob, idx)
-    # iterate until not empty
-    while not heap.empty() and iter_count < ARGS.compile_budget:
-        iter_count += 1
-        stat_file = open("best_first.txt", "a")
-        stat_file.write("Stats after iteration # " + str(iter_count) + "\n")
-        stat_file.write("Time: {:.3f}\n".format(time.time() - START_TIME))
-        log_prob, curr_idx = heap.pop()
-        stat_file.write(str(log_prob) + "\n")
-        stat_file.write(str(curr_idx) + "\n")
-        if log_prob >= SCORE_THRES:
-            stat_file.write("Log_prob threshold reached. Committing suicide ...")
-            return False, False
-        for i in range(len(curr_idx)):
-            if curr_idx[i] < ARGS.num_preds - 1:
-                new_idx = curr_idx.copy()
-                new_idx[i] += 1
-                # add neighbours to the heap
-                log_prob = 0
-                for j in range(len(new_idx)):
-                    log_prob += prob_list[j][new_idx[j]]
-                heap.add(-log_prob, new_idx)
-        # find the code
-        code = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-        prev_line = " "
-        idx_count = 0
-        curr_ind = 0
-        for inp, pred in zip(inp_stmt, pred_stmt):
-            indent = "\t" * int(inp[_inp.indent])
-            tmp_ind = int(inp[_inp.indent])
-            if tmp_ind < curr_ind:
-                if inp[_inp.code] != "}":
-                    indent += "} "
-                if curr_ind - tmp_ind > 1:
-                    indent += (curr_ind - tmp_ind - 1) * "} "
-            elif tmp_ind > curr_ind:
-                if not prev_line or prev_line[-1] != "{":
-                    indent += "{ "
-                if tmp_ind - curr_ind > 1:
-                    indent += (tmp_ind - curr_ind - 1) * "{ "
-            curr_ind = tmp_ind
-            if pred[_pred.text] == "DUMMY":
-                code += indent + inp[_inp.code] + "\n"
-                prev_line = inp[_inp.code]
-            else:
-                code += (
-                    indent
-                    + fix_strings(pred[_pred.pred_best + curr_idx[idx_count]])
-                    + " // "
-                    + inp[_inp.text]
-                    + "\n"
+    # enumerate the index vectors by decreasing log prob
+    heap = KBestEnumerator(prob_list, max_size=ARGS.max_heap)
+    # candidates compiled and tested concurrently (speculatively)
+    num_slots = max(1, ARGS.speculate)
+    try:
+        with SearchLog("best_first") as log, ThreadPoolExecutor(
+            max_workers=num_slots
+        ) as executor:
+            log.write("start", probid=probid, subid=subid, lines=len(prob_list))
+            # candidates rejected by the syntax pre-check are never returned
+            if ARGS.precheck:
+                start = time.time()
+                precheck = LinePrecheck(assembler, ARGS.num_preds)
+                for k, rejected in enumerate(precheck.blacklist):
+                    for cand in rejected:
+                        heap.ban(k, cand)
+                log.write(
+                    "precheck",
+                    rejected=precheck.num_rejected,
+                    precheck_time=time.time() - start,
                 )
-                prev_line = pred[_pred.pred_best + curr_idx[idx_count]]
-                idx_count += 1
-        # run the program
-        passed, error, _ = compile_and_run_tests(code, probid, subid, iter_count)
-        if error != err.compile_err:
-            compile_count += 1
-        stat_file.write("Number of programs compiled:  " + str(compile_count) + "\n")
-        stat_file.write(str(passed) + " " + str(error) + "\n")
-        # if public didn't pass then proceed
-        if passed == pass_test.none:
-            stat_file.write("continuing best first search...\n\n")
-            stat_file.close()
-            continue
-        elif passed == pass_test.public:
-            stat_file.write("passed public but failed hidden!\n\n")
-            stat_file.close()
-            return True, False
-        else:
-            stat_file.write("passed public and hidden!\n\n")
-            stat_file.close()
-            return True, True
-    return False, False
+            result = "exhausted"
+            # iterate until not empty
+            while not heap.empty() and iter_count < ARGS.compile_budget:
+                # Pop the next candidates in heap order. The order does not
+                # depend on the results, so it is the same as in the serial search.
+                batch = []
+                while (
+                    not heap.empty()
+                    and len(batch) < num_slots
+                    and iter_count + len(batch) < ARGS.compile_budget
+                ):
+                    start = time.time()
+                    heap_size = len(heap)
+                    log_prob, curr_idx = heap.pop()
+                    if log_prob >= SCORE_THRES:
+                        batch.append((log_prob, curr_idx, heap_size, None, None, None, None))
+                        break
+                    # find the code and run the program
+                    code = assembler.build(curr_idx)
+                    search_time = time.time() - start
+                    slot_subid = subid if num_slots == 1 else "{}-{}".format(subid, len(batch))
+                    timing = {}
+                    future = executor.submit(
+                        compile_and_run_tests,
+                        code,
+                        probid,
+                        slot_subid,
+                        iter_count + len(batch) + 1,
+                        timing,
+                    )
+                    batch.append(
+                        (log_prob, curr_idx, heap_size, search_time, code, future, timing)
+                    )
+                # commit the results in heap order
+                for log_prob, curr_idx, heap_size, search_time, code, future, timing in batch:
+                    iter_count += 1
+                    if future is None:
+                        result = "threshold"
+                        break
+                    passed, error, _ = future.result()
+                    if error != err.compile_err:
+                        compile_count += 1
+                    log.write(
+                        "iter",
+                        iter=iter_count,
+                        heap=heap_size,
+                        log_prob=log_prob,
+                        idx=curr_idx,
+                        search_time=search_time,
+                        compile_time=timing["compile"],
+                        test_time=timing["test"],
+                        passed=passed,
+                        error=error,
+                    )
+                    # if public didn't pass then proceed
+                    if passed == pass_test.none:
+                        continue
+                    if num_slots > 1:
+                        # keep the passing program under the usual name
+                        with open(probid + "-" + subid + ".cpp", "w") as fout:
+                            fout.write(code)
+                    result = "public" if passed == pass_test.public else "hidden"
+                    break
+                if result != "exhausted":
+                    break
+            else:
+                if not heap.empty():
+                    result = "budget"
+            log.write(
+                "end",
+                result=result,
+                iterations=iter_count,
+                compiled=compile_count,
+                dropped_subspaces=heap.dropped,
+            )
+    finally:
+        if num_slots > 1:
+            for slot in range(num_slots):
+                slot_file = "{}-{}-{}.cpp".format(probid, subid, slot)
+                if os.path.exists(slot_file):
+                    os.remove(slot_file)
+    return result in ("public", "hidden"), result == "hidden"
 
 
 ################################################
 # Prefix pruning
 
 
-def stitch_prefix_pruning(inp_stmt, pred_stmt, probid, subid):
-    bad_prefixes = {}
+class PrefixTrie(object):
+    """
+    Index of the bad prefixes of index vectors.
 
-    def check_if_bad(curr_idx, bad_prefixes):
-        for l in range(len(curr_idx)):
-            if l + 1 in bad_prefixes:
-                if tuple(curr_idx[: l + 1]) in bad_prefixes[l + 1]:
-                    return True, tuple(curr_idx[: l + 1])
-        return False, None
+    Nodes are dicts from candidate index to child; a bad prefix ends in
+    True, which also stands for its whole subtree (longer bad prefixes
+    below it are dropped). Looking up an index vector walks at most
+    len(idx) nodes instead of hashing one tuple per prefix length.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.num_prefixes = 0
+
+    def add(self, prefix):
+        """
+        Mark prefix as bad. Return False if it was already covered.
+        """
+        node = self.root
+        for cand in prefix[:-1]:
+            child = node.get(cand)
+            if child is True:
+                return False
+            if child is None:
+                child = node[cand] = {}
+            node = child
+        if node.get(prefix[-1]) is True:
+            return False
+        node[prefix[-1]] = True
+        self.num_prefixes += 1
+        return True
+
+    def match(self, idx):
+        """
+        Return the length of the bad prefix of idx, 0 if there is none.
+        """
+        node = self.root
+        for depth, cand in enumerate(idx):
+            node = node.get(cand)
+            if node is None:
+                return 0
+            if node is True:
+                return depth + 1
+        return 0
+
+
+def stitch_prefix_pruning(inp_stmt, pred_stmt, probid, subid):
+    bad_prefixes = PrefixTrie()
 
     prob_list = []
     prob_list_idx_to_stmt_idx = []
@@ -820,303 +1325,163 @@ def stitch_prefix_pruning(inp_stmt, pred_stmt, probid, subid):
         x: i for (i, x) in enumerate(prob_list_idx_to_stmt_idx)
     }
 
+    assembler = ProgramAssembler(inp_stmt, pred_stmt)
+
+    from err_utils import NaiveErrDetector
+
+    err_detector = NaiveErrDetector(None)
+
     iter_count, compile_count = 0, 0
     prefix_ccount, heap_ccount, skip_ccount = 0, 0, 0
-    # create a heap and add the first element
-    # since we want a max_heap, we add a the negative of log prob (by default it's a min heap)
-    heap = PrioritySet()
-    log_prob = 0
-    idx = []
-    for prob_list_ in prob_list:
-        log_prob += prob_list_[0]
-        idx.append(0)
-    heap.add(-log_prob, idx)
-    # iterate until not empty
-    while not heap.empty() and prefix_ccount + heap_ccount < ARGS.compile_budget:
-        iter_count += 1
-        stat_file = open("best_first_prefix_pruning.txt", "a")
-        stat_file.write("Stats after iteration # " + str(iter_count) + "\n")
-        stat_file.write("Time: {:.3f}\n".format(time.time() - START_TIME))
-        log_prob, curr_idx = heap.pop()
-        stat_file.write(str(log_prob) + "\n")
-        stat_file.write(str(curr_idx) + "\n")
-
-        code = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-        prev_line = " "
-        idx_count = 0
-        curr_ind = 0
-        for inp, pred in zip(inp_stmt, pred_stmt):
-            indent = "\t" * int(inp[_inp.indent])
-            tmp_ind = int(inp[_inp.indent])
-            if tmp_ind < curr_ind:
-                if inp[_inp.code] != "}":
-                    indent += "} "
-                if curr_ind - tmp_ind > 1:
-                    indent += (curr_ind - tmp_ind - 1) * "} "
-            elif tmp_ind > curr_ind:
-                if not prev_line or prev_line[-1] != "{":
-                    indent += "{ "
-                if tmp_ind - curr_ind > 1:
-                    indent += (tmp_ind - curr_ind - 1) * "{ "
-            curr_ind = tmp_ind
-            if pred[_pred.text] == "DUMMY":
-                code += indent + inp[_inp.code] + "\n"
-                prev_line = inp[_inp.code]
-            else:
-                code += (
-                    indent
-                    + fix_strings(pred[_pred.pred_best + curr_idx[idx_count]])
-                    + " // "
-                    + inp[_inp.text]
-                    + "\n"
-                )
-                prev_line = pred[_pred.pred_best + curr_idx[idx_count]]
-                idx_count += 1
-
-        from err_utils import NaiveErrDetector
+    # enumerate the index vectors by decreasing log prob; the subtrees
+    # that would fix a known bad prefix are not created
+    heap = KBestEnumerator(
+        prob_list, max_size=ARGS.max_heap, prefix_filter=bad_prefixes.match
+    )
+    result = "exhausted"
+    with SearchLog("best_first_prefix_pruning") as log:
+        log.write("start", probid=probid, subid=subid, lines=len(prob_list))
+        # iterate until not empty
+        while not heap.empty() and prefix_ccount + heap_ccount < ARGS.compile_budget:
+            iter_count += 1
+            start = time.time()
+            heap_size = len(heap)
+            log_prob, curr_idx = heap.pop()
 
-        err_detector = NaiveErrDetector(None)
+            # the prefix may have been found bad after curr_idx was added
+            bad_length = bad_prefixes.match(curr_idx)
+            if bad_length:
+                log.write(
+                    "skip",
+                    iter=iter_count,
+                    heap=heap_size,
+                    log_prob=log_prob,
+                    idx=curr_idx,
+                    bad_prefix=curr_idx[:bad_length],
+                    search_time=time.time() - start,
+                )
+                skip_ccount += 1
+                continue
 
-        passed, error, raw_err_msg = compile_and_run_tests(
-            code, probid, subid, iter_count
-        )
-        heap_ccount += 1
-        add_to_heap_upto = len(curr_idx)
-        if error != err.compile_err:
-            stat_file.write("Compiled. Proceeding..." + "\n")
-            compile_count += 1
-        else:
-            stat_file.write("Did not compile. Finding prefix..." + "\n")
-            stat_file.write("Length of program: " + str(len(curr_idx)) + "\n")
+            code = assembler.build(curr_idx)
+            search_time = time.time() - start
 
-            try:
-                err_line_stmt_idx, err_msg = err_detector.detect(None, raw_err_msg)
-            except Exception as e:
-                # Commit suicide
-                print("PANIC! {}".format(e))
-                print("PANIC! {}".format(e), file=stat_file)
-                stat_file.write(traceback.format_exc())
-                exit(1)
-            # resolve the error line to prob_list_idx
-            if err_line_stmt_idx is not None:
-                err_line = stmt_idx_to_prob_list_idx.get(err_line_stmt_idx)
-            else:
-                err_line = None
-            # after resolving, check if it's a predicted line
-            if err_line is None:
-                print("Error line UNKNOWN: {}".format(err_msg), file=stat_file)
+            timing = {}
+            passed, error, raw_err_msg = compile_and_run_tests(
+                code, probid, subid, iter_count, timing
+            )
+            heap_ccount += 1
+            # detector decision and prefix search of a compile error
+            prefix = None
+            if error != err.compile_err:
+                compile_count += 1
             else:
-                stat_file.write("Length of prob_list: " + str(len(prob_list)) + "\n")
-                stat_file.write("Found err_line: " + str(err_line) + "\n")
-
-                def find_code_upto(mid_idx, inp_stmt, pred_stmt):
-                    code = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-                    prev_line = " "
-                    idx_count = 0
-                    curr_ind = 0
-                    for inp, pred in zip(inp_stmt, pred_stmt):
-                        if idx_count > mid_idx:
-                            next_ind = int(inp[_inp.indent])
-                            break
-                        indent = "\t" * int(inp[_inp.indent])
-                        tmp_ind = int(inp[_inp.indent])
-                        if tmp_ind < curr_ind:
-                            if inp[_inp.code] != "}":
-                                indent += "} "
-                            if curr_ind - tmp_ind > 1:
-                                indent += (curr_ind - tmp_ind - 1) * "} "
-                        elif tmp_ind > curr_ind:
-                            if not prev_line or prev_line[-1] != "{":
-                                indent += "{ "
-                            if tmp_ind - curr_ind > 1:
-                                indent += (tmp_ind - curr_ind - 1) * "{ "
-                        curr_ind = tmp_ind
-                        if pred[_pred.text] == "DUMMY":
-                            code += indent + inp[_inp.code] + "\n"
-                            prev_line = inp[_inp.code]
-                        else:
-                            code += (
-                                indent
-                                + fix_strings(
-                                    pred[_pred.pred_best + curr_idx[idx_count]]
-                                )
-                                + " // "
-                                + inp[_inp.text]
-                                + "\n"
-                            )
-                            prev_line = pred[_pred.pred_best + curr_idx[idx_count]]
-                            idx_count += 1
-
-                    if not prev_line or prev_line[-1] == "{":
-                        code += "} "
-                    if (
-                        not prev_line
-                        or (
-                            (
-                                prev_line.startswith("while")
-                                or prev_line.startswith("for")
-                                or prev_line.startswith("if")
-                                or prev_line.startswith("else")
-                            )
-                            and prev_line[-1] == ")"
-                        )
-                        or prev_line.startswith("else")
-                    ):
-                        code += "{ }"
-                    if curr_ind == 0 and next_ind == 1:
-                        code += "{ }"
-                    code += curr_ind * "} "
-                    return code
-
-                prev_pass_fail = None
-                curr_prefix_ccount = 0
-                if err_line != len(prob_list) - 1:
-                    stat_file.write(
-                        "err_line is in the middle, not at the end.." + "\n"
-                    )
-                    code = find_code_upto(err_line, inp_stmt, pred_stmt)
-                    if compile_code(code, probid, subid, True) == None:
-                        stat_file.write("Compiled! Going right..." + "\n")
-                        prev_pass_fail = True
-                    else:
-                        stat_file.write("Did not compile! Going left..." + "\n")
-                        prev_pass_fail = False
-                    curr_prefix_ccount += 1
-                else:
-                    stat_file.write(
-                        "err_line is at the end, not compiling for err_line..." + "\n"
-                    )
-                    prev_pass_fail = False
-
-                prefix_inc = None
-                if prev_pass_fail:
-                    prefix_inc = 1
+                start = time.time()
+                err_line_stmt_idx, err_msg = err_detector.detect(None, raw_err_msg)
+                # resolve the error line to prob_list_idx
+                if err_line_stmt_idx is not None:
+                    err_line = stmt_idx_to_prob_list_idx.get(err_line_stmt_idx)
                 else:
-                    prefix_inc = -1
-
-                curr_prefix_idx = err_line + prefix_inc
-                found_a_prefix = False
-                while (
-                    curr_prefix_ccount < 3
-                    and -1 <= curr_prefix_idx
-                    and curr_prefix_idx < len(prob_list)
-                ):
-                    stat_file.write("Finding code upto " + str(curr_prefix_idx) + "\n")
-                    if curr_prefix_idx == -1:
-                        # Empty code always compiles successfully
-                        compile_res = True
-                    else:
-                        code = find_code_upto(curr_prefix_idx, inp_stmt, pred_stmt)
-                        compile_res = compile_code(code, probid, subid, True)
+                    err_line = None
+                prefix = {"err_line": err_line, "message": err_msg}
+                # after resolving, check if it's a predicted line
+                if err_line is not None:
+                    prev_pass_fail = None
+                    curr_prefix_ccount = 0
+                    if err_line != len(prob_list) - 1:
+                        # err_line is in the middle: go right if the code
+                        # up to it compiles, else go left
+                        code = assembler.prefix(curr_idx, err_line)
+                        prev_pass_fail = compile_code(code, probid, subid, True) == None
                         curr_prefix_ccount += 1
-                    if prev_pass_fail and compile_res != None:
-                        stat_file.write("Finding a failing program and found!" + "\n")
-                        found_a_prefix = True
-                        break
-                    if (not prev_pass_fail) and compile_res == None:
-                        stat_file.write("Finding a passing program and found!" + "\n")
-                        found_a_prefix = True
-                        break
-                    curr_prefix_idx += prefix_inc
-                    stat_file.write(
-                        "Didn't find a required program, progressing search..." + "\n"
-                    )
+                    else:
+                        # err_line is at the end, not compiling for err_line
+                        prev_pass_fail = False
 
-                if not found_a_prefix:
-                    stat_file.write("Didn't find a required program at all :(" + "\n")
-                else:
+                    prefix_inc = None
                     if prev_pass_fail:
-                        stat_file.write(
-                            "BAD PREFIX: " + str(curr_idx[: curr_prefix_idx + 1]) + "\n"
-                        )
-                        add_to_heap_upto = curr_prefix_idx + 1
-                        if (curr_prefix_idx + 1) not in bad_prefixes:
-                            bad_prefixes[(curr_prefix_idx + 1)] = set()
-                        bad_prefixes[(curr_prefix_idx + 1)].add(
-                            tuple(curr_idx[: curr_prefix_idx + 1])
-                        )
+                        prefix_inc = 1
                     else:
-                        stat_file.write(
-                            "BAD PREFIX: " + str(curr_idx[: curr_prefix_idx + 2]) + "\n"
-                        )
-                        add_to_heap_upto = curr_prefix_idx + 2
-                        if (curr_prefix_idx + 2) not in bad_prefixes:
-                            bad_prefixes[(curr_prefix_idx + 2)] = set()
-                        bad_prefixes[(curr_prefix_idx + 2)].add(
-                            tuple(curr_idx[: curr_prefix_idx + 2])
-                        )
-                    stat_file.write("added to set..." + "\n")
-                prefix_ccount += curr_prefix_ccount
-
-        for i in range(add_to_heap_upto):
-            if curr_idx[i] < ARGS.num_preds - 1:
-                new_idx = curr_idx.copy()
-                new_idx[i] += 1
-                check_flag, check_value = check_if_bad(new_idx, bad_prefixes)
-                if check_flag:
-                    continue
-                # add neighbours to the heap
-                log_prob = 0
-                for j in range(len(new_idx)):
-                    log_prob += prob_list[j][new_idx[j]]
-                heap.add(-log_prob, new_idx)
-
-        stat_file.write("Number of programs compiled:  " + str(compile_count) + "\n")
-        stat_file.write(str(passed) + " " + str(error) + "\n")
-        # if public didn't pass then proceed
-        if passed == pass_test.none:
-            stat_file.write("continuing best first search...\n\n")
-            stat_file.close()
-            continue
-        elif passed == pass_test.public:
-            stat_file.write("passed public but failed hidden!\n\n")
-            stat_file.write(
-                "PREFIX PRUNING STATS:\nheap compiler calls: "
-                + str(heap_ccount)
-                + "\nprefix compiler calls: "
-                + str(prefix_ccount)
-                + "\nskip compiler calls: "
-                + str(skip_ccount)
-                + "\ntotal iterations: "
-                + str(iter_count)
+                        prefix_inc = -1
+
+                    curr_prefix_idx = err_line + prefix_inc
+                    found_a_prefix = False
+                    while (
+                        curr_prefix_ccount < 3
+                        and -1 <= curr_prefix_idx
+                        and curr_prefix_idx < len(prob_list)
+                    ):
+                        if curr_prefix_idx == -1:
+                            # Empty code always compiles successfully
+                            compile_res = True
+                        else:
+                            code = assembler.prefix(curr_idx, curr_prefix_idx)
+                            compile_res = compile_code(code, probid, subid, True)
+                            curr_prefix_ccount += 1
+                        # looking for a failing program when going right,
+                        # for a passing one when going left
+                        if prev_pass_fail and compile_res != None:
+                            found_a_prefix = True
+                            break
+                        if (not prev_pass_fail) and compile_res == None:
+                            found_a_prefix = True
+                            break
+                        curr_prefix_idx += prefix_inc
+
+                    prefix["direction"] = "right" if prev_pass_fail else "left"
+                    prefix["compiles"] = curr_prefix_ccount
+                    prefix["bad_prefix"] = None
+                    if found_a_prefix:
+                        if prev_pass_fail:
+                            prefix["bad_prefix"] = curr_idx[: curr_prefix_idx + 1]
+                        else:
+                            prefix["bad_prefix"] = curr_idx[: curr_prefix_idx + 2]
+                        bad_prefixes.add(prefix["bad_prefix"])
+                    prefix_ccount += curr_prefix_ccount
+                prefix["prefix_time"] = time.time() - start
+
+            log.write(
+                "iter",
+                iter=iter_count,
+                heap=heap_size,
+                log_prob=log_prob,
+                idx=curr_idx,
+                search_time=search_time,
+                compile_time=timing["compile"],
+                test_time=timing["test"],
+                passed=passed,
+                error=error,
+                prefix=prefix,
             )
-            stat_file.close()
-            return True, False
+            # if public didn't pass then proceed
+            if passed == pass_test.none:
+                continue
+            result = "public" if passed == pass_test.public else "hidden"
+            break
         else:
-            stat_file.write("passed public and hidden!\n\n")
-            stat_file.write(
-                "PREFIX PRUNING STATS:\nheap compiler calls: "
-                + str(heap_ccount)
-                + "\nprefix compiler calls: "
-                + str(prefix_ccount)
-                + "\nskip compiler calls: "
-                + str(skip_ccount)
-                + "\ntotal iterations: "
-                + str(iter_count)
-            )
-            stat_file.close()
-            return True, True
-
-    stat_file = open("best_first_prefix_pruning.txt", "a")
-    stat_file.write(
-        "PREFIX PRUNING STATS:\nheap compiler calls: "
-        + str(heap_ccount)
-        + "\nprefix compiler calls: "
-        + str(prefix_ccount)
-        + "\nskip compiler calls: "
-        + str(skip_ccount)
-        + "\ntotal iterations: "
-        + str(iter_count)
-    )
-    stat_file.close()
-    return False, False
+            if not heap.empty():
+                result = "budget"
+
+        log.write(
+            "end",
+            result=result,
+            iterations=iter_count,
+            compiled=compile_count,
+            heap_compiles=heap_ccount,
+            prefix_compiles=prefix_ccount,
+            skipped=skip_ccount,
+            pruned_subtrees=heap.pruned,
+            dropped_subspaces=heap.dropped,
+            bad_prefixes=bad_prefixes.num_prefixes,
+        )
+    return result in ("public", "hidden"), result == "hidden"
 
 
 ################################################
 # Error detection
 
 
-def stitch_error_detect(inp_stmt, pred_stmt, probid, subid):
+def stitch_error_detect(inp_stmt, pred_stmt, probid, subid, probno=None):
     # There are 2 different indexing systems (both 0-based)
     # * stmt_idx: index of inp_stmt and pred_stmt (i.e., with DUMMY lines)
     #     Note: stmt_idx = real line number minus LINE_OFFSET
@@ -1136,376 +1501,306 @@ def stitch_error_detect(inp_stmt, pred_stmt, probid, subid):
         x: i for (i, x) in enumerate(prob_list_idx_to_stmt_idx)
     }
 
+    assembler = ProgramAssembler(inp_stmt, pred_stmt, fixed_prev=True)
+
     iter_count, compile_count = 0, 0
-    # create a heap and add the first element
-    # since we want a max_heap, we add a the negative of log prob (by default it's a min heap)
-    if ARGS.err_rebuild_heap:
-        heap = FragilePrioritySet(prob_list)
-    else:
-        heap = PrioritySet()
-        log_prob = 0
-        idx = []
-        for prob_list_ in prob_list:
-            log_prob += prob_list_[0]
-            idx.append(0)
-        heap.add(-log_prob, idx)
+    # enumerate the index vectors by decreasing log prob; blacklisting and
+    # graylisting update the scores in place (no heap rebuild)
+    heap = KBestEnumerator(prob_list, max_size=ARGS.max_heap)
+
+    def blame(prob_list_idx, candidate_idx):
+        if ARGS.err_handling == "gray":
+            heap.penalize(prob_list_idx, candidate_idx, ARGS.err_gray_amount)
+        else:
+            heap.ban(prob_list_idx, candidate_idx)
 
     # error detector
     from err_utils import get_err_detector
 
-    err_detector = get_err_detector(ARGS)
-    # blacklist[prob_list_idx] = set of candidate_idxs that are blacklisted
-    blacklist = [set() for _ in range(len(prob_list))]
-
-    # iterate until not empty
-    with open("error_detect.txt", "w") as stat_file:
+    err_detector = get_err_detector(ARGS, probno)
+
+    result = "exhausted"
+    with SearchLog("error_detect") as log:
+        log.write("start", probid=probid, subid=subid, lines=len(prob_list))
+        # the candidates rejected by the syntax pre-check are handled
+        # like the ones blamed by the error detector
+        if ARGS.precheck:
+            start = time.time()
+            precheck = LinePrecheck(assembler, ARGS.num_preds)
+            for prob_list_idx, rejected in enumerate(precheck.blacklist):
+                for candidate_idx in rejected:
+                    blame(prob_list_idx, candidate_idx)
+            log.write(
+                "precheck",
+                rejected=precheck.num_rejected,
+                precheck_time=time.time() - start,
+            )
+        # iterate until not empty
         while not heap.empty() and iter_count < ARGS.compile_budget:
-            stat_file.flush()
             iter_count += 1
-            stat_file.write("Stats after iteration # " + str(iter_count) + "\n")
-            stat_file.write("Time: {:.3f}\n".format(time.time() - START_TIME))
+            start = time.time()
+            heap_size = len(heap)
             # log_prob: float
             # curr_idx: list[int] of length len(prob_list)
             log_prob, curr_idx = heap.pop()
-            stat_file.write(str(log_prob) + "\n")
-            stat_file.write(str(curr_idx) + "\n")
             if log_prob >= SCORE_THRES:
-                stat_file.write("Log_prob threshold reached. Committing suicide ...")
-                return False, False
-
-            # detect if there is a blacklisted candidate
-            found_blacklist = None
-            for prob_list_idx, candidate_idx in enumerate(curr_idx):
-                if candidate_idx in blacklist[prob_list_idx]:
-                    found_blacklist = (prob_list_idx, candidate_idx)
-                    break
+                result = "threshold"
+                break
 
-            # decide whether to proceed with code generation
-            skip_synthesis = (
-                found_blacklist is not None and ARGS.err_handling == "black"
+            # find the code
+            code = assembler.build(curr_idx)
+            code_lines = assembler.code_lines(curr_idx)  # For the error detection model
+            search_time = time.time() - start
+
+            # run the program
+            timing = {}
+            passed, error, raw_err_msg = compile_and_run_tests(
+                code, probid, subid, iter_count, timing
             )
-            if skip_synthesis:
-                stat_file.write(
-                    "Skip since {}.{} is in blacklist\n".format(*found_blacklist)
-                )
-                iter_count -= 1
+            detect = None
+            if error != err.compile_err:
+                compile_count += 1
             else:
-                # find the code
-                code = "#include <bits/stdc++.h>\n\nusing namespace std;\n\n"
-                code_lines = []  # For the error detection model
-                prev_line = " "
-                idx_count = 0
-                curr_ind = 0
-                for inp, pred in zip(inp_stmt, pred_stmt):
-                    indent = "\t" * int(inp[_inp.indent])
-                    tmp_ind = int(inp[_inp.indent])
-                    if tmp_ind < curr_ind:
-                        if inp[_inp.code] != "}":
-                            indent += "} "
-                        if curr_ind - tmp_ind > 1:
-                            indent += (curr_ind - tmp_ind - 1) * "} "
-                    elif tmp_ind > curr_ind:
-                        if not prev_line or prev_line[-1] != "{":
-                            indent += "{ "
-                        if tmp_ind - curr_ind > 1:
-                            indent += (tmp_ind - curr_ind - 1) * "{ "
-                    curr_ind = tmp_ind
-                    if pred[_pred.text] == "DUMMY":
-                        curr_code = inp[_inp.code]
-                        code += indent + curr_code + "\n"
-                    else:
-                        curr_code = fix_strings(
-                            pred[_pred.pred_best + curr_idx[idx_count]]
-                        )
-                        code += indent + curr_code + " // " + inp[_inp.text] + "\n"
-                        idx_count += 1
-                    prev_line = curr_code
-                    code_lines.append((inp[_inp.text], curr_code, curr_ind))
-
-                # run the program
-                passed, error, raw_err_msg = compile_and_run_tests(
-                    code, probid, subid, iter_count
-                )
-                if error != err.compile_err:
-                    compile_count += 1
+                # detect error message and blacklist the candidate
+                start = time.time()
+                err_line_stmt_idx, err_msg = err_detector.detect(code_lines, raw_err_msg)
+                # resolve the error line to prob_list_idx
+                if err_line_stmt_idx is not None:
+                    err_line = stmt_idx_to_prob_list_idx.get(err_line_stmt_idx)
                 else:
-                    # detect error message and blacklist the candidate
-                    try:
-                        err_line_stmt_idx, err_msg = err_detector.detect(
-                            code_lines, raw_err_msg
-                        )
-                    except Exception as e:
-                        # Commit suicide
-                        print("PANIC! {}".format(e))
-                        print("PANIC! {}".format(e), file=stat_file)
-                        stat_file.write(traceback.format_exc())
-                        exit(1)
-                    # resolve the error line to prob_list_idx
-                    if err_line_stmt_idx is not None:
-                        err_line = stmt_idx_to_prob_list_idx.get(err_line_stmt_idx)
-                    else:
-                        err_line = None
-                    # after resolving, check if it's a predicted line
-                    if err_line is None:
-                        print("Error line UNKNOWN: {}".format(err_msg), file=stat_file)
-                    else:
-                        print(
-                            "Error line {} -> {}: {}".format(
-                                err_line_stmt_idx,
-                                err_line,
-                                err_msg,
-                            ),
-                            file=stat_file,
-                        )
-                        print(code_lines[err_line_stmt_idx], file=stat_file)
-                        print(
-                            "Blacklisting {}.{}".format(err_line, curr_idx[err_line]),
-                            file=stat_file,
-                        )
-                        blacklist[err_line].add(curr_idx[err_line])
-                        if ARGS.err_handling == "gray":
-                            prob_list[err_line][
-                                curr_idx[err_line]
-                            ] -= ARGS.err_gray_amount
-                        else:
-                            prob_list[err_line][curr_idx[err_line]] = ERR_BLACK_AMOUNT
-                        if ARGS.err_rebuild_heap:
-                            heap.rebuild()
+                    err_line = None
+                detect = {
+                    "stmt_idx": err_line_stmt_idx,
+                    "err_line": err_line,
+                    "message": err_msg,
+                    "blamed": None,
+                }
+                # after resolving, check if it's a predicted line
+                if err_line is not None:
+                    detect["code"] = code_lines[err_line_stmt_idx]
+                    detect["blamed"] = [err_line, curr_idx[err_line]]
+                    blame(err_line, curr_idx[err_line])
+                detect["detect_time"] = time.time() - start
+
+            log.write(
+                "iter",
+                iter=iter_count,
+                heap=heap_size,
+                log_prob=log_prob,
+                idx=curr_idx,
+                search_time=search_time,
+                compile_time=timing["compile"],
+                test_time=timing["test"],
+                passed=passed,
+                error=error,
+                detect=detect,
+            )
+            # if public didn't pass then proceed
+            if passed == pass_test.none:
+                continue
+            result = "public" if passed == pass_test.public else "hidden"
+            break
+        else:
+            if not heap.empty():
+                result = "budget"
+
+        log.write(
+            "end",
+            result=result,
+            iterations=iter_count,
+            compiled=compile_count,
+            dropped_subspaces=heap.dropped,
+        )
+    return result in ("public", "hidden"), result == "hidden"
 
-                stat_file.write(
-                    "Number of programs compiled:  " + str(compile_count) + "\n"
-                )
-                stat_file.write(str(passed) + " " + str(error) + "\n")
-                # if public didn't pass then proceed
-                if passed == pass_test.none:
-                    stat_file.write("continuing best first search...\n\n")
-                elif passed == pass_test.public:
-                    stat_file.write("passed public but failed hidden!\n\n")
-                    return True, False
-                else:
-                    stat_file.write("passed public and hidden!\n\n")
-                    return True, True
-
-            # add neighbours to the heap, but handle blacklisted candidates with care
-            if ARGS.err_rebuild_heap:
-                pass
-            elif ARGS.err_handling == "black":
-                gen_neighbors_skip_blacks(heap, curr_idx, prob_list, blacklist)
-            elif ARGS.err_handling == "gray":
-                gen_neighbors_down_grays(heap, curr_idx, prob_list, blacklist)
-            else:
-                raise ValueError("Unknown err_handling: {}".format(ARGS.err_handling))
 
-        return False, False
+################################################
 
 
-def gen_neighbors_skip_blacks(heap, curr_idx, prob_list, blacklist):
-    for i in range(len(curr_idx)):
-        new_idx = curr_idx.copy()
-        new_idx[i] += 1
-        log_prob = 0
-        for j in range(len(new_idx)):
-            # skip all blacklisted entries
-            while new_idx[j] in blacklist[j]:
-                new_idx[j] += 1
-            if new_idx[j] >= ARGS.num_preds:
-                break  # else below is not called
-            log_prob += prob_list[j][new_idx[j]]
-        else:
-            heap.add(-log_prob, new_idx)
-
-
-def gen_neighbors_down_grays(heap, curr_idx, prob_list, blacklist):
-    for i in range(len(curr_idx)):
-        new_idx = curr_idx.copy()
-        new_idx[i] += 1
-        # combos[j] = [new_idx[j]] if new_idx[j] is not blacklisted.
-        # otherwise, it's [new_idx[j], new_idx[j] + 1, ...]
-        # where the list continues until a non-blacklisted candidate is found
-        combos = [[] for _ in range(len(new_idx))]
-        for j in range(len(new_idx)):
-            k = new_idx[j]
-            while k < ARGS.num_preds:
-                combos[j].append(k)
-                if k not in blacklist[j]:
+def index_problems(folder, stop=None):
+    """
+    Scan [folder].tsv and [folder].summary once and locate every program.
+
+    Return a list of (probno, probid, subid, tsv_offset, summary_offset, num_lines),
+    where the offsets are the byte offsets of the first line of the program
+    (probno is 1-based). If stop is given, the scan ends after program stop.
+    """
+    problems = []
+    with open(folder + ".tsv", "rb") as tsvin, open(folder + ".summary", "rb") as predin:
+        tsv_offset = len(tsvin.readline())
+        pred_offset = len(predin.readline())
+        for inp, pred in zip(tsvin, predin):
+            fields = inp.split(b"\t")
+            if int(fields[_inp.line].strip()) == 0:
+                if stop is not None and len(problems) == stop:
                     break
-                k += 1
-        for new_idx in itertools.product(*combos):
-            log_prob = sum(prob_list[j][v] for (j, v) in enumerate(new_idx))
-            heap.add(-log_prob, list(new_idx))
+                problems.append(
+                    [
+                        len(problems) + 1,
+                        fields[_inp.probid].strip().decode(),
+                        fields[_inp.subid].strip().decode(),
+                        tsv_offset,
+                        pred_offset,
+                        0,
+                    ]
+                )
+            if problems:
+                problems[-1][-1] += 1
+            tsv_offset += len(inp)
+            pred_offset += len(pred)
+    return [tuple(problem) for problem in problems]
 
 
-class FragilePrioritySet(object):
+def read_problem(folder, problem):
     """
-    Rebuild the heap every time prob_list changes.
+    Read the input/pred lines of one program located by index_problems.
     """
+    _, _, _, tsv_offset, pred_offset, num_lines = problem
+    stmts = []
+    for path, offset in ((folder + ".tsv", tsv_offset), (folder + ".summary", pred_offset)):
+        with open(path, "rb") as fin:
+            fin.seek(offset)
+            # decode like open(path, "r") does
+            lines = io.TextIOWrapper(fin)
+            stmts.append([lines.readline().split("\t") for _ in range(num_lines)])
+    return stmts
+
+
+def stitch_problem(probno, probid, subid, inp_stmt, pred_stmt):
+    # generate a unique id for this program
+    unique_id = "{:04d}-{}-{}".format(probno, probid, subid)
+    print("Unique ID: " + unique_id)
+    # make dir for this program to store .cpp & stats
+    prog_dir = os.path.join(ARGS.out_dir, unique_id)
+    os.makedirs(prog_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(prog_dir)
+    global START_TIME
+    START_TIME = time.time()
+    try:
+        # oracle
+        if ARGS.oracle:
+            # generate a report for the interface to parse
+            in_beam_exact_match = generate_report(inp_stmt, pred_stmt)
+            # if in_beam_exact_match, log it
+            if in_beam_exact_match:
+                tmp_f = open("in_beam_exact_match.txt", "w")
+                tmp_f.close()
+            # check if in beam for true oracle
+            in_beam_true_oracle = true_oracle(inp_stmt, pred_stmt, probid, subid)
+            if in_beam_true_oracle:
+                tmp_f = open("in_beam_true_oracle.txt", "w")
+                tmp_f.close()
+        # detailed oracle
+        if ARGS.detailed_oracle:
+            detailed_oracle(inp_stmt, pred_stmt, probid, subid)
+        # stitcher -- top 1
+        if ARGS.top1:
+            public, hidden = stitch_top1(inp_stmt, pred_stmt, probid, subid)
+            if public:
+                tmp_f = open("passed_top1_public.txt", "w")
+                tmp_f.close()
+            if hidden:
+                tmp_f = open("passed_top1_hidden.txt", "w")
+                tmp_f.close()
+        # stitcher -- gibbs
+        if ARGS.gibbs:
+            public, hidden = stitch_gibbs(inp_stmt, pred_stmt, probid, subid)
+            if public:
+                tmp_f = open("passed_gibbs_public.txt", "w")
+                tmp_f.close()
+            if hidden:
+                tmp_f = open("passed_gibbs_hidden.txt", "w")
+                tmp_f.close()
+        # stitcher -- best_first
+        if ARGS.best_first:
+            public, hidden = stitch_best_first(inp_stmt, pred_stmt, probid, subid)
+            if public:
+                tmp_f = open("passed_best_first_public.txt", "w")
+                tmp_f.close()
+            if hidden:
+                tmp_f = open("passed_best_first_hidden.txt", "w")
+                tmp_f.close()
+        # stitcher -- best_first with prefix pruning
+        if ARGS.prefix_pruning:
+            public, hidden = stitch_prefix_pruning(inp_stmt, pred_stmt, probid, subid)
+            if public:
+                tmp_f = open("passed_prefix_pruning_public.txt", "w")
+                tmp_f.close()
+            if hidden:
+                tmp_f = open("passed_prefix_pruning_hidden.txt", "w")
+                tmp_f.close()
+        # stitcher -- best_first with error detector
+        if ARGS.error_detect:
+            public, hidden = stitch_error_detect(inp_stmt, pred_stmt, probid, subid, probno)
+            if public:
+                tmp_f = open("passed_error_detect_public.txt", "w")
+                tmp_f.close()
+            if hidden:
+                tmp_f = open("passed_error_detect_hidden.txt", "w")
+                tmp_f.close()
+    finally:
+        os.chdir(cwd)
+    return unique_id
 
-    def __init__(self, prob_list):
-        # prob_list[i][j] = logprob
-        # prob_list is a shared object that can be updated outside the class
-        self.prob_list = prob_list
-        self.L = len(self.prob_list)
-        # (neg_logprob, (j1, ..., jL), (r1, ..., rL))
-        # true indices (j1, ..., jL) are used to track used combinations
-        # ranks (r1, ..., rL) are used for finding neighbors
-        self.heap = []
-        self.rebuild()
-        # Store combinations (j1, ..., jL) returnd during any reincarnation
-        self.used = set()
-        # Store combinations (j1, ..., jL) added to heap in this reincarnation
-        self.added = set()
-
-    def rebuild(self):
-        # rankings[i][r] = j
-        self.rankings = []
-        for i, logprobs in enumerate(self.prob_list):
-            ranked = sorted((-logprob, j) for (j, logprob) in enumerate(logprobs))
-            self.rankings.append([j for (_, j) in ranked])
-        self.heap.clear()
-        self.added = set()
-        self._add_r_tuple(tuple([0] * self.L))
-
-    def _add_r_tuple(self, r_tuple):
-        assert isinstance(r_tuple, tuple)
-        j_tuple = tuple(self.rankings[i][r] for (i, r) in enumerate(r_tuple))
-        if j_tuple in self.added:
-            return
-        assert len(j_tuple) == self.L
-        logprob = sum(self.prob_list[i][j] for (i, j) in enumerate(j_tuple))
-        heapq.heappush(self.heap, (-logprob, j_tuple, r_tuple))
-        self.added.add(j_tuple)
-
-    def add(self, log_prob, idx):
-        raise NotImplementedError("Should not be called.")
 
-    def pop(self):
-        # Keep popping the heap until an unused item is found
-        while True:
-            neg_logprob, j_tuple, r_tuple = heapq.heappop(self.heap)
-            # Immediately add all neighbors
-            for i in range(self.L):
-                if r_tuple[i] < ARGS.num_preds - 1:
-                    neighbor = list(r_tuple)
-                    neighbor[i] += 1
-                    self._add_r_tuple(tuple(neighbor))
-            # If not used, return it
-            if j_tuple not in self.used:
-                self.used.add(j_tuple)
-                return (neg_logprob, list(j_tuple))
+def stitch():
+    probno, folder = ARGS.probno, ARGS.folder
+    # the following extracts the input/pred lines for the probno specified
+    # and passes it further for stitching
+    problems = index_problems(folder, stop=probno)
+    assert len(problems) == probno, "num problems = {} but probno = {}".format(
+        len(problems), probno
+    )
+    problem = problems[probno - 1]
+    inp_stmt, pred_stmt = read_problem(folder, problem)
+    stitch_problem(problem[0], problem[1], problem[2], inp_stmt, pred_stmt)
 
-    def __len__(self):
-        return len(self.heap)
 
-    def empty(self):
-        return len(self.heap) == 0
+################################################
+#   Driver: stitch all programs with a worker pool
 
 
-################################################
+def init_worker(args):
+    """
+    Set the globals of a worker process (also used by the main process).
+    """
+    global ARGS, PCH, TESTCASES, SERVICE
+    ARGS = args
+    TESTCASES = TestcaseStore(ARGS.prog_dir, ARGS.testcase_cache)
+    if ARGS.pch:
+        PCH = PrecompiledHeader(ARGS.pch_dir, timeout=ARGS.gcc_timeout)
+    if ARGS.eval_socket:
+        from service import EvalClient
 
+        SERVICE = EvalClient(ARGS.eval_socket)
 
-def stitch():
-    probno, folder = ARGS.probno, ARGS.folder
-    count = 0
-    inp_stmt, pred_stmt = [], []
 
-    # the following look extracts the input/pred lines for the probno specified
-    # and passes it further for stitching
-    with open(folder + ".tsv", "r") as tsvin, open(folder + ".summary", "r") as predin:
-        tsvin.readline(), predin.readline()
-        probid, subid = None, None
+def stitch_task(problem):
+    probno, probid, subid = problem[:3]
+    try:
+        inp_stmt, pred_stmt = read_problem(ARGS.folder, problem)
+        stitch_problem(probno, probid, subid, inp_stmt, pred_stmt)
+    except Exception:
+        # one broken program must not stop the others
+        traceback.print_exc()
+        return False
+    finally:
+        sys.stdout.flush()
+    return True
 
-        while True:
-            inp = tsvin.readline()
-            if not inp:
-                # Special handling for last line
-                assert count == probno, "num problems = {} but probno = {}".format(
-                    count, probno
-                )
-                break
-            inp = inp.split("\t")
-            pred = predin.readline().split("\t")
-            if int(inp[_inp.line].strip()) == 0:
-                if count == probno:
-                    break
-                count += 1
-                probid, subid = inp[_inp.probid].strip(), inp[_inp.subid].strip()
-                hitid = inp[_inp.hitid].strip()
-            if count == probno:
-                inp_stmt.append(inp)
-                pred_stmt.append(pred)
 
-    # generate a unique id for this program
-    unique_id = "{:04d}-{}-{}".format(probno, probid, subid)
-    print("Unique ID: " + unique_id)
-    # make dir for this program to store .cpp & stats
-    # os.system("rm -rf " + unique_id)
-    os.system("mkdir " + os.path.join(ARGS.out_dir, unique_id))
-    os.chdir(os.path.join(ARGS.out_dir, unique_id))
-    global START_TIME
-    START_TIME = time.time()
-    # oracle
-    if ARGS.oracle:
-        # generate a report for the interface to parse
-        in_beam_exact_match = generate_report(inp_stmt, pred_stmt)
-        # if in_beam_exact_match, log it
-        if in_beam_exact_match:
-            tmp_f = open("in_beam_exact_match.txt", "w")
-            tmp_f.close()
-        # check if in beam for true oracle
-        in_beam_true_oracle = true_oracle(inp_stmt, pred_stmt, probid, subid)
-        if in_beam_true_oracle:
-            tmp_f = open("in_beam_true_oracle.txt", "w")
-            tmp_f.close()
-    # detailed oracle
-    if ARGS.detailed_oracle:
-        detailed_oracle(inp_stmt, pred_stmt, probid, subid)
-    # stitcher -- top 1
-    if ARGS.top1:
-        public, hidden = stitch_top1(inp_stmt, pred_stmt, probid, subid)
-        if public:
-            tmp_f = open("passed_top1_public.txt", "w")
-            tmp_f.close()
-        if hidden:
-            tmp_f = open("passed_top1_hidden.txt", "w")
-            tmp_f.close()
-    # stitcher -- gibbs
-    if ARGS.gibbs:
-        public, hidden = stitch_gibbs(inp_stmt, pred_stmt, probid, subid)
-        if public:
-            tmp_f = open("passed_gibbs_public.txt", "w")
-            tmp_f.close()
-        if hidden:
-            tmp_f = open("passed_gibbs_hidden.txt", "w")
-            tmp_f.close()
-    # stitcher -- best_first
-    if ARGS.best_first:
-        public, hidden = stitch_best_first(inp_stmt, pred_stmt, probid, subid)
-        if public:
-            tmp_f = open("passed_best_first_public.txt", "w")
-            tmp_f.close()
-        if hidden:
-            tmp_f = open("passed_best_first_hidden.txt", "w")
-            tmp_f.close()
-    # stitcher -- best_first with prefix pruning
-    if ARGS.prefix_pruning:
-        public, hidden = stitch_prefix_pruning(inp_stmt, pred_stmt, probid, subid)
-        if public:
-            tmp_f = open("passed_prefix_pruning_public.txt", "w")
-            tmp_f.close()
-        if hidden:
-            tmp_f = open("passed_prefix_pruning_hidden.txt", "w")
-            tmp_f.close()
-    # stitcher -- best_first with error detector
-    if ARGS.error_detect:
-        public, hidden = stitch_error_detect(inp_stmt, pred_stmt, probid, subid)
-        if public:
-            tmp_f = open("passed_error_detect_public.txt", "w")
-            tmp_f.close()
-        if hidden:
-            tmp_f = open("passed_error_detect_hidden.txt", "w")
-            tmp_f.close()
-    os.chdir("../")
-    return
+def stitch_all():
+    """
+    Stitch every program of [folder].tsv in one run.
+    Both files are indexed once; programs are scheduled longest first.
+    """
+    problems = index_problems(ARGS.folder)
+    print("一共有{}个问题".format(len(problems)))
+    problems.sort(key=lambda problem: -problem[-1])
+    with EvalPool(ARGS.workers, init_worker, (ARGS,)) as pool:
+        done = list(pool.map(stitch_task, problems, timeout=ARGS.task_timeout))
+    print("Stitched {} programs, {} failed".format(len(done), done.count(False)))
 
 
 def main():
@@ -1521,7 +1816,7 @@ def main():
         "--max-heap",
         type=int,
         default=999999,
-        help="Suicide when heap is bigger than this",
+        help="Maximum number of subspaces kept by the best first search (the worst half is dropped beyond it)",
     )
     parser.add_argument(
         "-t",
@@ -1544,6 +1839,44 @@ def main():
         default=999999,
         help="Number of maximum g++ calls 编译预算",
     )
+    parser.add_argument(
+        "--testcase-cache",
+        default=None,
+        help="Directory of the binary test case index shared across runs",
+    )
+    parser.add_argument(
+        "--pch",
+        action="store_true",
+        help="Compile with a precompiled bits/stdc++.h",
+    )
+    parser.add_argument(
+        "--pch-dir",
+        default="./pch",
+        help="Directory of the precompiled header",
+    )
+    parser.add_argument(
+        "-k",
+        "--speculate",
+        type=int,
+        default=1,
+        help="(best first) Number of candidates compiled and tested concurrently",
+    )
+    parser.add_argument(
+        "--chains",
+        type=int,
+        default=1,
+        help="(gibbs) Number of chains sampled, compiled and tested concurrently",
+    )
+    parser.add_argument(
+        "--eval-socket",
+        default=None,
+        help="Compile and test through the service listening on this Unix socket (see service.py)",
+    )
+    parser.add_argument(
+        "--precheck",
+        action="store_true",
+        help="(best first / error detect) Reject syntactically broken candidate lines before compiling",
+    )
     parser.add_argument(
         "-p",
         "--num-preds",
@@ -1551,8 +1884,27 @@ def main():
         default=100,
         help="Number of predictions per line TopN",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes when stitching all programs (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--task-timeout",
+        type=int,
+        default=0,
+        help="Stop the run when a program takes longer to stitch (in seconds, 0 to disable)",
+    )
     parser.add_argument("folder")
-    parser.add_argument("probno", type=int)
+    parser.add_argument(
+        "probno",
+        type=int,
+        nargs="?",
+        default=None,
+        help="1-based program number; stitch all programs if omitted",
+    )
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
@@ -1594,7 +1946,7 @@ def main():
         "-r",
         "--err-rebuild-heap",
         action="store_true",
-        help="Rebuild the heap after an error is detected",
+        help="No effect, kept for compatibility: scores are always updated without rebuilding the heap",
     )
     group.add_argument(
         "--err-handling",
@@ -1624,7 +1976,9 @@ def main():
         help="(template) Minimum percentage for the template to trigger",
     )
     group.add_argument(
-        "--err-server", help="(binary/advanced) Server + Port of the PyTorch detector"
+        "--err-server",
+        help="(binary/advanced) Server + Port of the PyTorch detector, "
+        "or unix:[path] of a shared err_service.py",
     )
     group.add_argument(
         "--err-advanced-threshold",
@@ -1635,6 +1989,11 @@ def main():
 
     global ARGS
     ARGS = parser.parse_args()
+    if ARGS.err_rebuild_heap:
+        print(
+            "Warning: -r/--err-rebuild-heap has no effect, the heap is never rebuilt",
+            file=sys.stderr,
+        )
 
     if os.environ.get("PROG_DIR"):
         ARGS.prog_dir = str(os.environ["PROG_DIR"])
@@ -1642,7 +2001,15 @@ def main():
     if not os.path.isabs(ARGS.prog_dir):
         ARGS.prog_dir = os.path.abspath(ARGS.prog_dir)
 
-    stitch()
+    # absolute paths since stitch_problem() and the workers change the working directory
+    ARGS.folder = os.path.abspath(ARGS.folder)
+    ARGS.out_dir = os.path.abspath(ARGS.out_dir)
+    init_worker(ARGS)
+
+    if ARGS.probno is None:
+        stitch_all()
+    else:
+        stitch()
 
 
 if __name__ == "__main__":
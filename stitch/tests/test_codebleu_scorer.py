@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("codebleu")
+
+from codebleu.codebleu import calc_codebleu
+
+from codebleu_scorer import CodeBLEUScorer
+
+WEIGHTS = (0.25, 0.25, 0.25, 0.25)
+
+REFERENCE = """
+int main ( ) {
+int n ; cin >> n ;
+int s = 0 ;
+for ( int i = 0 ; i < n ; i ++ ) { int x ; cin >> x ; s += x ; }
+if ( s % 2 == 0 ) cout << "EVEN" << endl ;
+else cout << "ODD" << endl ;
+return 0 ;
+}
+"""
+
+PREDICTIONS = [
+    REFERENCE,
+    REFERENCE.replace("s += x ;", "s = s + x ;"),
+    REFERENCE.replace("int s = 0 ;", "long long s ;"),
+    REFERENCE.replace("s % 2 == 0", "s & 1").replace('"EVEN"', '"ODD"'),
+    "int main ( ) { return 0 ; }",
+    "",
+]
+
+
+def test_scores_match_calc_codebleu():
+    scorer = CodeBLEUScorer("c_sharp", weights=WEIGHTS)
+    for prediction in PREDICTIONS:
+        expected = calc_codebleu(
+            [REFERENCE], [prediction], lang="c_sharp", weights=WEIGHTS, tokenizer=None
+        )
+        result = scorer.score("1A", REFERENCE, prediction)
+        assert set(result) == set(expected)
+        for name, value in expected.items():
+            assert result[name] == pytest.approx(value, abs=1e-12), name
+
+
+def test_reference_is_parsed_once():
+    scorer = CodeBLEUScorer("c_sharp", weights=WEIGHTS)
+    first = scorer.reference("1A", REFERENCE)
+    scorer.score("1A", REFERENCE, PREDICTIONS[1])
+    assert scorer.reference("1A", REFERENCE) is first
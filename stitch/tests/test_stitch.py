@@ -0,0 +1,96 @@
+import itertools
+import random
+
+from stitch import KBestEnumerator, PrefixTrie
+
+
+def shortest_bad_prefix(prefixes, idx):
+    lengths = [len(p) for p in prefixes if list(idx[: len(p)]) == list(p)]
+    return min(lengths) if lengths else 0
+
+
+def test_prefix_trie_match():
+    trie = PrefixTrie()
+    assert trie.add([1, 2])
+    assert trie.match([1, 2, 3]) == 2
+    assert trie.match([1, 2]) == 2
+    assert trie.match([1, 3, 2]) == 0
+    assert trie.match([1]) == 0
+    # covered by [1, 2]
+    assert not trie.add([1, 2, 0])
+    assert not trie.add([1, 2])
+    assert trie.add([1])
+    assert trie.match([1, 5]) == 1
+    assert trie.match([1, 2, 3]) == 1
+    assert trie.num_prefixes == 2
+
+
+def test_prefix_trie_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(200):
+        trie, prefixes = PrefixTrie(), []
+        for _ in range(rng.randint(1, 8)):
+            prefix = [rng.randrange(3) for _ in range(rng.randint(1, 4))]
+            trie.add(prefix)
+            prefixes.append(prefix)
+        for _ in range(20):
+            idx = [rng.randrange(3) for _ in range(4)]
+            assert trie.match(idx) == shortest_bad_prefix(prefixes, idx)
+
+
+def random_prob_list(rng):
+    # quarter steps make ties frequent and the sums exact
+    return [
+        [-rng.randint(0, 8) / 4 for _ in range(rng.randint(1, 4))]
+        for _ in range(rng.randint(1, 4))
+    ]
+
+
+def brute_force_order(prob_list, banned=(), skip=()):
+    vectors = []
+    for idx in itertools.product(*[range(len(scores)) for scores in prob_list]):
+        if any(idx[j] == c for j, c in banned) or list(idx) in skip:
+            continue
+        score = 0.0
+        for j, c in enumerate(idx):
+            score += prob_list[j][c]
+        vectors.append((-score, list(idx)))
+    # ties are broken lexicographically
+    return sorted(vectors)
+
+
+def pop_all(heap):
+    popped = []
+    while not heap.empty():
+        popped.append(heap.pop())
+    return popped
+
+
+def test_kbest_enumerator_order():
+    rng = random.Random(0)
+    for _ in range(200):
+        prob_list = random_prob_list(rng)
+        assert pop_all(KBestEnumerator(prob_list)) == brute_force_order(prob_list)
+
+
+def test_kbest_enumerator_ban_and_penalize():
+    rng = random.Random(1)
+    for _ in range(200):
+        prob_list = random_prob_list(rng)
+        heap = KBestEnumerator(prob_list)
+        expected = brute_force_order(prob_list)
+        popped = [heap.pop() for _ in range(rng.randint(0, len(expected) - 1))]
+        assert popped == expected[: len(popped)]
+        seen = [idx for _, idx in popped]
+
+        j = rng.randrange(len(prob_list))
+        c = rng.randrange(len(prob_list[j]))
+        if rng.random() < 0.5:
+            heap.ban(j, c)
+            expected = brute_force_order(prob_list, banned=[(j, c)], skip=seen)
+        else:
+            amount = rng.randint(1, 4) / 4
+            heap.penalize(j, c, amount)
+            prob_list[j][c] -= amount
+            expected = brute_force_order(prob_list, skip=seen)
+        assert pop_all(heap) == expected
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+from utils import CompileCache, EvalPool, parse_testcases
+from utils import TestcaseStore as Store  # not a test class
+
+
+def square(x):
+    return x * x
+
+
+def nap(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def record_tests(cache_dir, worker, count):
+    cache = CompileCache(cache_dir)
+    for i in range(count):
+        cache.put_test("int main() {}", "1A", "testcases_{}_{}".format(worker, i), 2, 0, None)
+
+
+def test_eval_pool_map_keeps_order(tmp_path):
+    with EvalPool(2, scratch_dir=str(tmp_path)) as pool:
+        assert list(pool.map(square, range(20))) == [x * x for x in range(20)]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_eval_pool_map_timeout(tmp_path):
+    with pytest.raises(TimeoutError):
+        with EvalPool(1, scratch_dir=str(tmp_path)) as pool:
+            list(pool.map(nap, [30], timeout=0.5))
+
+
+def test_compile_cache_concurrent_updates(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    with EvalPool(4, scratch_dir=str(tmp_path)) as pool:
+        list(pool.map(record_tests, [cache_dir] * 4, range(4), [10] * 4))
+    cache = CompileCache(cache_dir)
+    entry = cache.get("int main() {}")
+    assert len(entry["tests"]) == 40
+    assert cache.get_test(entry, "1A", "testcases_3_9", 2) == (0, None)
+    assert cache.get_test(entry, "1A", "testcases_3_9", 5) is None
+
+
+CASES = [
+    (b"3\n1 2 3\n", b"6\n"),
+    (b"", b"empty input\n"),
+    ("\u00e9t\u00e9\n".encode("utf8"), b""),
+]
+
+
+def write_testcases(prog_dir, probid, test_name, cases):
+    folder = os.path.join(prog_dir, probid)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "{}_{}.txt".format(probid, test_name))
+    with open(path, "w") as fout:
+        for inp, out in cases:
+            fout.write(inp.decode("utf8") + "###ENDINPUT###\n" + out.decode("utf8") + "###ENDOUTPUT###\n")
+    return path
+
+
+def test_testcase_store_binary_round_trip(tmp_path):
+    prog_dir, cache_dir = str(tmp_path / "testcases"), str(tmp_path / "cache")
+    source = write_testcases(prog_dir, "1A", "testcases_public", CASES)
+    assert parse_testcases(source) == CASES
+
+    store = Store(prog_dir, cache_dir)
+    assert store.get("1A", "testcases_public") == CASES
+    binary = store.binary_path("1A", "testcases_public")
+    assert os.path.exists(binary)
+
+    # a new store maps the binary file instead of parsing the source
+    os.utime(source, (0, 0))
+    assert Store(prog_dir, cache_dir)._read_binary(binary) == CASES
+    assert Store(prog_dir, cache_dir).get("1A", "testcases_public") == CASES
+
+
+def test_testcase_store_rebuilds_stale_binary(tmp_path):
+    prog_dir, cache_dir = str(tmp_path / "testcases"), str(tmp_path / "cache")
+    source = write_testcases(prog_dir, "1A", "testcases_hidden", CASES)
+    Store(prog_dir, cache_dir).get("1A", "testcases_hidden")
+    write_testcases(prog_dir, "1A", "testcases_hidden", CASES[:1])
+    binary_time = os.path.getmtime(Store(prog_dir, cache_dir).binary_path("1A", "testcases_hidden"))
+    os.utime(source, (binary_time + 1, binary_time + 1))
+    assert Store(prog_dir, cache_dir).get("1A", "testcases_hidden") == CASES[:1]
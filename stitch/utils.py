@@ -0,0 +1,944 @@
+import os
+import re
+import sys
+import math
+import json
+import pickle
+import mmap
+import struct
+import time
+import signal
+import fcntl
+import select
+import selectors
+from collections import OrderedDict
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+"""
+    Helpers shared by main.py and stitch.py
+"""
+
+
+"""
+    Code normalization: quote trimming (fix_strings) and token fixes
+"""
+
+# a quoted string, or an unclosed quote up to the end of the line
+_DOUBLE_QUOTED = re.compile(r'"([^"]*)("|\Z)')
+_SINGLE_QUOTED = re.compile(r"'([^']*)('|\Z)")
+
+
+def _trim_quoted(m):
+    content, closing = m.group(1, 2)
+    quote = m.group(0)[0]
+    if not closing:
+        # unclosed quote: the content is dropped
+        return quote
+    if len(content) > 2 and content[0] == " " and content[-1] == " ":
+        content = content[1:-1]
+    return quote + content + quote
+
+
+def fix_strings(inp):
+    """
+    Remove the spaces the tokenizer put around the contents of string and
+    char literals ('" abc "' -> '"abc"'), first for double then for single
+    quotes. The content of an unclosed quote is dropped.
+    """
+    if '"' in inp:
+        inp = _DOUBLE_QUOTED.sub(_trim_quoted, inp)
+    if "'" in inp:
+        inp = _SINGLE_QUOTED.sub(_trim_quoted, inp)
+    return inp
+
+
+# fix_token: collapse doubled brackets and mark space literals.
+# The matches cannot overlap, so one pass equals the chained replacements.
+_FIX_TOKEN = re.compile(r"\( \(|\) \)|\[ \[|\] \]|\{ \{|\} \}|; ;|\"\s\"|'\s'")
+
+
+def _fix_token_repl(m):
+    token = m.group(0)
+    if token[0] in "\"'":
+        return "<space>"
+    return token[0] + token[2]
+
+
+def fix_token(nl):
+    # "long long int" may create a new "long long", keep the two passes
+    nl = nl.replace("long long int", "long_long").replace("long long", "long_long")
+    return _FIX_TOKEN.sub(_fix_token_repl, nl)
+
+
+# fix_token_b: undo the long_long / <space> markers
+_FIX_TOKEN_B = re.compile(r"long_long|<space>")
+
+
+def fix_token_b(nl):
+    if nl is None:
+        return None
+    return _FIX_TOKEN_B.sub(
+        lambda m: "long long" if m.group(0) == "long_long" else '" "', nl
+    )
+
+
+def fix_strings_batch(lines, fn=fix_strings):
+    """
+    Apply fn to a whole column of candidates (any iterable of str).
+    Duplicated candidates, frequent in top-N lists, are computed once.
+    """
+    done = {}
+    res = []
+    for line in lines:
+        fixed = done.get(line)
+        if fixed is None:
+            fixed = done[line] = fn(line)
+        res.append(fixed)
+    return res
+
+
+def _atomic_write(path, data, mode="w"):
+    """
+    Write data to path through a temporary file in the same directory,
+    so that concurrent readers never observe a half written file.
+    """
+    folder = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, mode) as fout:
+            fout.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_pickle(path, obj):
+    """
+    Pickle obj to path atomically, creating the parent directory.
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    _atomic_write(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), mode="wb")
+
+
+def load_pickle(path, source=None):
+    """
+    Return the object pickled at path.
+    Return None if the file is missing or older than the source file.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+        if source is not None and mtime < os.path.getmtime(source):
+            return None
+        with open(path, "rb") as fin:
+            return pickle.load(fin)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+class CompileCache(object):
+    """
+    Content-addressed on-disk cache of compile and test verdicts.
+
+    The key is the sha1 of the compiler command and the final C++ source,
+    so identical programs are compiled only once across runs and splits.
+    Each entry is stored as [key[:2]]/[key].json, with the binary in
+    [key[:2]]/[key].bin if keep_binaries is set (binaries are not evicted):
+
+        {
+            "compile_errors": None or str,
+            "tests": {"[probid]/[test_name]/[timeout]": [error_code, error_info], ...}
+        }
+    """
+
+    def __init__(self, cache_dir, compile_command="", keep_binaries=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.compile_command = compile_command
+        self.keep_binaries = keep_binaries
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, code):
+        sha = hashlib.sha1()
+        sha.update(self.compile_command.encode("utf8"))
+        sha.update(b"\0")
+        sha.update(code.encode("utf8", "backslashreplace"))
+        return sha.hexdigest()
+
+    def _path(self, key, suffix):
+        folder = os.path.join(self.cache_dir, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, key + suffix)
+
+    def get(self, code):
+        """
+        Return the cached entry of the code, or None if it was never compiled.
+        """
+        path = self._path(self.key(code), ".json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            # Corrupted entry: treat as a miss, it will be overwritten
+            return None
+
+    def put(self, code, entry):
+        _atomic_write(self._path(self.key(code), ".json"), json.dumps(entry))
+
+    def update(self, code, fn):
+        """
+        Read the entry of the code (or a new one), apply fn to it in place
+        and write it back. Workers and the service share the directory, so
+        the read-modify-write holds an exclusive flock on [key].lock.
+        """
+        with open(self._path(self.key(code), ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entry = self.get(code) or {"compile_errors": None, "tests": {}}
+                fn(entry)
+                self.put(code, entry)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return entry
+
+    def put_compile(self, code, compile_errors, objfile=None):
+        """
+        Record the compile verdict and keep a copy of the compiled binary
+        if keep_binaries is set.
+        """
+        key = self.key(code)
+        if self.keep_binaries and compile_errors is None and objfile is not None and os.path.exists(objfile):
+            binary = self._path(key, ".bin")
+            tmp_binary = binary + ".{}".format(os.getpid())
+            shutil.copy2(objfile, tmp_binary)
+            os.replace(tmp_binary, binary)
+
+        def set_compile(entry):
+            entry["compile_errors"] = compile_errors
+
+        return self.update(code, set_compile)
+
+    def put_test(self, code, probid, test_name, timeout, error_code, error_info):
+        def set_test(entry):
+            entry["tests"]["{}/{}/{}".format(probid, test_name, timeout)] = [error_code, error_info]
+
+        return self.update(code, set_test)
+
+    @staticmethod
+    def get_test(entry, probid, test_name, timeout):
+        """
+        Return the cached (error_code, error_info) of a test suite run with
+        the given timeout, or None.
+        """
+        res = entry["tests"].get("{}/{}/{}".format(probid, test_name, timeout))
+        return None if res is None else tuple(res)
+
+    def restore_binary(self, code, objfile):
+        """
+        Copy the cached binary of the code to objfile.
+        Return False if there is no cached binary.
+        """
+        binary = self._path(self.key(code), ".bin")
+        if not os.path.exists(binary):
+            return False
+        shutil.copy2(binary, objfile)
+        return True
+
+
+class PrecompiledHeader(object):
+    """
+    Precompiled <bits/stdc++.h> for the preamble of every stitched program.
+
+    A copy of the system header is placed in [pch_dir]/[flags hash]/bits/
+    and compiled to stdc++.h.gch with the same flags as the programs.
+    Adding "-I [dir]" to the g++ command makes the preamble resolve to the
+    .gch. If the PCH is stale (e.g. g++ was upgraded), g++ silently falls
+    back to the header copy; the stamp file and -Winvalid-pch are used to
+    detect it and rebuild.
+    """
+
+    HEADER = "bits/stdc++.h"
+    INVALID_WARNING = "-Winvalid-pch"
+
+    def __init__(self, pch_dir, flags="", timeout=60):
+        self.flags = flags
+        self.timeout = timeout
+        flags_hash = hashlib.sha1(flags.encode("utf8")).hexdigest()[:10]
+        self.include_dir = os.path.join(os.path.abspath(pch_dir), flags_hash)
+        self.header = os.path.join(self.include_dir, self.HEADER)
+        self.gch = self.header + ".gch"
+        self.stamp_file = os.path.join(self.include_dir, "stamp.txt")
+        # None: not checked yet, True: usable, False: unusable (no PCH)
+        self.usable = None
+        self.lock = threading.Lock()
+
+    def _system_header(self):
+        process = subprocess.run(
+            "echo '#include <{}>' | g++ {} -x c++ -M -".format(self.HEADER, self.flags),
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=self.timeout,
+        )
+        for token in process.stdout.decode("utf8").split():
+            if token.endswith(self.HEADER):
+                return token
+        return None
+
+    def _stamp(self, system_header):
+        version = subprocess.run(
+            ["g++", "--version"], stdout=subprocess.PIPE, timeout=self.timeout
+        ).stdout.decode("utf8")
+        return "{}\n{}\n{}\n{}".format(
+            version.strip(), self.flags, system_header, os.path.getmtime(system_header)
+        )
+
+    def _build(self):
+        system_header = self._system_header()
+        if system_header is None:
+            return False
+        stamp = self._stamp(system_header)
+        if os.path.exists(self.stamp_file) and os.path.exists(self.gch):
+            with open(self.stamp_file) as fin:
+                if fin.read() == stamp:
+                    return True
+        os.makedirs(os.path.dirname(self.header), exist_ok=True)
+        with open(system_header) as fin:
+            _atomic_write(self.header, fin.read())
+        # Build to a private file first, other workers may use the old .gch
+        tmp_gch = "{}.{}.{}".format(self.gch, os.getpid(), threading.get_ident())
+        try:
+            process = subprocess.run(
+                "g++ {} -x c++-header {} -o {}".format(self.flags, self.header, tmp_gch),
+                shell=True,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            process = None
+        if process is None or process.returncode != 0:
+            if os.path.exists(tmp_gch):
+                os.remove(tmp_gch)
+            return False
+        os.replace(tmp_gch, self.gch)
+        _atomic_write(self.stamp_file, stamp)
+        return True
+
+    def compile_flags(self):
+        """
+        Return the extra g++ flags that enable the PCH ("" if it is unusable).
+        The PCH is built on first use.
+        """
+        if self.usable is None:
+            with self.lock:
+                if self.usable is None:
+                    self.usable = self._build()
+        if not self.usable:
+            return ""
+        return "-I {} -Winvalid-pch ".format(self.include_dir)
+
+    def check(self, compiler_message):
+        """
+        Inspect the g++ output; schedule a rebuild if the PCH was rejected.
+        """
+        if compiler_message and self.INVALID_WARNING in compiler_message:
+            with self.lock:
+                if os.path.exists(self.stamp_file):
+                    os.remove(self.stamp_file)
+                self.usable = None
+
+
+# process groups started by run_command that are still running
+_CHILD_GROUPS = set()
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_command(command, timeout, **kwargs):
+    """
+    subprocess.run(command, shell=True) in its own process group.
+    On timeout the whole group (shell, g++, cc1plus, ...) is killed instead
+    of only the shell, so no orphaned compilers keep the cores busy.
+    Raise subprocess.TimeoutExpired like subprocess.run.
+    """
+    with subprocess.Popen(
+        command, shell=True, start_new_session=True, **kwargs
+    ) as process:
+        _CHILD_GROUPS.add(process.pid)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill_group(process.pid)
+            process.communicate()
+            raise
+        except BaseException:
+            _kill_group(process.pid)
+            raise
+        finally:
+            _CHILD_GROUPS.discard(process.pid)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+
+def default_scratch_dir():
+    """
+    Prefer tmpfs for the scratch files (.cpp, binaries, outputs).
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _terminate_worker(signum, frame):
+    for pgid in list(_CHILD_GROUPS):
+        _kill_group(pgid)
+    os._exit(1)
+
+
+def _process_alive(pid):
+    """
+    Whether the process exists and is not a zombie.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as fin:
+            return fin.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _init_worker(pid_queue, scratch_root, initializer, initargs):
+    signal.signal(signal.SIGTERM, _terminate_worker)
+    pid_queue.put(os.getpid())
+    # The user initializer runs first, so relative paths still resolve
+    # against the original working directory
+    if initializer is not None:
+        initializer(*initargs)
+    scratch = tempfile.mkdtemp(prefix="worker-{}-".format(os.getpid()), dir=scratch_root)
+    os.chdir(scratch)
+
+
+class EvalPool(object):
+    """
+    Process pool for the evaluators.
+    Every worker process works in its own scratch directory, so the
+    [probid]-[subid].cpp / _inp / _out / _prg files never collide.
+
+        with EvalPool(workers, init_fn, (ARGS,)) as pool:
+            res = list(pool.map(task, uids))
+
+    On an exception (including KeyboardInterrupt) pending tasks are
+    cancelled, the workers and their children are killed and the scratch
+    directories are removed.
+    """
+
+    def __init__(self, num_workers=None, initializer=None, initargs=(), scratch_dir=None):
+        self.num_workers = num_workers or os.cpu_count()
+        self.scratch_root = tempfile.mkdtemp(
+            prefix="eval-", dir=scratch_dir or default_scratch_dir()
+        )
+        # the workers report their pids, so that terminate can kill them
+        self.pid_queue = multiprocessing.SimpleQueue()
+        self.worker_pids = set()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_worker,
+            initargs=(self.pid_queue, self.scratch_root, initializer, initargs),
+        )
+        self.futures = []
+
+    def submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        self.futures.append(future)
+        return future
+
+    def map(self, fn, *iterables, timeout=None):
+        """
+        Like Executor.map: yield the results in order.
+        timeout (in seconds, None or 0 to wait forever) bounds the wait for
+        each single result; a TimeoutError is raised when it runs out, which
+        kills the workers when the pool is used as a context manager.
+        """
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        for i, future in enumerate(futures):
+            try:
+                yield future.result(timeout=timeout or None)
+            except FutureTimeoutError:
+                raise TimeoutError("Task {} did not finish in {} seconds".format(i, timeout))
+
+    def terminate(self):
+        while not self.pid_queue.empty():
+            self.worker_pids.add(self.pid_queue.get())
+        # SIGTERM lets the workers kill their running g++ / program first
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + 5
+        while any(_process_alive(pid) for pid in self.worker_pids) and time.time() < deadline:
+            time.sleep(0.05)
+        for pid in self.worker_pids:
+            if _process_alive(pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.executor.shutdown(wait=True)
+            else:
+                print("Cancelling {} workers ...".format(self.num_workers), file=sys.stderr)
+                self.terminate()
+        finally:
+            shutil.rmtree(self.scratch_root, ignore_errors=True)
+        return False
+
+
+"""
+    Test cases
+"""
+
+ENDINPUT = "###ENDINPUT###\n"
+ENDOUTPUT = "###ENDOUTPUT###\n"
+
+
+def parse_testcases(path):
+    """
+    Split a ###ENDINPUT### / ###ENDOUTPUT### test case file into
+    a list of (input, output) pairs of bytes.
+    """
+    cases = []
+    inp, out = [], []
+    current = inp
+    with open(path) as fin:
+        for line in fin:
+            if line == ENDINPUT:
+                current = out
+                continue
+            if line == ENDOUTPUT:
+                cases.append(("".join(inp).encode("utf8"), "".join(out).encode("utf8")))
+                inp, out = [], []
+                current = inp
+                continue
+            current.append(line)
+    return cases
+
+
+class Execution(object):
+    """
+    Result of one run of a program on one input.
+    returncode is None if the program exceeded its wall or CPU limit.
+    """
+
+    __slots__ = ("returncode", "stdout", "stderr", "wall", "cpu")
+
+    def __init__(self, returncode, stdout, stderr, wall, cpu):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall = wall
+        self.cpu = cpu
+
+
+def _set_cpu_limit(pid, cpu_limit):
+    """
+    Set RLIMIT_CPU of a running process: SIGXCPU at the soft limit,
+    SIGKILL one second later. The CPU time spent before the call counts.
+    (Not a preexec_fn, which may deadlock when the evaluator uses threads.)
+    """
+    import resource
+
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+    except ProcessLookupError:
+        pass
+
+
+def execute(objfile, inp, timeout, max_output=None, cpu_limit=None):
+    """
+    Run ./[objfile] with inp (bytes) on stdin, without a shell or timeout(1).
+    stdout and stderr are captured in memory.
+
+    - timeout is the wall-clock limit, enforced by this process.
+    - cpu_limit (integer seconds) is enforced by the kernel with RLIMIT_CPU,
+      set with prlimit right after the program starts.
+    - if stdout grows beyond max_output bytes, the program is killed
+      and stdout is cut (it then differs from any output of that size).
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [os.path.join(".", objfile)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    _CHILD_GROUPS.add(process.pid)
+    if cpu_limit is not None:
+        _set_cpu_limit(process.pid, cpu_limit)
+    chunks = {process.stdout: [], process.stderr: []}
+    stdout_size = 0
+    offset = 0
+    timed_out = truncated = False
+    deadline = start + timeout
+    with selectors.DefaultSelector() as selector:
+        if inp:
+            selector.register(process.stdin, selectors.EVENT_WRITE)
+        else:
+            process.stdin.close()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        selector.register(process.stderr, selectors.EVENT_READ)
+        while selector.get_map() and not truncated:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            for key, _ in selector.select(remaining):
+                fileobj = key.fileobj
+                if fileobj is process.stdin:
+                    try:
+                        offset += os.write(key.fd, inp[offset : offset + select.PIPE_BUF])
+                    except BrokenPipeError:
+                        # The program does not read all of its input
+                        offset = len(inp)
+                    if offset >= len(inp):
+                        selector.unregister(fileobj)
+                        fileobj.close()
+                    continue
+                data = os.read(key.fd, 32768)
+                if not data:
+                    selector.unregister(fileobj)
+                    fileobj.close()
+                    continue
+                chunks[fileobj].append(data)
+                if fileobj is process.stdout:
+                    stdout_size += len(data)
+                    if max_output is not None and stdout_size > max_output:
+                        truncated = True
+                        break
+    if not (timed_out or truncated):
+        # stdout and stderr are closed, but the program may still be running
+        delay = 0.0005
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.01)
+    if timed_out or truncated:
+        _kill_group(process.pid)
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - start
+    _CHILD_GROUPS.discard(process.pid)
+    for fileobj in (process.stdin, process.stdout, process.stderr):
+        if not fileobj.closed:
+            fileobj.close()
+    if timed_out or process.returncode == -signal.SIGXCPU:
+        returncode = None
+    elif truncated:
+        # Killed for the output limit: the output comparison fails anyway
+        returncode = 0
+    elif (
+        cpu_limit is not None
+        and process.returncode == -signal.SIGKILL
+        and rusage.ru_utime + rusage.ru_stime >= cpu_limit
+    ):
+        # hard RLIMIT_CPU
+        returncode = None
+    else:
+        returncode = process.returncode
+    return Execution(
+        returncode,
+        b"".join(chunks[process.stdout]),
+        b"".join(chunks[process.stderr]),
+        wall,
+        rusage.ru_utime + rusage.ru_stime,
+    )
+
+
+class SuiteReport(object):
+    """
+    Result of run_suites.
+
+    - passed: names of the suites whose cases all passed
+    - failed: name of the first failing suite (None if all passed)
+    - kind: "timeout", "runtime" or "mismatch" (None if all passed)
+    - info: "Timeout {}", the stderr of the program, or "Mismatch [num_test]"
+    - case: (input, gold, output) of the failing case
+    - timings: (suite, num_test, wall, cpu) of every case that was run
+    """
+
+    def __init__(self):
+        self.passed = []
+        self.failed = None
+        self.kind = None
+        self.info = None
+        self.case = None
+        self.timings = []
+
+    def to_dict(self):
+        """
+        JSON-friendly form; the bytes of the failing case are kept as latin-1.
+        """
+        return {
+            "passed": self.passed,
+            "failed": self.failed,
+            "kind": self.kind,
+            "info": self.info,
+            "case": None if self.case is None else [x.decode("latin-1") for x in self.case],
+            "timings": self.timings,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        report = cls()
+        report.passed = list(data["passed"])
+        report.failed = data["failed"]
+        report.kind = data["kind"]
+        report.info = data["info"]
+        if data["case"] is not None:
+            report.case = tuple(x.encode("latin-1") for x in data["case"])
+        report.timings = [tuple(timing) for timing in data["timings"]]
+        return report
+
+
+def run_suites(objfile, suites, timeout, big_output=1000000):
+    """
+    Run ./[objfile] on the cases of every suite in order, e.g.
+    [("testcases_public", cases), ("testcases_hidden", cases)],
+    in a single supervised session that stops at the first failure.
+    Each case is limited to timeout seconds of wall clock and CPU time.
+    Outputs larger than max(len(gold), big_output) are mismatches.
+    """
+    report = SuiteReport()
+    cpu_limit = max(1, int(math.ceil(timeout)))
+    for test_name, cases in suites:
+        for num_test, (inp, out) in enumerate(cases):
+            res = execute(
+                objfile,
+                inp,
+                timeout,
+                max_output=max(len(out), big_output),
+                cpu_limit=cpu_limit,
+            )
+            report.timings.append((test_name, num_test, res.wall, res.cpu))
+            if res.returncode is None:
+                report.kind, report.info = "timeout", "Timeout {}"
+            elif res.returncode != 0:
+                report.kind = "runtime"
+                report.info = res.stderr.decode("utf8", "backslashreplace")
+            elif res.stdout != out:
+                report.kind, report.info = "mismatch", "Mismatch {}".format(num_test)
+            else:
+                continue
+            report.failed = test_name
+            report.case = (inp, out, res.stdout)
+            return report
+        report.passed.append(test_name)
+    return report
+
+
+class TestcaseStore(object):
+    """
+    Lazily built, memoized index of the parsed test cases of each problem.
+
+    get(probid, test_name) parses [prog_dir]/[probid]/[probid]_[test_name].txt
+    at most once per process and keeps the last max_entries suites in memory.
+    If cache_dir is given, the parsed cases are also written to a compact
+    binary file that other workers (and later runs) mmap instead of parsing:
+
+        b"TCS1" | count (uint32) | count x (inp_off, inp_len, out_off, out_len) (uint64) | data
+
+    A binary file older than its source file is rebuilt.
+    """
+
+    MAGIC = b"TCS1"
+    HEAD = struct.Struct("<4sI")
+    ENTRY = struct.Struct("<QQQQ")
+
+    def __init__(self, prog_dir, cache_dir=None, max_entries=64):
+        self.prog_dir = os.path.abspath(prog_dir)
+        self.cache_dir = None if cache_dir is None else os.path.abspath(cache_dir)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def source_path(self, probid, test_name):
+        return "{}/{}/{}_{}.txt".format(self.prog_dir, probid, probid, test_name)
+
+    def binary_path(self, probid, test_name):
+        return os.path.join(self.cache_dir, "{}_{}.bin".format(probid, test_name))
+
+    def get(self, probid, test_name):
+        """
+        Return the list of (input, output) bytes pairs.
+        """
+        key = (probid, test_name)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        cases = self._load(probid, test_name)
+        with self.lock:
+            self.entries[key] = cases
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return cases
+
+    def _load(self, probid, test_name):
+        source = self.source_path(probid, test_name)
+        if self.cache_dir is None:
+            return parse_testcases(source)
+        binary = self.binary_path(probid, test_name)
+        if (
+            os.path.exists(binary)
+            and os.path.getmtime(binary) >= os.path.getmtime(source)
+        ):
+            cases = self._read_binary(binary)
+            if cases is not None:
+                return cases
+        cases = parse_testcases(source)
+        self._write_binary(binary, cases)
+        return cases
+
+    def _write_binary(self, binary, cases):
+        offset = self.HEAD.size + self.ENTRY.size * len(cases)
+        index, data = [], []
+        for inp, out in cases:
+            index.append(self.ENTRY.pack(offset, len(inp), offset + len(inp), len(out)))
+            data += [inp, out]
+            offset += len(inp) + len(out)
+        payload = self.HEAD.pack(self.MAGIC, len(cases)) + b"".join(index + data)
+        _atomic_write(binary, payload, mode="wb")
+
+    def _read_binary(self, binary):
+        with open(binary, "rb") as fin:
+            if os.fstat(fin.fileno()).st_size < self.HEAD.size:
+                return None
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, count = self.HEAD.unpack_from(mm, 0)
+                if magic != self.MAGIC:
+                    return None
+                cases = []
+                for i in range(count):
+                    inp_off, inp_len, out_off, out_len = self.ENTRY.unpack_from(
+                        mm, self.HEAD.size + i * self.ENTRY.size
+                    )
+                    cases.append(
+                        (mm[inp_off : inp_off + inp_len], mm[out_off : out_off + out_len])
+                    )
+                return cases
+
+
+"""
+    Compile-and-test jobs, run in EvalPool workers (see service.py)
+"""
+
+# per worker state set by init_job_worker
+_JOB = {}
+# accepted values of the std of a job (passed to g++ as -std=...)
+_STD = re.compile(r"^(c|gnu)\+\+\w{2}$")
+# accepted file names of a job
+_NAME = re.compile(r"^[\w.-]+$")
+
+
+def init_job_worker(prog_dir, testcase_cache=None, pch_dir=None, gcc_timeout=30):
+    _JOB["testcases"] = TestcaseStore(prog_dir, testcase_cache)
+    _JOB["pch_dir"] = pch_dir
+    _JOB["pch"] = {}
+    _JOB["gcc_timeout"] = gcc_timeout
+
+
+def run_job(code, probid, suites, timeout, std=None, name="job", big_output=1000000, gcc_timeout=None):
+    """
+    Compile code as [name].cpp in the scratch directory of the worker and run
+    it on the given suites of probid (one session, stops at the first failure).
+    gcc_timeout defaults to the one of the worker.
+    Return a dict with "compile_errors", "compile_time" and the fields of
+    SuiteReport.to_dict (empty if the compilation failed).
+    """
+    if std is not None and not _STD.match(std):
+        raise ValueError("Invalid std: {}".format(std))
+    if not _NAME.match(name):
+        raise ValueError("Invalid name: {}".format(name))
+    flags = "" if std is None else "-std={} ".format(std)
+    if _JOB["pch_dir"] is not None:
+        pch = _JOB["pch"].get(flags)
+        if pch is None:
+            pch = _JOB["pch"][flags] = PrecompiledHeader(
+                _JOB["pch_dir"], flags=flags.strip(), timeout=_JOB["gcc_timeout"]
+            )
+        flags += pch.compile_flags()
+    else:
+        pch = None
+    if gcc_timeout is None:
+        gcc_timeout = _JOB["gcc_timeout"]
+    objfile = name
+    with open(objfile + ".cpp", "w") as src_file:
+        src_file.write(code)
+    start = time.monotonic()
+    try:
+        process = run_command(
+            "g++ {}{}.cpp -o {}".format(flags, objfile, objfile),
+            timeout=gcc_timeout,
+            stderr=subprocess.PIPE,
+        )
+        compile_errors = process.stderr.decode("utf8", "backslashreplace")
+        if pch is not None:
+            pch.check(compile_errors)
+        if process.returncode == 0:
+            compile_errors = None
+    except subprocess.TimeoutExpired:
+        compile_errors = "g++ timeout!"
+    res = {"compile_errors": compile_errors, "compile_time": time.monotonic() - start}
+    try:
+        if compile_errors is None:
+            report = run_suites(
+                objfile,
+                [(suite, _JOB["testcases"].get(probid, suite)) for suite in suites],
+                timeout,
+                big_output=big_output,
+            )
+            res.update(report.to_dict())
+        else:
+            res.update(SuiteReport().to_dict())
+    finally:
+        for path in (objfile, objfile + ".cpp"):
+            if os.path.exists(path):
+                os.remove(path)
+    return res